@@ -6,9 +6,12 @@
 import inspect
 import os, os.path
 import time
+import warnings
 
 # Self imports
 import misc
+import spatial
+import storage
 import data_processing
 import recommenders
 import recommender_systems
@@ -23,17 +26,21 @@ import integration
 
 
 # TODO: remove this when stable
-reload(misc)
-reload(data_processing)
-reload(recommenders)
-reload(recommender_systems.base)
-reload(recommender_systems.simple)
-reload(recommender_systems.user_based)
-reload(recommender_systems.item_based)
-reload(recommender_systems.hybrid)
-reload(recommender_systems.evaluation)
-reload(weather)
-reload(integration)
+# (only when the package itself is reloaded - on the first import the modules are fresh)
+if globals().has_key('RECOMMENDERS'):
+    reload(misc)
+    reload(spatial)
+    reload(storage)
+    reload(data_processing)
+    reload(recommenders)
+    reload(recommender_systems.base)
+    reload(recommender_systems.simple)
+    reload(recommender_systems.user_based)
+    reload(recommender_systems.item_based)
+    reload(recommender_systems.hybrid)
+    reload(recommender_systems.evaluation)
+    reload(weather)
+    reload(integration)
 
 
 
@@ -58,7 +65,8 @@ RATING_KEY_1 	= 'tvAEWLlgopSFsWrdwyWOURg'
 scripts_dir = os.path.dirname(inspect.currentframe().f_code.co_filename)
 data_dir = os.path.join(scripts_dir, 'data')
 
-GEOCODING_CACHE_FILE = os.path.join(data_dir, "geocache.shelve")
+GEOCODING_CACHE_FILE = os.path.join(data_dir, "geocache.sqlite")
+OLD_GEOCODING_CACHE_FILE = os.path.join(data_dir, "geocache.shelve")
 
 PLACES_FILE 	= os.path.join(data_dir, "places_db.pcl")
 USERS_FILE 		= os.path.join(data_dir, "users_db.pcl")
@@ -67,32 +75,60 @@ RATING_FILE 	= os.path.join(data_dir, "rating_db.pcl")
 MOVIELENS_100K_FILE = os.path.join(data_dir, "datasets", "movielens", "100k", "u.data")
 
 
-GC = data_processing.GeocodingCache(GEOCODING_CACHE_FILE)
+GEOCODING_STORE = data_processing.SqliteGeocodingStore(GEOCODING_CACHE_FILE)
 
-RD_places 	= data_processing.PlacesRecommenderData(PLACES_FILE, GC, PLACES_KEY_1, GOOGLE_USER)
-RD_users 	= data_processing.UsersRecommenderData(USERS_FILE, USERS_KEY_1, GOOGLE_USER)
-RD_rating 	= data_processing.RatingRecommenderData(RATING_FILE, RATING_KEY_1, GOOGLE_USER)
+# (the geocoding cache used to be a shelve - copy it once; tried again next time if it fails)
+if os.path.exists(OLD_GEOCODING_CACHE_FILE) and not GEOCODING_STORE.Imported(OLD_GEOCODING_CACHE_FILE):
+    try:
+        GEOCODING_STORE.ImportShelve(OLD_GEOCODING_CACHE_FILE)
+    except Exception, e:
+        warnings.warn("Could not copy the old geocoding cache %s: %s" % (OLD_GEOCODING_CACHE_FILE, e))
+
+GC = data_processing.GeocodingCache(GEOCODING_STORE)
+
+# (the place/user IDs are given the same indices in all the data)
+PLACE_IDS 	= data_processing.IdRegistry()
+USER_IDS 	= data_processing.IdRegistry()
+
+RD_places 	= data_processing.PlacesRecommenderData(PLACES_FILE, GC, PLACES_KEY_1, GOOGLE_USER, ids=PLACE_IDS)
+RD_users 	= data_processing.UsersRecommenderData(USERS_FILE, USERS_KEY_1, GOOGLE_USER, ids=USER_IDS)
+RD_rating 	= data_processing.RatingRecommenderData(RATING_FILE, RATING_KEY_1, GOOGLE_USER, user_ids=USER_IDS, place_ids=PLACE_IDS)
 
 
 # (to match old docs)
 RD = RD_places
 
 
-# Different versions of recommenders
-SLO = recommenders.SlopeOneRecommender(RD_places, RD_users, RD_rating, weather.GoogleWeather())
-WSLO = recommenders.WeightedSlopeOneRecommender(RD_places, RD_users, RD_rating, weather.GoogleWeather())
+# Weather, shared by all recommenders
+WEATHER = weather.CachedWeather(weather.GoogleWeather())
+
+# Different versions of recommenders (each is built when first used)
+RECOMMENDERS = recommenders.RecommenderRegistry()
+
+RECOMMENDERS.Register('SLO', lambda: recommenders.SlopeOneRecommender(RD_places, RD_users, RD_rating, WEATHER))
+RECOMMENDERS.Register('WSLO', lambda: recommenders.WeightedSlopeOneRecommender(RD_places, RD_users, RD_rating, WEATHER))
+
+RECOMMENDERS.Register('PEAR', lambda: recommenders.PearsonRecommender(RD_places, RD_users, RD_rating, WEATHER))
 
-PEAR = recommenders.PearsonRecommender(RD_places, RD_users, RD_rating, weather.GoogleWeather())
+RECOMMENDERS.Register('SW', lambda: recommenders.SimpleWineryRecommender(RD_places, WEATHER))
+RECOMMENDERS.Register('SWJ', lambda: recommenders.SimpleWineryRecommender(RD_places, weather.RainyInJerusalem()))
 
-SW = recommenders.SimpleWineryRecommender(RD_places, weather.GoogleWeather())
-SWJ = recommenders.SimpleWineryRecommender(RD_places, weather.RainyInJerusalem())
 
+RECOMMENDERS.Register('TF', lambda: recommenders.TFIDFRecommender(RD_places, RD_users, RD_rating, WEATHER))
+RECOMMENDERS.Register('HY', lambda: recommenders.HybridLinearRecommender(RD_places, RD_users, RD_rating, WEATHER))
+RECOMMENDERS.Register('HY2', lambda: recommenders.HybridAugmentedRecommender(RD_places, RD_users, RD_rating, WEATHER))
 
-TF = recommenders.TFIDFRecommender(RD_places, RD_users, RD_rating, weather.GoogleWeather())
-HY = recommenders.HybridLinearRecommender(RD_places, RD_users, RD_rating, weather.GoogleWeather())
-HY2 = recommenders.HybridAugmentedRecommender(RD_places, RD_users, RD_rating, weather.GoogleWeather())
+RECOMMENDERS.Register('DEMO', lambda: recommenders.DemographicRecommender(RD_places, RD_users, RD_rating, WEATHER))
 
-DEMO = recommenders.DemographicRecommender(RD_places, RD_users, RD_rating, weather.GoogleWeather())
+SLO = RECOMMENDERS.Lazy('SLO')
+WSLO = RECOMMENDERS.Lazy('WSLO')
+PEAR = RECOMMENDERS.Lazy('PEAR')
+SW = RECOMMENDERS.Lazy('SW')
+SWJ = RECOMMENDERS.Lazy('SWJ')
+TF = RECOMMENDERS.Lazy('TF')
+HY = RECOMMENDERS.Lazy('HY')
+HY2 = RECOMMENDERS.Lazy('HY2')
+DEMO = RECOMMENDERS.Lazy('DEMO')
 
 
 
@@ -121,7 +157,5 @@ def random_user():
 	import random
 	return random.choice(RD_users.keys())
 
-def syncall(passwd):
-	RD_places.Sync(passwd)
-	RD_users.Sync(passwd)
-	RD_rating.Sync(passwd)
+def syncall(passwd, **kwargs):
+	return data_processing.SyncAll([RD_places, RD_users, RD_rating], passwd, **kwargs)
@@ -8,26 +8,46 @@ import gdata.spreadsheet.service
 import geopy.geocoders
 
 import shelve
+import sqlite3
 import warnings
 import cPickle
 import random
 import os.path
+import sys
+import time
+import threading
+import Queue
+import collections
+import hashlib
+import weakref
+import atexit
+import numpy
+
+# Self imports
+import spatial
+import storage
 
 
 
 __all__.append('GoogleSpreadsheetAcquisitor')
 class GoogleSpreadsheetAcquisitor:
 
-    def __init__(self, email, password):
+    def __init__(self, email, password, service=None):
         """
         Create a client that can get a google spreadsheet easily and download its data.
         
         email   - the email/username (e.g., "username@gmail.com")
         pass    - the password
+
+        Optional:
+        service - the spreadsheets service to use (default is a new gdata SpreadsheetsService;
+                  see also FakeSpreadsheetService)
         
         """
         
-        self.gd_client = gdata.spreadsheet.service.SpreadsheetsService()
+        if service == None:
+            service = gdata.spreadsheet.service.SpreadsheetsService()
+        self.gd_client = service
         self.gd_client.email = email
         self.gd_client.password = password
         self.gd_client.source = 'Spreadsheets GData Sample'
@@ -46,11 +66,75 @@ class GoogleSpreadsheetAcquisitor:
         
         """
         
+        final_rows = []
+        for page in self.IterPages(spreadsheet_key, sheet_number):
+            final_rows.extend(page)
+        return final_rows
+
+    def IterPages(self, spreadsheet_key, sheet_number, page_size=500, prefetch=2):
+        """
+        Get the data from a spreadsheet, as a generator of pages (lists of rows), so the rows can be
+        processed while the next pages download.
+
+        spreadsheet_key     - The key of the spreadsheet (see GetSpreadsheet)
+        sheet_number        - The number of the worksheet (this worksheet should exist)
+
+        Optional:
+        page_size           - Number of rows to download at once
+        prefetch            - Number of pages to download ahead
+        """
+
         worksheet_feed = self.gd_client.GetWorksheetsFeed(spreadsheet_key)
         if len(worksheet_feed.entry) <= sheet_number:
             raise IndexError("No worksheet number %d (total %d)" % (sheet_number,len(worksheet_feed.entry)))
         worksheet_key = worksheet_feed.entry[sheet_number].id.text.split('/')[-1]
-        list_feed = self.gd_client.GetListFeed(spreadsheet_key, worksheet_key)
+
+        pages = Queue.Queue(prefetch)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pages.put(item, timeout=0.1)
+                    return
+                except Queue.Full:
+                    pass
+
+        def download():
+            try:
+                start = 1
+                while not stop.is_set():
+                    page = self._GetPage(spreadsheet_key, worksheet_key, start, page_size)
+                    if len(page) > 0:
+                        put(page)
+                    if len(page) < page_size:
+                        break
+                    start += page_size
+                put(None)
+            except:
+                put(sys.exc_info())
+
+        thread = threading.Thread(target=download)
+        thread.setDaemon(True)
+        thread.start()
+
+        try:
+            while True:
+                item = pages.get()
+                if item == None:
+                    return
+                if isinstance(item, tuple):
+                    # (an exception in the downloading thread)
+                    raise item[0], item[1], item[2]
+                yield item
+        finally:
+            stop.set()
+
+    def _GetPage(self, spreadsheet_key, worksheet_key, start, page_size):
+        query = gdata.spreadsheet.service.ListQuery()
+        query['start-index'] = str(start)
+        query['max-results'] = str(page_size)
+        list_feed = self.gd_client.GetListFeed(spreadsheet_key, worksheet_key, query=query)
         final_rows = []
         for row in list_feed.entry:
             d = {}
@@ -58,74 +142,687 @@ class GoogleSpreadsheetAcquisitor:
                 d[k] = v.text
             final_rows.append(d)
         return final_rows
-            
+
+
+__all__.append('SpreadsheetSessionPool')
+class SpreadsheetSessionPool:
+    """
+    Keeps logged in GoogleSpreadsheetAcquisitor objects, so each sync does not have to log in again.
+    An acquisitor is used by one user at a time (several are logged in if needed at once).
+
+    >>> A = SPREADSHEET_SESSIONS.Acquire("username@gmail.com", password)
+    >>> rows = A.GetSpreadsheet(key, 0)
+    >>> SPREADSHEET_SESSIONS.Release(A)
+    """
+
+    def __init__(self, service_factory=None):
+        """
+        Optional:
+        service_factory     - A function returning a new spreadsheets service (see GoogleSpreadsheetAcquisitor)
+        """
+        self.service_factory = service_factory
+        self.idle = {}                  # (email, password) -> list of idle acquisitors
+        self.lock = threading.Lock()
+
+    def Acquire(self, email, password):
+        """
+        Return a logged in GoogleSpreadsheetAcquisitor (call Release when done).
+        """
+        with self.lock:
+            idle = self.idle.get((email, password), [])
+            if len(idle) > 0:
+                return idle.pop()
+
+        service = None
+        if self.service_factory != None:
+            service = self.service_factory()
+        acquisitor = GoogleSpreadsheetAcquisitor(email, password, service)
+        acquisitor.credentials = (email, password)
+        return acquisitor
+
+    def Release(self, acquisitor):
+        with self.lock:
+            self.idle.setdefault(acquisitor.credentials, []).append(acquisitor)
+
+    def Clear(self):
+        """
+        Forget all the sessions (e.g., after a password change).
+        """
+        with self.lock:
+            self.idle = {}
+
+
+# The sessions used by RecommenderData.Sync
+SPREADSHEET_SESSIONS = SpreadsheetSessionPool()
+
+
+__all__.append('FakeSpreadsheetService')
+class FakeSpreadsheetService:
+    """
+    (For debugging and testing purposes)
+
+    A local stand-in for the google spreadsheets service (gdata's SpreadsheetsService), which serves
+    rows from memory, in pages, with a delay. Use with GoogleSpreadsheetAcquisitor or SpreadsheetSessionPool:
+
+    >>> S = FakeSpreadsheetService({'tlp_N0Ej7v_fz0MMMlV_rdA': [[{'id': '766cff27a26d9ba5', 'address': 'Zichron Yaakov'}]]})
+    >>> GoogleSpreadsheetAcquisitor("username@gmail.com", "password", S).GetSpreadsheet('tlp_N0Ej7v_fz0MMMlV_rdA', 0)
+    [{'id': '766cff27a26d9ba5', 'address': 'Zichron Yaakov'}]
+    """
+
+    n_logins = 0
+
+    def __init__(self, spreadsheets, delay=0):
+        """
+        spreadsheets    - dict from spreadsheet key to a list of worksheets, each a list of rows (dicts)
+        delay           - number of seconds each request takes
+        """
+        self.spreadsheets = spreadsheets
+        self.delay = delay
+        self.n_requests = 0
+
+    def ProgrammaticLogin(self):
+        FakeSpreadsheetService.n_logins += 1
+
+    def _Request(self):
+        self.n_requests += 1
+        if self.delay:
+            time.sleep(self.delay)
+
+    def GetWorksheetsFeed(self, spreadsheet_key):
+        self._Request()
+        worksheets = self.spreadsheets[spreadsheet_key]
+        return _FakeFeedObject(entry=[_FakeFeedObject(id=_FakeFeedObject(text="%s/worksheets/%s/private/full/%d" % (self.__class__.__name__, spreadsheet_key, n)))
+                                      for n in xrange(len(worksheets))])
+
+    def GetListFeed(self, spreadsheet_key, worksheet_key, query=None):
+        self._Request()
+        rows = self.spreadsheets[spreadsheet_key][int(worksheet_key)]
+        start, n_rows = 1, len(rows)
+        if query != None:
+            start, n_rows = int(query['start-index']), int(query['max-results'])
+        return _FakeFeedObject(entry=[_FakeFeedObject(custom=dict((k, _FakeFeedObject(text=v)) for k, v in row.iteritems()))
+                                      for row in rows[start-1:start-1+n_rows]])
+
+
+class _FakeFeedObject:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+__all__.append('ShelveGeocodingStore')
+class ShelveGeocodingStore:
+    """
+    Keeps geocoding results (for GeocodingCache) in a shelve file.
+    
+    Only one process at a time can use the file.
+    """
+    
+    def __init__(self, filename):
+        self.filename = filename
+        self.shelve_obj = shelve.open(self.filename)
+
+    def Get(self, key):
+        """
+        Return the value kept for key, or None.
+        """
+        if self.shelve_obj.has_key(key):
+            return self.shelve_obj[key]
+        return None
+
+    def Put(self, key, value):
+        self.shelve_obj[key] = value
+
+    def PutMany(self, items):
+        for key, value in items:
+            self.shelve_obj[key] = value
+
+    def Close(self):
+        self.shelve_obj.close()
+
+
+__all__.append('SqliteGeocodingStore')
+class SqliteGeocodingStore:
+    """
+    Keeps geocoding results (for GeocodingCache) in an SQLite database.
+    
+    The database is in WAL mode, so many processes can read it while one of them writes.
+    Each address (normalized) is kept with its result and the time it was geocoded.
+    
+    To move an old shelve cache to SQLite:
+    
+    >>> S = SqliteGeocodingStore(r"data\geocache.sqlite")
+    >>> S.ImportShelve(r"data\geocache.shelve")
+    1032
+    >>> S.Imported(r"data\geocache.shelve")
+    True
+    """
+    
+    def __init__(self, filename, timeout=30):
+        """
+        filename    - The database file (created if it doesn't exist)
+        
+        Optional:
+        timeout     - Number of seconds to wait for another process which is writing
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        
+        # (used by several threads, see lock)
+        self.connection = sqlite3.connect(self.filename, timeout=timeout, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS geocache ("
+                                "address TEXT PRIMARY KEY, "
+                                "name TEXT, "
+                                "lat REAL, "
+                                "long REAL, "
+                                "failed INTEGER NOT NULL, "
+                                "time REAL NOT NULL)")
+        # (the shelve files which were imported, by name)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS imports ("
+                                "name TEXT PRIMARY KEY, "
+                                "time REAL NOT NULL)")
+
+    def _Row(self, key, value):
+        if value[:2] == GeocodingCache.FAILED:
+            return (key, None, None, None, 1, value[2] if len(value) > 2 else 0)
+        name, (latitude, longitude) = value
+        return (key, name, latitude, longitude, 0, time.time())
+
+    def Get(self, key):
+        """
+        Return the value kept for key, or None.
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT name, lat, long, failed, time FROM geocache WHERE address = ?", (key,)).fetchone()
+        if row == None:
+            return None
+        name, latitude, longitude, failed, when = row
+        if failed:
+            return GeocodingCache.FAILED + (when,)
+        return (name, (latitude, longitude))
+
+    def Put(self, key, value):
+        self.PutMany([(key, value)])
+
+    def PutMany(self, items, replace=True):
+        """
+        Keep several values at once (in one transaction).
+        
+        replace     - If False, addresses which are already kept are left alone
+        """
+        rows = [self._Row(key, value) for key, value in items]
+        verb = "INSERT OR REPLACE" if replace else "INSERT OR IGNORE"
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(verb + " INTO geocache VALUES (?, ?, ?, ?, ?, ?)", rows)
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def ImportShelve(self, shelve_filename):
+        """
+        Copy the results from an old shelve cache (keys are normalized; results already here are kept),
+        and remember that it was imported (see Imported). Return the number of addresses copied.
+
+        If the shelve cannot be read, nothing is copied (so the import can be tried again).
+        """
+        shelve_obj = shelve.open(shelve_filename, 'r')
+        try:
+            items = {}
+            for address, value in shelve_obj.iteritems():
+                key = NormalizeAddress(address)
+                # (prefer a result over a failure, if the same address was kept twice)
+                if not items.has_key(key) or items[key][:2] == GeocodingCache.FAILED:
+                    items[key] = value
+        finally:
+            shelve_obj.close()
+        self.PutMany(items.items(), replace=False)
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO imports VALUES (?, ?)", (os.path.basename(shelve_filename), time.time()))
+        return len(items)
+
+    def Imported(self, shelve_filename):
+        """
+        Return whether a shelve cache (by its file name) was imported (see ImportShelve).
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT name FROM imports WHERE name = ?", (os.path.basename(shelve_filename),)).fetchone()
+        return row != None
+
+    def Close(self):
+        self.connection.close()
+
+
+__all__.append('NormalizeAddress')
+def NormalizeAddress(address):
+    """
+    The form of an address used as a key in the geocoding cache (lower case, single spaces).
+    """
+    return ' '.join(address.split()).lower()
+
+
 __all__.append('GeocodingCache')
 class GeocodingCache:
     """
-    A geocoder with a builtin file cache. Can be accessed like a dictionary, and return
+    A geocoder with a builtin file cache (SQLite or shelve). Can be accessed like a dictionary, and return
     a tuple of text representation and a tuple of lat/long (as returned by google).
+    Failures return (-1, -1), and are retried after failure_ttl seconds.
     
     Use like this:
     
     >>> G = GeocodingCache(filename)
     >>> G["Jerusalem, Israel"]
     (u'Jerusalem, Israel', (31.768862, 35.203856))
+    >>> G.GeocodeMany(["Jerusalem, Israel", "  jerusalem,  israel", "Haifa, Israel"])
+    [(u'Jerusalem, Israel', (31.768862, 35.203856)), (u'Jerusalem, Israel', (31.768862, 35.203856)), (u'Haifa, Israel', (32.794044, 34.989571))]
     
-    
+    Addresses are normalized (case and whitespace) before caching; recent results are also kept in memory.
     """
+
+    FAILED = (-1, -1)
     
-    
-    def __init__(self, shelve_filename):
+    def __init__(self, filename, geocoder=None, n_threads=4, rate=5, failure_ttl=24*60*60, memory_size=10000):
         """
-        shelve_filename - The shelve filename in which to keep geocoding cached results.              
+        filename        - The file in which to keep geocoding cached results - an SQLite database if it ends
+                          with .sqlite (see SqliteGeocodingStore), a shelve otherwise (see ShelveGeocodingStore).
+                          Can also be a store object.
+
+        Optional:
+        geocoder        - An object with a geocode(address) method (default is google's geocoder)
+        n_threads       - Number of threads to geocode with at once (in GeocodeMany)
+        rate            - Maximal number of geocoding requests per second
+        failure_ttl     - Number of seconds until a failed address is tried again
+        memory_size     - Number of results to keep in memory
         
         """
         
-        self.shelve_filename = shelve_filename
-        self.shelve_obj = shelve.open(self.shelve_filename)        
-        self.geocoder = geopy.geocoders.Google(resource="maps", output_format="kml")
-    
+        if isinstance(filename, str):
+            self.filename = filename
+            if filename.endswith('.sqlite'):
+                self.store = SqliteGeocodingStore(filename)
+            else:
+                self.store = ShelveGeocodingStore(filename)
+        else:
+            self.filename = None
+            self.store = filename
+        if geocoder == None:
+            geocoder = geopy.geocoders.Google(resource="maps", output_format="kml")
+        self.geocoder = geocoder
+
+        self.n_threads = n_threads
+        self.failure_ttl = failure_ttl
+        self.memory_size = memory_size
+
+        self.memory = collections.OrderedDict()        # normalized address -> result, least recently used first
+
+        self._min_interval = 1.0 / rate
+        self._next_request_time = 0
+        self._rate_lock = threading.Lock()
+
+        self.n_geocoded = 0
+
+    def _Remember(self, key, result):
+        if self.memory.has_key(key):
+            del self.memory[key]
+        self.memory[key] = result
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def _Lookup(self, address):
+        """
+        Return the cached result of an address, or None if there is none (or it is an expired failure).
+        """
+        key = NormalizeAddress(address)
+
+        if self.memory.has_key(key):
+            result = self.memory.pop(key)
+        else:
+            result = self.store.Get(key)
+            if result == None and address != key:
+                # (cached before addresses were normalized)
+                result = self.store.Get(address)
+            if result == None:
+                return None
+
+        self._Remember(key, result)
+
+        if result[:2] == self.FAILED:
+            # failures are kept as (-1, -1, time of failure) - and (-1, -1) from before there was a ttl
+            if len(result) < 3 or result[2] + self.failure_ttl < time.time():
+                return None
+            return self.FAILED
+
+        return result
+
+    def _Store(self, addresses_and_results):
+        items = []
+        for address, result in addresses_and_results:
+            if result == self.FAILED:
+                result = self.FAILED + (time.time(),)
+            items.append((NormalizeAddress(address), result))
+        self.store.PutMany(items)
+        for key, result in items:
+            self._Remember(key, result)
+
+    def _Wait(self):
+        """
+        Wait for our turn to send a request (keeps the rate).
+        """
+        with self._rate_lock:
+            now = time.time()
+            wait = self._next_request_time - now
+            self._next_request_time = max(now, self._next_request_time) + self._min_interval
+        if wait > 0:
+            time.sleep(wait)
+
+    def _Geocode(self, address):
+        self._Wait()
+        try:
+            return self.geocoder.geocode(address)
+        except:
+            return self.FAILED
+
     def __getitem__(self, key):
-        if not self.shelve_obj.has_key(key):
-            try:
-                self.shelve_obj[key] = self.geocoder.geocode(key)
-            except:
-                self.shelve_obj[key] = (-1, -1)
-        return self.shelve_obj[key]
+        result = self._Lookup(key)
+        if result == None:
+            result = self._Geocode(key)
+            self.n_geocoded += 1
+            self._Store([(key, result)])
+        return result
+
+    def GeocodeMany(self, addresses):
+        """
+        Geocode several addresses; return a list of the results (in the same order).
+
+        The missing addresses (each normalized address once) are geocoded by several threads at once.
+        """
+        results = {}
+        missing = {}                # normalized address -> address to geocode
+        for address in addresses:
+            key = NormalizeAddress(address)
+            if results.has_key(key) or missing.has_key(key):
+                continue
+            result = self._Lookup(address)
+            if result == None:
+                missing[key] = address
+            else:
+                results[key] = result
+
+        # (the store is only used from this thread)
+        queue = Queue.Queue()
+        for address in missing.values():
+            queue.put(address)
+        geocoded = []
+
+        def work():
+            while True:
+                try:
+                    address = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                geocoded.append((address, self._Geocode(address)))
+
+        threads = [threading.Thread(target=work) for n in xrange(min(self.n_threads, len(missing)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.n_geocoded += len(geocoded)
+        self._Store(geocoded)
+        for address, result in geocoded:
+            results[NormalizeAddress(address)] = result
+
+        return [results[NormalizeAddress(address)] for address in addresses]
             
     def __del__(self):
-        self.shelve_obj.close()
+        self.store.Close()
+
+
+__all__.append('FakeGeocoder')
+class FakeGeocoder:
+    """
+    (For debugging and testing purposes)
+
+    A local stand-in for a geocoder. Gives every address a made up location in Israel (the same one every time),
+    unless given, with a delay and failures.
+    """
+
+    def __init__(self, locations=None, failing=(), delay=0):
+        """
+        locations   - dict from address to a lat/long (others get made up ones)
+        failing     - addresses for which geocoding fails
+        delay       - number of seconds each call takes
+        """
+        self.locations = locations or {}
+        self.failing = set(failing)
+        self.delay = delay
+
+        self.n_calls = 0
+        self.lock = threading.Lock()
+
+    def geocode(self, address):
+        with self.lock:
+            self.n_calls += 1
+        if self.delay:
+            time.sleep(self.delay)
+        if address in self.failing:
+            raise IOError("Fake geocoding failure: %s" % address)
+
+        if self.locations.has_key(address):
+            return (address, self.locations[address])
+        rnd = random.Random(address)
+        return (address, (29.5 + 3.8 * rnd.random(), 34.3 + 1.5 * rnd.random()))
+
 
         
 
+__all__.append("IdRegistry")
+class IdRegistry:
+    """
+    Gives dense indices to IDs (e.g., place IDs), in the order they are first seen. An ID never changes
+    its index and is never forgotten, so indices stay valid across Sync, and arrays indexed by them can be
+    shared between the data objects and the models.
+
+    ids     - the IDs (by index)
+    index   - the index of each ID
+
+    Use like this:
+
+    >>> R = IdRegistry()
+    >>> R.Intern('766cff27a26d9ba5')
+    0
+    >>> R.Indices(['766cff27a26d9ba5', 'unknown'])
+    array([ 0, -1])
+    """
+
+    def __init__(self, ids=()):
+        self.ids = []
+        self.index = {}
+        self.lock = threading.Lock()        # (data objects sharing the registry can be synced at once)
+        self.InternMany(ids)
+
+    def Intern(self, uid):
+        """
+        Return the index of the ID, giving it a new one if it has none.
+        """
+        if not self.index.has_key(uid):
+            with self.lock:
+                if not self.index.has_key(uid):
+                    self.ids.append(uid)
+                    self.index[uid] = len(self.ids) - 1
+        return self.index[uid]
+
+    def InternMany(self, uids):
+        for uid in uids:
+            self.Intern(uid)
+
+    def Indices(self, uids):
+        """
+        Return an array of the indices of the IDs (-1 for unknown IDs).
+        """
+        return numpy.array([self.index.get(uid, -1) for uid in uids], dtype=int)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, uid):
+        return self.index.has_key(uid)
+
+
+
 class RecommenderData:
     """
     A class containing data for recommendation.
     
     Data is in the 'data' member.
+
+    The data is stored as a columnar table (see storage.Table) in a directory next to the filename
+    (e.g., places_db.store for places_db.pcl), and is only loaded when first accessed. Until then, keys()
+    and [] decode single records from the table. An existing pickle file is migrated to a table once.
+
+    Save appends the changed records (see Touch) to a journal (e.g., places_db.journal), and only writes
+    a new table (a snapshot) once the journal grows as large as the data. Loading replays the journal over
+    the table.
+
+    Changes are only written by Save (or Close); the objects which were not closed are saved when the
+    program exits.
     """
 
-    data = {}
+    version = 0
+
+    _min_journal_entries = 1000         # (the journal is compacted when larger than this and the data)
 
-    def __init__(self, filename, google_key=None, google_email=None):
+    def __init__(self, filename, google_key=None, google_email=None, ids=None):
         """
         filename            - The filename containing the data         
         
         Optional:
         google_key          - A key for the google spreadshete from which the object can be synchronized
         google_email        - The email with which to use google
+        ids                 - An IdRegistry for the keys (can be shared with other data objects); default is a new one
 
         """
         
         self.filename = filename
 
+        if ids == None:
+            ids = IdRegistry()
+        self.ids = ids
+
         self.google_key = google_key
         self.google_email = google_email
 
-        if os.path.exists(self.filename):
-            self.data = cPickle.load(file(self.filename, 'rb'))
+        self.table_path = os.path.splitext(self.filename)[0] + ".store"
+        self.journal_path = os.path.splitext(self.filename)[0] + ".journal"
+        self._table = None
+        self._table_view = None
+
+        # changes which were not saved yet: the changed keys, and whether all the data was reset
+        self._touched = set()
+        self._reset = False
+        self._n_journal_entries = 0
+
+        # objects derived from the data (e.g., indices), by name: (version, object)
+        self._derived = {}
+
+        if storage.IsTable(self.table_path):
+            # (the data is loaded when first accessed)
+            self._table = storage.Table(self.table_path)
+        elif os.path.exists(self.filename):
+            self.data = self._FromPickled(cPickle.load(file(self.filename, 'rb')))
+            self._InternKeys()
+            self.Save()
         else:
             self.Reset()
+
+        _OPEN_DATA.add(self)
+
+    def __getattr__(self, name):
+        if name == 'data' and self.__dict__.get('_table') != None:
+            records = self._table.Records()
+            if self._table_view != None:
+                # (the records which were already given are kept, as they may have been changed)
+                index, journal, decoded = self._table_view
+                for n, record in decoded.iteritems():
+                    records[n] = record
+                entries = journal.items()
+            else:
+                entries = storage.ReadJournal(self.journal_path)
+                self._n_journal_entries = len(entries)
+            self.data = self._FromRecords(self._table.Keys(), records)
+            self._table_view = None
+
+            for key, record in entries:
+                if record == None:
+                    self._RemoveRecord(key)
+                else:
+                    self._SetRecord(key, record)
+
+            self._InternKeys()
+            return self.data
+        raise AttributeError(name)
+
+    def _TableView(self):
+        """
+        Return the index of the keys of the table, the records in the journal (None for removed ones) and the
+        records decoded so far (by number), for getting records before the data is loaded.
+        """
+        if self._table_view == None:
+            entries = storage.ReadJournal(self.journal_path)
+            self._n_journal_entries = len(entries)
+            self._table_view = (self._table.Index(), dict(entries), {})
+        return self._table_view
+
+    def _Record(self, key):
+        """
+        Return the record of a key (as stored by _ToRecords), or None if there is none.
+        """
+        return self.data.get(key)
+
+    def _SetRecord(self, key, record):
+        self.data[key] = record
+
+    def _RemoveRecord(self, key):
+        if self.data.has_key(key):
+            del self.data[key]
+
+    def _NumRecords(self):
+        return len(self.data)
+
+    def Touch(self, keys):
+        """
+        Mark that the records of these keys were added, changed or removed (so Save will write them).
+        """
+        self._touched.update(keys)
+
+    def _InternKeys(self):
+        """
+        Give indices (in self.ids) to all the keys.
+        """
+        self.ids.InternMany(self.data.keys())
+
+    def _ToRecords(self):
+        """
+        Return the data as a list of keys and a list of records (dicts), for storing in a table.
+        """
+        keys = self.data.keys()
+        return keys, [self.data[key] for key in keys]
+
+    def _FromRecords(self, keys, records):
+        """
+        Return the data from the keys and records of _ToRecords.
+        """
+        return dict(zip(keys, records))
+
+    def _FromPickled(self, data):
+        """
+        Return the data from the data of an (old) pickle file.
+        """
+        return data
             
     def _ReturnIfLegal(self, uid, parameter, legal_values):
         if isinstance(parameter, str):
@@ -137,42 +834,266 @@ class RecommenderData:
         else:
             return None
         
-    def Sync(self, password, verbose=False, reset=True, sheet_number=0):
+    def Sync(self, password, verbose=False, reset=True, sheet_number=0, differential=False):
+        """
+        Download the data from the google spreadsheet, update and save.
+
+        Optional:
+        reset           - Throw away all data first
+        differential    - Only update the rows which were added or changed, and remove the rows which were
+                          deleted from the spreadsheet (reset is ignored). Returns a ChangeSet.
+        """
         assert self.google_key != None
-        if reset:
+        if reset and not differential:
             self.Reset()
-        self.google_spreadsheet_acquisitor = GoogleSpreadsheetAcquisitor(self.google_email, password)
-        self.raw_google_results = self.google_spreadsheet_acquisitor.GetSpreadsheet(self.google_key, sheet_number)
-        self.UpdateFromGoogle(self.raw_google_results, verbose=verbose)
+
+        self.google_spreadsheet_acquisitor = SPREADSHEET_SESSIONS.Acquire(self.google_email, password)
+
+        # (the rows are updated page by page, as they download)
+        self.raw_google_results = []
+        def pages():
+            for page in self.google_spreadsheet_acquisitor.IterPages(self.google_key, sheet_number):
+                self.raw_google_results.extend(page)
+                yield page
+
+        try:
+            if differential:
+                changes = self._UpdateChangedPages(pages(), verbose=verbose)
+            else:
+                for page in pages():
+                    self.UpdateFromGoogle(page, verbose=verbose)
+                changes = None
+        finally:
+            SPREADSHEET_SESSIONS.Release(self.google_spreadsheet_acquisitor)
+
         self.Save()
+        return changes
 
 
     def UpdateFromGoogle(self, google_results, verbose=False):            
         raise NotImplementedError()
 
+    def UpdateChangedFromGoogle(self, google_results, verbose=False):
+        """
+        Like UpdateFromGoogle, but only for the rows which are new or differ from the stored raw information
+        (compared by hash); keys which are not in google_results are removed.
+
+        google_results  - all the rows of the spreadsheet (return of GoogleSpreadsheetAcquisitor.GetSpreadsheet)
+
+        Returns a ChangeSet of the keys.
+        """
+        return self._UpdateChangedPages([google_results], verbose)
+
+    def _UpdateChangedPages(self, pages, verbose=False):
+        """
+        UpdateChangedFromGoogle over an iterable of pages (lists of rows) of the spreadsheet.
+        """
+        hashes = self.RowHashes()
+        changes = ChangeSet()
+        seen = set()
+
+        for page in pages:
+            # (the last row of a key wins, as in UpdateFromGoogle)
+            rows = collections.OrderedDict()
+            for row in page:
+                rows[self._RowKey(row)] = row
+
+            update = []
+            for key, row in rows.iteritems():
+                if key in seen:
+                    update.append(row)
+                    continue
+                seen.add(key)
+                if not hashes.has_key(key):
+                    changes.added.append(key)
+                    update.append(row)
+                elif hashes[key] != self._RowHash(row):
+                    changes.changed.append(key)
+                    update.append(row)
+
+            if len(update) > 0:
+                self.UpdateFromGoogle(update, verbose=verbose)
+
+        changes.removed = [key for key in hashes if key not in seen]
+
+        if verbose:
+            print "%d added, %d changed, %d removed" % (len(changes.added), len(changes.changed), len(changes.removed))
+
+        if changes.removed:
+            self._RemoveRecords(changes.removed)
+
+        return changes
+
+    def _RemoveRecords(self, keys):
+        """
+        Remove the records of keys which were deleted from the spreadsheet (they are written to the journal
+        as tombstones).
+        """
+        for key in keys:
+            self._RemoveRecord(key)
+        self.Touch(keys)
+        self.Changed()
+
+    def _RowKey(self, row):
+        """
+        Return the key of the record that a spreadsheet row updates.
+        """
+        return row['id']
+
+    def _Raws(self):
+        """
+        Return a list of (key, raw spreadsheet row) of all records.
+        """
+        return [(key, record.get('raw')) for key, record in self.data.iteritems()]
+
+    def _RowHash(self, row):
+        if row == None:
+            return None
+        return hashlib.md5(repr(sorted(row.items()))).hexdigest()
+
+    def RowHashes(self):
+        """
+        Return a dict from each key to the hash of its raw spreadsheet row (rebuilt after the data changes).
+        """
+        return self.Derived('row_hashes', lambda: dict((key, self._RowHash(raw)) for key, raw in self._Raws()))
+
+    def Changed(self):
+        """
+        Mark that the data has changed (increases the version).
+        """
+        self.version += 1
+        self._InternKeys()
+
+    def Derived(self, name, build):
+        """
+        Return an object derived from the data (e.g., an index), built by calling build(),
+        and kept until the data changes.
+        """
+        if (not self._derived.has_key(name)) or (self._derived[name][0] != self.version):
+            self._derived[name] = (self.version, build())
+        return self._derived[name][1]
+
     def __getitem__(self, key):
-        return self.data[key]
+        if self.__dict__.has_key('data') or self._table == None:
+            return self.data[key]
+
+        index, journal, decoded = self._TableView()
+        if journal.has_key(key):
+            if journal[key] == None:
+                raise KeyError(key)
+            return journal[key]
+
+        n = index[key]
+        if not decoded.has_key(n):
+            decoded[n] = self._table.Record(n)
+        return decoded[n]
 
     def keys(self):
-        return self.data.keys()
+        if self.__dict__.has_key('data') or self._table == None:
+            return self.data.keys()
+
+        index, journal, decoded = self._TableView()
+        return [key for key in index if not journal.has_key(key)] + [key for key, record in journal.iteritems() if record != None]
 
     Keys = keys
             
-    def Save(self):
+    def Save(self, compact=False):
         """
         Save current state
+
+        compact     - write a new table (instead of appending the changes to the journal)
         """
-        cPickle.dump(self.data, file(self.filename, 'wb'), -1)
+        # (if the data was never loaded, it did not change)
+        if not self.__dict__.has_key('data'):
+            return
+
+        n_journal_entries = self._n_journal_entries + len(self._touched)
+        if compact or self._reset or (not storage.IsTable(self.table_path)) or \
+                n_journal_entries > max(self._min_journal_entries, self._NumRecords()):
+            keys, records = self._ToRecords()
+            storage.WriteTable(self.table_path, keys, records)
+            storage.RemoveJournal(self.journal_path)
+            self._n_journal_entries = 0
+        elif len(self._touched) > 0:
+            storage.AppendJournal(self.journal_path, [(key, self._Record(key)) for key in self._touched])
+            self._n_journal_entries = n_journal_entries
+
+        self._touched = set()
+        self._reset = False
         
     def Reset(self):
         """
         Reset all data
         """
         self.data = {}
-                
-    def __del__(self):
+        self._touched = set()
+        self._reset = True
+        self.Changed()
+
+    def Close(self):
+        """
+        Save, and stop saving the object when the program exits.
+        """
         self.Save()
-        
+        _OPEN_DATA.discard(self)
+
+
+# The RecommenderData objects which are saved when the program exits (while the modules are still usable)
+_OPEN_DATA = weakref.WeakSet()
+
+def _SaveOpenData():
+    for recommender_data in list(_OPEN_DATA):
+        try:
+            recommender_data.Save()
+        except Exception, e:
+            warnings.warn("Could not save %s: %s" % (recommender_data.filename, e))
+
+atexit.register(_SaveOpenData)
+
+
+__all__.append("SyncAll")
+def SyncAll(recommender_datas, password, **kwargs):
+    """
+    Sync several RecommenderData objects at once (each in its own thread), and return the list of
+    the results of their Sync (see RecommenderData.Sync for the optional arguments).
+    """
+    results = [None] * len(recommender_datas)
+    errors = []
+
+    def sync(n):
+        try:
+            results[n] = recommender_datas[n].Sync(password, **kwargs)
+        except:
+            errors.append(sys.exc_info())
+
+    threads = [threading.Thread(target=sync, args=(n,)) for n in xrange(len(recommender_datas))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(errors) > 0:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+__all__.append("ChangeSet")
+class ChangeSet:
+    """
+    The keys which were added, changed and removed by an update (see RecommenderData.UpdateChangedFromGoogle).
+    """
+
+    def __init__(self, added=None, changed=None, removed=None):
+        self.added = added or []
+        self.changed = changed or []
+        self.removed = removed or []
+
+    def __len__(self):
+        return len(self.added) + len(self.changed) + len(self.removed)
+
+    def __repr__(self):
+        return "ChangeSet(added=%r, changed=%r, removed=%r)" % (self.added, self.changed, self.removed)
+
 
 __all__.append("PlacesRecommenderData")
 class PlacesRecommenderData(RecommenderData):
@@ -183,9 +1104,10 @@ class PlacesRecommenderData(RecommenderData):
     _legal_expert_ranks = map(str, [1,2,3,4,5])
     _legal_kosher = ['Yes', 'No']
     _legal_visiting_center = ['Yes', 'No']
+    _legal_hours = map(str, range(0, 25))
 
 
-    def __init__(self, filename, geocoding_cache, google_key=None, google_email=None):
+    def __init__(self, filename, geocoding_cache, google_key=None, google_email=None, ids=None):
         """
         filename            - The filename containing the data 
         geocoding_cache     - An instance of GeocodingCache that contains geocoding info
@@ -193,9 +1115,10 @@ class PlacesRecommenderData(RecommenderData):
         Optional:
         google_key          - A key for the google spreadshete from which the object can be synchronized
         google_email        - The email with which to use google
+        ids                 - An IdRegistry for the place IDs (see RecommenderData)
 
         """
-        RecommenderData.__init__(self, filename, google_key, google_email)
+        RecommenderData.__init__(self, filename, google_key, google_email, ids)
         self.geocoding_cache = geocoding_cache
 
    
@@ -205,12 +1128,16 @@ class PlacesRecommenderData(RecommenderData):
         
         google_results  - the results (return of GoogleSpreadsheetAcquisitor.GetSpreadsheet)
         """
+        # geocode all the addresses at once
+        self.geocoding_cache.GeocodeMany([result['address'] for result in google_results if isinstance(result['address'], str)])
+
         for n_result, result in enumerate(google_results):
             if verbose:
                 print "Updating %d / %d - %s " % (n_result+1, len(google_results), result['address'])
             
             # Fill information from the spreadsheet
             uid = result['id']
+            self.Touch([uid])
             if not self.data.has_key(uid):
                 self.data[uid] = {}
             
@@ -255,13 +1182,120 @@ class PlacesRecommenderData(RecommenderData):
             if not self.data[uid].has_key('hours'):
                 self.data[uid]['hours'] = {}                
             for day in ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday']:            
-                val = result[day]
-                if val == None:
-                    self.data[uid]['hours'][day] = None
-                elif val.isdigit():
-                    self.data[uid]['hours'][day] = int(val)
-                else:
-                    self.data[uid]['hours'][day] = None
+                self.data[uid]['hours'][day] = self._ReturnIfLegal(uid, result[day], self._legal_hours)
+                if self.data[uid]['hours'][day] != None:
+                    self.data[uid]['hours'][day] = int(self.data[uid]['hours'][day])
+
+        self.Changed()
+
+    def SpatialIndex(self):
+        """
+        Return a spatial.PlacesSpatialIndex over the places' latlong (rebuilt after the data changes).
+        """
+        return self.Derived('spatial_index', lambda: spatial.PlacesSpatialIndex(self))
+
+    def Columns(self):
+        """
+        Return a PlacesColumns view of the places (rebuilt after the data changes).
+        """
+        return self.Derived('columns', lambda: PlacesColumns(self))
+
+
+__all__.append("PlacesColumns")
+class PlacesColumns:
+    """
+    A columnar view of the filterable attributes of the places, as numpy arrays
+    (by the position of the place in 'placeids').
+
+    size, expert_rank                   - floats, nan where None
+    kosher, visiting_center,
+    visiting_center_free_admission      - 1 / 0 / -1 for True / False / None
+    has_latlong                         - booleans
+    closing_hours                       - (weekday x place) floats, the hour at which the place closes on each
+                                          day (weekdays as in time.localtime: monday is 0), nan where unknown
+    """
+
+    _days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+    def __init__(self, places_recommender_data):
+        """
+        places_recommender_data    - PlacesRecommenderData object with the places
+        """
+        self.placeids = numpy.array(places_recommender_data.keys(), dtype=object)
+        self.index = dict((uid, position) for position, uid in enumerate(self.placeids))
+
+        infos = [places_recommender_data[uid] for uid in self.placeids]
+
+        self.size = numpy.array([info['size'] for info in infos], dtype=float)
+        self.expert_rank = numpy.array([info['expert_rank'] for info in infos], dtype=float)
+        self.kosher = self._Tristate([info['kosher'] for info in infos])
+        self.visiting_center = self._Tristate([info['visiting_center'] for info in infos])
+        self.visiting_center_free_admission = self._Tristate([info['visiting_center_free_admission'] for info in infos])
+        self.has_latlong = numpy.array([info['latlong'] != None for info in infos], dtype=bool)
+
+        self.closing_hours = numpy.array([[info.get('hours', {}).get(day) for info in infos] for day in self._days], dtype=float).reshape((len(self._days), len(infos)))
+
+        # (hours which are not an hour of the day, e.g. from data saved before they were checked, are unknown)
+        with numpy.errstate(invalid='ignore'):
+            illegal = (self.closing_hours < 0) | (self.closing_hours > 24)
+        for day, position in zip(*numpy.nonzero(illegal)):
+            warnings.warn("ID %s: illegal value %s" % (self.placeids[position], self.closing_hours[day, position]))
+        self.closing_hours[illegal] = numpy.nan
+
+    def _Tristate(self, values):
+        return numpy.array([{True: 1, False: 0}.get(value, -1) for value in values], dtype=numpy.int8)
+
+    def __len__(self):
+        return len(self.placeids)
+
+    def Positions(self, placeids):
+        """
+        Return the positions of the given place IDs (ignoring unknown IDs).
+        """
+        return numpy.array([self.index[uid] for uid in placeids if self.index.has_key(uid)], dtype=int)
+
+    def _LocalDayAndSeconds(self, t):
+        """
+        Return the weekday and the seconds since (local) midnight of a time given in seconds since epoch.
+        """
+        local_time = time.localtime(t)
+        return local_time.tm_wday, local_time.tm_hour * 60 * 60 + local_time.tm_min * 60 + local_time.tm_sec
+
+    def _OpenUntil(self, weekday, seconds):
+        """
+        Return a boolean array of the places which are still open 'seconds' after midnight of the given weekday.
+        Places with unknown hours are considered open.
+        """
+        with numpy.errstate(invalid='ignore'):
+            return ~(self.closing_hours[weekday] * 60 * 60 < seconds)
+
+    def OpenAt(self, t, seconds_before_close=0):
+        """
+        Return a boolean array of the places which are open at time t (in seconds since epoch), and close
+        at least seconds_before_close after it.
+        """
+        weekday, seconds = self._LocalDayAndSeconds(t)
+        return self._OpenUntil(weekday, seconds + seconds_before_close)
+
+    def OpenDuring(self, start_time, end_time):
+        """
+        Return a boolean array of the places which are open during the whole window [start_time, end_time]
+        (in seconds since epoch), i.e., do not close before the window ends on any of the days it spans.
+        """
+        mask = numpy.ones(len(self), dtype=bool)
+
+        # go over the days of the window (after a week, the days repeat)
+        t = start_time
+        for n_day in xrange(len(self._days) + 1):
+            weekday, seconds = self._LocalDayAndSeconds(t)
+            seconds_to_midnight = 24 * 60 * 60 - seconds
+            if end_time - t < seconds_to_midnight:
+                mask &= self._OpenUntil(weekday, seconds + (end_time - t))
+                break
+            mask &= self._OpenUntil(weekday, 24 * 60 * 60)
+            t += seconds_to_midnight
+
+        return mask
 
 
 
@@ -283,6 +1317,7 @@ class UsersRecommenderData(RecommenderData):
 
             # Fill information from the spreadsheet
             uid = result['id']
+            self.Touch([uid])
             if not self.data.has_key(uid):
                 self.data[uid] = {}
             
@@ -303,19 +1338,534 @@ class UsersRecommenderData(RecommenderData):
             # zip
             self.data[uid]['zip'] = result['zip']
 
+        self.Changed()
+
+
+__all__.append("RatingStore")
+class RatingStore:
+    """
+    Ratings over interned user/place ids, in compressed sparse arrays which share one array of values.
+
+    userids, user_index         - the user IDs (by index), and the index of each user ID
+    placeids, place_index       - the same, for places
+    user_indptr, user_places    - CSR: the places rated by user u are user_places[user_indptr[u]:user_indptr[u+1]] (sorted),
+                                  and their ratings are values[user_indptr[u]:user_indptr[u+1]]
+    place_indptr, place_users,
+    place_slots                 - CSC: the users who rated place p are place_users[place_indptr[p]:place_indptr[p+1]] (sorted),
+                                  and their ratings are values[place_slots[place_indptr[p]:place_indptr[p+1]]]
+    values                      - the ratings (nan for None)
+    raws                        - the raw information of each rating (by its position in values)
+
+    Updating an existing rating is done in place; added and removed ratings are merged into the arrays when
+    they are next used (see Compact).
+
+    Use like this:
+
+    >>> S = RatingStore()
+    >>> S.Set('u1', 'p1', 4)
+    >>> S.Get('u1', 'p1')
+    4
+    >>> S.ByUser()['u1']['p1']['rating']
+    4
+    """
+
+    def __init__(self, triples=(), user_ids=None, place_ids=None):
+        """
+        triples     - (userid, placeid, rating, raw) to start with
+        user_ids    - IdRegistry for the user IDs (can be shared); default is a new one
+        place_ids   - IdRegistry for the place IDs (can be shared); default is a new one
+        """
+        self.user_ids = user_ids if user_ids is not None else IdRegistry()
+        self.place_ids = place_ids if place_ids is not None else IdRegistry()
+
+        # (the registries may have more IDs than the arrays, until the next Compact)
+        self.userids = self.user_ids.ids
+        self.user_index = self.user_ids.index
+        self.placeids = self.place_ids.ids
+        self.place_index = self.place_ids.index
+
+        self.user_indptr = numpy.zeros(1, dtype=numpy.int64)
+        self.user_places = numpy.zeros(0, dtype=numpy.int32)
+        self.place_indptr = numpy.zeros(1, dtype=numpy.int64)
+        self.place_users = numpy.zeros(0, dtype=numpy.int32)
+        self.place_slots = numpy.zeros(0, dtype=numpy.int32)
+        self.values = numpy.zeros(0, dtype=numpy.float32)
+        self.raws = []
+
+        # changes which were not merged into the arrays yet
+        self.added = {}             # (user index, place index) -> (rating, raw)
+        self.removed = set()        # slots
+
+        # (increases whenever ratings are added or removed, i.e. when the rows may change)
+        self.version = 0
+
+        for userid, placeid, rating, raw in triples:
+            self.added[(self.user_ids.Intern(userid), self.place_ids.Intern(placeid))] = (rating, raw)
+        self.Compact()
+
+    def _Value(self, value):
+        # (ratings are usually integers)
+        if value != value:
+            return None
+        if value == int(value):
+            return int(value)
+        return float(value)
+
+    def _Slot(self, u, p):
+        """
+        Return the position of the rating of user index u for place index p in the arrays, or -1.
+        """
+        if u >= len(self.user_indptr) - 1:
+            return -1
+        start, end = self.user_indptr[u], self.user_indptr[u + 1]
+        n = start + numpy.searchsorted(self.user_places[start:end], p)
+        if n < end and self.user_places[n] == p and n not in self.removed:
+            return n
+        return -1
+
+    def Compact(self):
+        """
+        Merge the added and removed ratings into the arrays.
+        """
+        if len(self.added) == 0 and len(self.removed) == 0:
+            return
+
+        n_users = len(self.userids)
+        n_places = len(self.placeids)
+
+        rows = numpy.repeat(numpy.arange(len(self.user_indptr) - 1, dtype=numpy.int32), numpy.diff(self.user_indptr))
+        keep = numpy.ones(len(self.values), dtype=bool)
+        keep[list(self.removed)] = False
+        keep &= numpy.array([not self.added.has_key((u, p)) for u, p in zip(rows.tolist(), self.user_places.tolist())], dtype=bool)
+
+        added = sorted(self.added.items())
+        rows = numpy.concatenate([rows[keep], numpy.array([u for (u, p), v in added], dtype=numpy.int32)])
+        cols = numpy.concatenate([self.user_places[keep], numpy.array([p for (u, p), v in added], dtype=numpy.int32)])
+        values = numpy.concatenate([self.values[keep], numpy.array([(numpy.nan if rating == None else rating) for (u, p), (rating, raw) in added], dtype=numpy.float32)])
+        raws = [raw for raw, k in zip(self.raws, keep) if k] + [raw for (u, p), (rating, raw) in added]
+
+        # CSR
+        order = numpy.lexsort((cols, rows))
+        self.user_places = cols[order]
+        self.values = values[order]
+        self.raws = [raws[n] for n in order]
+        self.user_indptr = numpy.zeros(n_users + 1, dtype=numpy.int64)
+        self.user_indptr[1:] = numpy.cumsum(numpy.bincount(rows, minlength=n_users))
+        rows = rows[order]
+
+        # CSC
+        self.place_slots = numpy.lexsort((rows, self.user_places)).astype(numpy.int32)
+        self.place_users = rows[self.place_slots]
+        self.place_indptr = numpy.zeros(n_places + 1, dtype=numpy.int64)
+        self.place_indptr[1:] = numpy.cumsum(numpy.bincount(self.user_places, minlength=n_places))
+
+        self.added = {}
+        self.removed = set()
+        self.version += 1
+
+    def __len__(self):
+        self.Compact()
+        return len(self.values)
+
+    def Get(self, userid, placeid, default=None):
+        """
+        Return the rating of a user for a place (default if there is none).
+        """
+        u = self.user_index.get(userid, -1)
+        p = self.place_index.get(placeid, -1)
+        if self.added.has_key((u, p)):
+            return self.added[(u, p)][0]
+        n = self._Slot(u, p)
+        if n == -1:
+            return default
+        return self._Value(self.values[n])
+
+    def Has(self, userid, placeid):
+        u = self.user_index.get(userid, -1)
+        p = self.place_index.get(placeid, -1)
+        return self.added.has_key((u, p)) or self._Slot(u, p) != -1
+
+    def Set(self, userid, placeid, rating, raw=None):
+        """
+        Add or update a rating. Returns the previous rating (or None).
+        """
+        u = self.user_ids.Intern(userid)
+        p = self.place_ids.Intern(placeid)
+
+        if self.added.has_key((u, p)):
+            old_rating = self.added[(u, p)][0]
+            self.added[(u, p)] = (rating, raw)
+            return old_rating
+
+        n = self._Slot(u, p)
+        if n == -1:
+            self.added[(u, p)] = (rating, raw)
+            self.version += 1
+            return None
+
+        old_rating = self._Value(self.values[n])
+        self.values[n] = (numpy.nan if rating == None else rating)
+        self.raws[n] = raw
+        return old_rating
+
+    def Remove(self, userid, placeid):
+        """
+        Remove a rating. Returns the removed rating; raises KeyError if there is none.
+        """
+        u = self.user_index.get(userid, -1)
+        p = self.place_index.get(placeid, -1)
+
+        if self.added.has_key((u, p)):
+            self.version += 1
+            return self.added.pop((u, p))[0]
+
+        n = self._Slot(u, p)
+        if n == -1:
+            raise KeyError((userid, placeid))
+        self.removed.add(n)
+        self.version += 1
+        return self._Value(self.values[n])
+
+    def Triples(self):
+        """
+        Return a list of (userid, placeid, rating, raw) of all the ratings.
+        """
+        self.Compact()
+        rows = numpy.repeat(numpy.arange(len(self.user_indptr) - 1), numpy.diff(self.user_indptr))
+        return [(self.userids[u], self.placeids[p], self._Value(v), raw) for u, p, v, raw in zip(rows.tolist(), self.user_places.tolist(), self.values.tolist(), self.raws)]
+
+    def Row(self, by_user, index):
+        """
+        Return (indices of the other ids, slots in values) of the ratings of a user (or a place, if not by_user) index.
+        """
+        self.Compact()
+        if by_user:
+            start, end = self.user_indptr[index], self.user_indptr[index + 1]
+            return self.user_places[start:end], numpy.arange(start, end)
+        start, end = self.place_indptr[index], self.place_indptr[index + 1]
+        return self.place_users[start:end], self.place_slots[start:end]
+
+    def ByUser(self):
+        """
+        Return a read-only view of the ratings like {userid: {placeid: {'rating': ..., 'raw': ...}}}.
+        """
+        return _RatingsView(self, True)
+
+    def ByPlace(self):
+        """
+        Return a read-only view of the ratings like {placeid: {userid: {'rating': ..., 'raw': ...}}}.
+        """
+        return _RatingsView(self, False)
+
+
+class _RatingsView:
+    """
+    A read-only mapping from user (or place) IDs to their ratings (see RatingStore.ByUser/ByPlace).
+    Only IDs with ratings are included.
+    """
+
+    def __init__(self, store, by_user):
+        self.store = store
+        self.by_user = by_user
+
+    def _Ids(self):
+        if self.by_user:
+            return self.store.userids, self.store.user_index, self.store.user_indptr
+        return self.store.placeids, self.store.place_index, self.store.place_indptr
+
+    def keys(self):
+        self.store.Compact()
+        ids, index, indptr = self._Ids()
+        return [ids[n] for n in numpy.flatnonzero(numpy.diff(indptr)).tolist()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def has_key(self, uid):
+        self.store.Compact()
+        ids, index, indptr = self._Ids()
+        n = index.get(uid, -1)
+        return n != -1 and n < len(indptr) - 1 and indptr[n + 1] > indptr[n]
+
+    __contains__ = has_key
+
+    def __getitem__(self, uid):
+        if not self.has_key(uid):
+            raise KeyError(uid)
+        return _RatingsRow(self.store, self.by_user, self._Ids()[1][uid])
+
+    def get(self, uid, default=None):
+        if not self.has_key(uid):
+            return default
+        return self[uid]
+
+    def iteritems(self):
+        for uid in self.keys():
+            yield uid, self[uid]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for uid, row in self.iteritems():
+            yield row
+
+    def values(self):
+        return list(self.itervalues())
+
+    def __len__(self):
+        self.store.Compact()
+        return int(numpy.count_nonzero(numpy.diff(self._Ids()[2])))
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
+class _RatingsRow:
+    """
+    A read-only mapping from the place (or user) IDs rated by one user (or place) to {'rating': ..., 'raw': ...}.
+    It follows the changes of the store.
+    """
+
+    def __init__(self, store, by_user, index):
+        self.store = store
+        self.by_user = by_user
+        self.index = index
+        self.version = None
+        self.other_ids = (store.placeids if by_user else store.userids)
+        self.other_index = (store.place_index if by_user else store.user_index)
+
+    def _Row(self):
+        """
+        Return the (indices, slots) of the row (see RatingStore.Row), again if the store changed since.
+        """
+        if self.version != self.store.version:
+            self.indices, self.slots = self.store.Row(self.by_user, self.index)
+            # (after Row, which may compact the store)
+            self.version = self.store.version
+        return self.indices, self.slots
+
+    def _Position(self, uid):
+        indices, slots = self._Row()
+        n = self.other_index.get(uid, -1)
+        position = numpy.searchsorted(indices, n)
+        if n == -1 or position == len(indices) or indices[position] != n:
+            return -1
+        return position
+
+    def _Info(self, slot):
+        return {'rating': self.store._Value(self.store.values[slot]), 'raw': self.store.raws[slot]}
+
+    def keys(self):
+        return [self.other_ids[n] for n in self._Row()[0].tolist()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    iterkeys = __iter__
+
+    def has_key(self, uid):
+        return self._Position(uid) != -1
+
+    __contains__ = has_key
+
+    def __getitem__(self, uid):
+        position = self._Position(uid)
+        if position == -1:
+            raise KeyError(uid)
+        return self._Info(self._Row()[1][position])
+
+    def get(self, uid, default=None):
+        position = self._Position(uid)
+        if position == -1:
+            return default
+        return self._Info(self._Row()[1][position])
+
+    def iteritems(self):
+        indices, slots = self._Row()
+        for n, slot in zip(indices.tolist(), slots.tolist()):
+            yield self.other_ids[n], self._Info(slot)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for uid, info in self.iteritems():
+            yield info
+
+    def values(self):
+        return list(self.itervalues())
+
+    def __len__(self):
+        return len(self._Row()[0])
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+
 
 __all__.append("RatingRecommenderData")
 class RatingRecommenderData(RecommenderData):
 
     _legal_rating = map(str, [1,2,3,4,5])
 
+    def __init__(self, filename, google_key=None, google_email=None, user_ids=None, place_ids=None):
+        """
+        filename            - The filename containing the data         
+        
+        Optional:
+        google_key          - A key for the google spreadshete from which the object can be synchronized
+        google_email        - The email with which to use google
+        user_ids            - An IdRegistry for the user IDs (e.g., the 'ids' of the users data); default is a new one
+        place_ids           - An IdRegistry for the place IDs (e.g., the 'ids' of the places data); default is a new one
+
+        """
+        self.user_ids = user_ids if user_ids is not None else IdRegistry()
+        self.place_ids = place_ids if place_ids is not None else IdRegistry()
+
+        RecommenderData.__init__(self, filename, google_key, google_email)
+        self.listeners = []
+
     def Reset(self):
         """
         Reset all data
         """
-        RecommenderData.Reset(self)
-        self.data['by_user'] = {}
-        self.data['by_place'] = {}
+        self._SetStore(RatingStore(user_ids=self.user_ids, place_ids=self.place_ids))
+        self._touched = set()
+        self._reset = True
+        self.Changed()
+
+    def _InternKeys(self):
+        # (the store gives indices to the user and place IDs)
+        pass
+
+    def __getitem__(self, key):
+        # (the data is by_user/by_place views of the store, which are built from all the records)
+        return self.data[key]
+
+    def keys(self):
+        return self.data.keys()
+
+    Keys = keys
+
+    def _SetStore(self, store):
+        # (data is kept as read-only views of the store)
+        self.store = store
+        self.data = {'by_user': store.ByUser(), 'by_place': store.ByPlace()}
+
+    def Ratings(self):
+        """
+        Return the RatingStore with the ratings (for direct use of its arrays).
+        """
+        self.data
+        return self.store
+
+    def _ToRecords(self):
+        triples = self.Ratings().Triples()
+        return [(userid, placeid) for userid, placeid, rating, raw in triples], [{'rating': rating, 'raw': raw} for userid, placeid, rating, raw in triples]
+
+    def _Record(self, key):
+        userid, placeid = key
+        return self.data['by_user'].get(userid, {}).get(placeid)
+
+    def _SetRecord(self, key, record):
+        userid, placeid = key
+        self.store.Set(userid, placeid, record['rating'], record['raw'])
+
+    def _RemoveRecord(self, key):
+        userid, placeid = key
+        if self.store.Has(userid, placeid):
+            self.store.Remove(userid, placeid)
+
+    def _NumRecords(self):
+        return len(self.store)
+
+    def _RowKey(self, row):
+        return (row['userid'], row['placeid'])
+
+    def _Raws(self):
+        return [((userid, placeid), raw) for userid, placeid, rating, raw in self.Ratings().Triples()]
+
+    def _FromPickled(self, data):
+        self._SetStore(RatingStore([(userid, placeid, v['rating'], v['raw']) for userid, rated_places in data['by_user'].iteritems() for placeid, v in rated_places.iteritems()],
+                                   self.user_ids, self.place_ids))
+        return self.data
+
+    def _FromRecords(self, keys, records):
+        self._SetStore(RatingStore([(userid, placeid, record.get('rating'), record.get('raw')) for (userid, placeid), record in zip(keys, records)],
+                                   self.user_ids, self.place_ids))
+        return self.data
+
+    def _RemoveRecords(self, keys):
+        for userid, placeid in keys:
+            self.RemoveRating(userid, placeid)
+
+    def AddListener(self, listener):
+        """
+        Register an object to be told about single rating changes (see SetRating/RemoveRating).
+        
+        listener    - An object with a RatingChanged(userid, placeid, old_rating, new_rating) method.
+                      old_rating/new_rating are None when the rating did not exist before/after.
+
+        Listeners are told about every change of a single rating (including those of UpdateFromGoogle and
+        differential syncs), right after the version increased by one for it. Other changes (e.g., Reset)
+        only increase the version.
+
+        The listener is held through a weak reference, so it is dropped once it is no longer used elsewhere.
+        """
+        if listener not in self._Listeners():
+            self.listeners.append(weakref.ref(listener))
+
+    def RemoveListener(self, listener):
+        """
+        Stop telling an object about rating changes (see AddListener).
+        """
+        self.listeners = [ref for ref in self.listeners if ref() not in (None, listener)]
+
+    def _Listeners(self):
+        """
+        Return the live listeners (forgetting those which were garbage collected).
+        """
+        live = [(ref, ref()) for ref in self.listeners]
+        self.listeners = [ref for ref, listener in live if listener is not None]
+        return [listener for ref, listener in live if listener is not None]
+
+    def _NotifyListeners(self, userid, placeid, old_rating, new_rating):
+        for listener in self._Listeners():
+            listener.RatingChanged(userid, placeid, old_rating, new_rating)
+
+    def SetRating(self, userid, placeid, rating, raw=None):
+        """
+        Add or update a single rating, and notify the listeners.
+        
+        userid      - The user ID
+        placeid     - The place ID
+        rating      - The rating (an integer, or None if illegal)
+        raw         - The raw information (e.g., a spreadsheet row); can be None
+        """
+        old_rating = self._StoreRating(userid, placeid, rating, raw)
+        self.Changed()
+
+        self._NotifyListeners(userid, placeid, old_rating, rating)
+
+    def _StoreRating(self, userid, placeid, rating, raw):
+        """
+        Add or update a single rating, without notifying anyone. Returns the previous rating (or None).
+        """
+        self.Touch([(userid, placeid)])
+        return self.Ratings().Set(userid, placeid, rating, raw)
+
+    def RemoveRating(self, userid, placeid):
+        """
+        Remove a single rating, and notify the listeners.
+        """
+        old_rating = self.Ratings().Remove(userid, placeid)
+        self.Touch([(userid, placeid)])
+        self.Changed()
+
+        self._NotifyListeners(userid, placeid, old_rating, None)
 
     def UpdateFromGoogle(self, google_results, verbose=False):
         """
@@ -333,27 +1883,13 @@ class RatingRecommenderData(RecommenderData):
             userid = result['userid']
             rating = result['rating']
             
-            if not self.data['by_user'].has_key(userid):
-                self.data['by_user'][userid] = {}
-            if not self.data['by_user'][userid].has_key(placeid):
-                self.data['by_user'][userid][placeid] = {}
-
-            if not self.data['by_place'].has_key(placeid):
-                self.data['by_place'][placeid] = {}
-            if not self.data['by_place'][placeid].has_key(userid):
-                self.data['by_place'][placeid][userid] = {}
-            
-            # Raw information
-            self.data['by_user'][userid][placeid]['raw'] = result   
-            self.data['by_place'][placeid][userid]['raw'] = result   
-            
             # rating
             rating = self._ReturnIfLegal((userid, placeid), rating, self._legal_rating)
             if rating != None:
                 rating = int(rating)
 
-            self.data['by_user'][userid][placeid]['rating'] = rating
-            self.data['by_place'][placeid][userid]['rating'] = rating
+            # (one at a time, so the listeners can follow)
+            self.SetRating(userid, placeid, rating, result)
 
 
             
@@ -9,7 +9,7 @@ import geopy.distance
 import time
 import random
 import csv
-import inspect
+import numpy
 
 
 
@@ -21,7 +21,34 @@ import inspect
 
 class IntegratorFilter(object):
     """An integration filter abstract class"""
-    pass
+
+    def Filter(self, info):
+        raise NotImplementedError()
+
+    def Mask(self, columns):
+        """
+        Gets a data_processing.PlacesColumns view of all the places.
+
+        Return a boolean array of the places which pass the predicates that can be checked on the columns.
+        """
+        return numpy.ones(len(columns), dtype=bool)
+
+    def FilterRemaining(self, info):
+        """
+        Gets an information for an item which passed Mask.
+
+        Return whether it should be filtered or not, according to the rest of the cheap predicates.
+        """
+        return self.Filter(info)
+
+    def FilterExpensive(self, infos):
+        """
+        Gets a list of informations for items which passed Mask and FilterRemaining (best ranked first).
+
+        Return a list of whether each should be filtered or not, according to the expensive predicates
+        (e.g., ones which need remote calls). These are only checked for as many items as needed.
+        """
+        return [True] * len(infos)
 
        
 
@@ -46,16 +73,20 @@ class BasicIntegratorFilter(IntegratorFilter):
                   visiting_center = None,
                   visiting_center_free_admission = None,
                   visit_time = None,
+                  visit_end_time = None,
                   use_weather = False,
                   use_only_ids = None,
                   weather_client = None):
-        #
-        # Copy all arguments to members
-        #
-        args, dummy, dummy, values = inspect.getargvalues(inspect.currentframe())
-        for arg in args:
-            if arg != "self":
-                setattr(self, arg, values[arg])
+        self.size = size
+        self.expert_rank = expert_rank
+        self.kosher = kosher
+        self.visiting_center = visiting_center
+        self.visiting_center_free_admission = visiting_center_free_admission
+        self.visit_time = visit_time
+        self.visit_end_time = visit_end_time
+        self.use_weather = use_weather
+        self.use_only_ids = use_only_ids
+        self.weather_client = weather_client
 
 
 
@@ -89,7 +120,7 @@ class BasicIntegratorFilter(IntegratorFilter):
             
         if add_item and (self.visiting_center_free_admission != None) and (self.visiting_center_free_admission == True and info['visiting_center_free_admission'] == False):
             add_item = False
-            
+
         if add_item and self.visit_time != None:
             day_of_visit = time.strftime("%A", time.localtime(self.visit_time)).lower()
             if info['hours'][day_of_visit] != None:
@@ -98,12 +129,79 @@ class BasicIntegratorFilter(IntegratorFilter):
                     add_item = False
             if day_of_visit == 'saturday' and self.kosher == True:
                 add_item = False
-                    
-        if add_item and self.use_weather:                
-            if not self.weather_client.GoodForWinery(self.weather_client.GetCondition(info['latlong'])):
-                add_item = False
-            
+
+        if add_item and not self.FilterRemaining(info):
+            add_item = False
+
+        if add_item and not self.FilterExpensive([info])[0]:
+            add_item = False
+
         return add_item
+
+    def Mask(self, columns):
+        """
+        Gets a data_processing.PlacesColumns view of all the places.
+
+        Return a boolean array of the places which pass all the predicates, except for the weather.
+        """
+
+        mask = columns.has_latlong.copy()
+
+        if self.use_only_ids != None:
+            only_ids = numpy.zeros(len(columns), dtype=bool)
+            only_ids[columns.Positions(self.use_only_ids)] = True
+            mask &= only_ids
+
+        # (places without a size/expert rank are filtered out)
+        with numpy.errstate(invalid='ignore'):
+            if self.size != None:
+                mask &= (columns.size >= self.size)
+
+            if self.expert_rank != None:
+                mask &= (columns.expert_rank >= self.expert_rank)
+
+        if self.kosher == True:
+            mask &= (columns.kosher != 0)
+
+        if self.visiting_center == True:
+            mask &= (columns.visiting_center != 0)
+
+        if self.visiting_center_free_admission == True:
+            mask &= (columns.visiting_center_free_admission != 0)
+
+        # (the visit should start at least _delta_time_before_close before closing, and the place should
+        # stay open until its end, if given)
+        if self.visit_time != None:
+            mask &= columns.OpenAt(self.visit_time, self._delta_time_before_close)
+            if self.visit_end_time != None:
+                mask &= columns.OpenDuring(self.visit_time, self.visit_end_time)
+            if time.localtime(self.visit_time).tm_wday == 5 and self.kosher == True:
+                mask[:] = False
+
+        return mask
+
+    def FilterRemaining(self, info):
+        """
+        Gets an information for an item which passed Mask.
+
+        Return whether it should be filtered or not (all the cheap predicates are in Mask).
+        """
+        return True
+
+    def FilterExpensive(self, infos):
+        """
+        Gets a list of informations for items which passed Mask and FilterRemaining.
+
+        Return a list of whether each should be filtered or not, according to the weather.
+        """
+
+        add_items = [True] * len(infos)
+
+        if self.use_weather and len(infos) > 0:
+            conditions = self.weather_client.GetConditions([info['latlong'] for info in infos])
+            add_items = [self.weather_client.GoodForWinery(condition) for condition in conditions]
+
+        return add_items
                 
 
 
@@ -119,10 +217,21 @@ class BasicIntegratorFilter(IntegratorFilter):
 
 
 class IntegratorSorter(object):
-    """An integration score abstract class"""
+    """
+    An integration score abstract class.
+
+    Score gets either single values or arrays of distances and ratings (of the same length).
+    """
 
     def Score(self, distance, rating, required_radius):
         raise NotImplementedError()
+
+    def ScoreBound(self, distance, max_rating, required_radius):
+        """
+        Return an upper bound on the score of places at the given distance(s), for any rating up to max_rating,
+        which does not increase with the distance; or None if there is no such bound.
+        """
+        return None
         
 
 
@@ -146,15 +255,16 @@ class StupidIntegratorSorter(IntegratorSorter):
     _max_rating = 5
 
     def Score(self, distance, rating, required_radius=None):
-        if distance > self._max_distance:
-            normalized_distance = 0
-        else:
-            normalized_distance = float(self._max_distance - distance) / self._max_distance
+        normalized_distance = numpy.maximum(0, (self._max_distance - numpy.asarray(distance, dtype=float)) / self._max_distance)
 
-        normalized_expert_rank = float(rating - self._min_rating)/(self._max_rating - self._min_rating)        
+        normalized_expert_rank = (numpy.asarray(rating, dtype=float) - self._min_rating)/(self._max_rating - self._min_rating)        
         res = normalized_distance * self._weights[0] + normalized_expert_rank * self._weights[1]    
         return res
 
+    def ScoreBound(self, distance, max_rating, required_radius=None):
+        # (the score does not increase with the distance, and increases with the rating)
+        return self.Score(distance, max_rating, required_radius)
+
 
 __all__.append("LinearIntegratorSorter")
 class LinearIntegratorSorter(IntegratorSorter):
@@ -171,6 +281,10 @@ class LinearIntegratorSorter(IntegratorSorter):
         res = rating + self._beta * distance * 1000
         return res
 
+    def ScoreBound(self, distance, max_rating, required_radius=None):
+        # (the score does not increase with the distance, and increases with the rating)
+        return self.Score(distance, max_rating, required_radius)
+
 
 
 
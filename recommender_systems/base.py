@@ -4,6 +4,143 @@
 __all__ = []
 __author__ = "Regev S"
 
+# python imports
+import threading
+import weakref
+import numpy
+import scipy.sparse
+
+
+__all__.append("ModelCache")
+class ModelCache(object):
+	"""
+	Objects built over the data (recommender systems, statistics), by (class, parameters, data versions), so
+	identical ones are built once and shared. Shared objects should be used read-only.
+
+	Only data with a 'version' (e.g., RecommenderData) is cached by; objects over other data are always built.
+	Objects over an older version of the data are dropped.
+
+	The objects are only kept while they are used (e.g., by a recommender), and the data is referred to weakly,
+	so the cache keeps neither alive.
+
+	>>> C = ModelCache()
+	>>> C.Get(PearsonRecommenderSystem, RD_places, RD_users, RD_rating) is C.Get(PearsonRecommenderSystem, RD_places, RD_users, RD_rating)
+	True
+	"""
+
+	def __init__(self):
+		self.objects = weakref.WeakValueDictionary()	# key -> object
+		self.lock = threading.RLock()	# (objects are built under the lock, and can use the cache themselves)
+
+		self.hits = 0
+		self.misses = 0
+
+	def _Key(self, value, datas):
+		"""
+		Return a hashable key of a parameter, adding (weak references to) the data objects in it to datas (or None if it
+		cannot be cached by).
+		"""
+		if hasattr(value, 'version'):
+			try:
+				data = weakref.ref(value)
+			except TypeError:
+				return None
+			datas.append(data)
+			return ('data', data, value.version)
+		if isinstance(value, (list, tuple)):
+			keys = [self._Key(v, datas) for v in value]
+			if None in keys:
+				return None
+			return ('list', tuple(keys))
+		if isinstance(value, (basestring, int, long, float, bool, type(None))):
+			return ('value', value)
+		return None
+
+	def Get(self, cls, *args, **kwargs):
+		"""
+		Return cls(*args, **kwargs), built once for the same parameters and data versions.
+		"""
+		datas = []
+		key = self._Key([cls.__module__, cls.__name__, list(args), sorted(kwargs.items())], datas)
+		if key == None or len(datas) == 0:
+			return cls(*args, **kwargs)
+
+		with self.lock:
+			obj = self.objects.get(key)
+			if obj is not None:
+				self.hits += 1
+				return obj
+
+			self.misses += 1
+			for old_key in self.objects.keys():
+				if not self._IsCurrent(old_key):
+					self.objects.pop(old_key, None)
+
+			obj = cls(*args, **kwargs)
+			self.objects[key] = obj
+			return obj
+
+	def _IsCurrent(self, key):
+		"""
+		Return whether all the data in a key (of _Key) still exists, in the same version.
+		"""
+		if key[0] == 'data':
+			data = key[1]()
+			return data is not None and data.version == key[2]
+		if key[0] == 'list':
+			return all([self._IsCurrent(k) for k in key[1]])
+		return True
+
+	def __len__(self):
+		return len(self.objects)
+
+	def Clear(self):
+		with self.lock:
+			self.objects = weakref.WeakValueDictionary()
+
+
+# The cache used by the recommender systems (and recommenders)
+SHARED_MODELS = ModelCache()
+
+
+__all__.append("RatingStatistics")
+class RatingStatistics(object):
+	"""
+	Statistics of the ratings (illegal ratings are ignored):
+
+	count, total, mean			- of all the ratings (mean is None if there are none)
+	user_sums, user_counts		- by user ID (only users who rated)
+	user_means
+	place_sums, place_counts	- the same by place ID
+	place_means
+	"""
+
+	def __init__(self, rating_recommender_data):
+		self.user_sums = {}
+		self.user_counts = {}
+		self.place_sums = {}
+		self.place_counts = {}
+
+		for userid, rated_places in rating_recommender_data['by_user'].iteritems():
+			for placeid, v in rated_places.iteritems():
+				rating = v['rating']
+				if rating == None:
+					continue
+				self.user_sums[userid] = self.user_sums.get(userid, 0) + rating
+				self.user_counts[userid] = self.user_counts.get(userid, 0) + 1
+				self.place_sums[placeid] = self.place_sums.get(placeid, 0) + rating
+				self.place_counts[placeid] = self.place_counts.get(placeid, 0) + 1
+
+		self.count = sum(self.user_counts.values())
+		self.total = sum(self.user_sums.values())
+		self.mean = None
+		if self.count != 0:
+			self.mean = float(self.total) / self.count
+
+		self.user_means = dict((userid, float(total) / self.user_counts[userid]) for userid, total in self.user_sums.iteritems())
+		self.place_means = dict((placeid, float(total) / self.place_counts[placeid]) for placeid, total in self.place_sums.iteritems())
+
+
 __all__.append("RecommenderSystem")
 class RecommenderSystem(object):
 
@@ -25,27 +162,174 @@ class RecommenderSystem(object):
 	def PreprocessWeights(self):
 		pass
 
+	def RatingStatistics(self):
+		"""
+		Return the RatingStatistics of the ratings (shared by the recommender systems over the same ratings).
+		"""
+		# (kept, so it is shared for as long as this system is used)
+		self._rating_statistics = SHARED_MODELS.Get(RatingStatistics, self.rating_recommender_data)
+		return self._rating_statistics
+
 	def SetDefaultRating(self):
 
-		sum_rating = 0.0
-		n_rating = 0.0
+		statistics = self.RatingStatistics()
+		self._rating_total = statistics.total
+		self._rating_count = statistics.count
 
-		for userid, rated_places in self.rating_recommender_data['by_user'].iteritems():
-			for placeid, v in rated_places.iteritems():
-				sum_rating += v['rating']
-				n_rating += 1
+		average_rating = statistics.mean
 
-		if n_rating != 0:
-			average_rating = float(sum_rating) / n_rating
+		if average_rating != None:
 			self._default_rating = average_rating			
 		else:
 			self._default_rating = 1
 
+	def UpdateDefaultRating(self, old_rating, new_rating):
+		"""
+		Keep the default rating (the average rating) up to date after a single rating was added, changed or removed.
+		"""
+		if old_rating != None:
+			self._rating_total -= old_rating
+			self._rating_count -= 1
+		if new_rating != None:
+			self._rating_total += new_rating
+			self._rating_count += 1
+
+		if self._rating_count != 0:
+			self._default_rating = float(self._rating_total) / self._rating_count
+		else:
+			self._default_rating = 1
+
+	def Detach(self):
+		"""
+		Stop following single rating changes (e.g., when the recommender system is replaced).
+		"""
+		if hasattr(self.rating_recommender_data, 'RemoveListener'):
+			self.rating_recommender_data.RemoveListener(self)
+
+	def BuildIndices(self):
+		"""
+		Give dense indices to the ids: sets self.userids/self.user_index and self.placeids/self.place_index.
+		Users are the ones in the users data, followed by any other user who rated.
+
+		If the data has IdRegistry objects ('ids'), the ids are ordered as in them, and self.user_positions/
+		self.place_positions map registry indices to our indices (-1 where not included).
+		"""
+
+		self.placeids = list(self.places_recommender_data.keys())
+
+		self.userids = list(self.users_recommender_data.keys())
+		known_userids = set(self.userids)
+		self.userids += [userid for userid in self.rating_recommender_data['by_user'].keys() if userid not in known_userids]
+
+		self.place_registry = getattr(self.places_recommender_data, 'ids', None)
+		self.user_registry = getattr(self.users_recommender_data, 'ids', None)
+		self.placeids, self.place_positions = self._RegistryOrder(self.place_registry, self.placeids)
+		self.userids, self.user_positions = self._RegistryOrder(self.user_registry, self.userids)
+
+		self.place_index = dict((placeid, i) for i, placeid in enumerate(self.placeids))
+		self.user_index = dict((userid, u) for u, userid in enumerate(self.userids))
+
+	def _RegistryOrder(self, registry, ids):
+		"""
+		Return the ids in the order of the registry, and an array from registry indices to positions in them
+		(or the ids and None, if there is no registry).
+		"""
+		if registry == None:
+			return ids, None
+
+		registry.InternMany(ids)
+		indices = numpy.sort(registry.Indices(ids))
+
+		positions = -numpy.ones(len(registry), dtype=int)
+		positions[indices] = numpy.arange(len(indices))
+
+		return [registry.ids[n] for n in indices], positions
+
+	def _Map(self, ids, registry, positions, store_registry):
+		"""
+		Return an array from the indices of a rating store registry to positions in ids (-1 where not included).
+		"""
+		if registry != None and registry is store_registry:
+			# (the same registry - no need to look the ids up; it may have grown since)
+			return numpy.concatenate([positions, -numpy.ones(len(store_registry) - len(positions), dtype=int)])
+
+		index = dict((uid, i) for i, uid in enumerate(ids))
+		return numpy.array([index.get(uid, -1) for uid in store_registry.ids], dtype=int)
+
+	def BuildRatingMatrix(self):
+		"""
+		Build a sparse user x place rating matrix (CSR), by the indices of BuildIndices, and return it.
+		Ratings of places that are not in the places data (or illegal ratings) are ignored.
+		"""
+
+		self.BuildIndices()
+
+		if hasattr(self.rating_recommender_data, 'Ratings'):
+			# use the arrays of the rating store directly, mapping its indices to ours
+			store = self.rating_recommender_data.Ratings()
+			store.Compact()
+			user_map = self._Map(self.userids, self.user_registry, self.user_positions, store.user_ids)
+			place_map = self._Map(self.placeids, self.place_registry, self.place_positions, store.place_ids)
+
+			rows = user_map[numpy.repeat(numpy.arange(len(store.user_indptr) - 1), numpy.diff(store.user_indptr))]
+			cols = place_map[store.user_places]
+			values = store.values.astype(float)
+
+			legal = (cols != -1) & ~numpy.isnan(values)
+			rows, cols, values = rows[legal], cols[legal], values[legal]
+		else:
+			rows = []
+			cols = []
+			values = []
+			for userid, rated_places in self.rating_recommender_data['by_user'].iteritems():
+				u = self.user_index[userid]
+				for placeid, v in rated_places.iteritems():
+					if self.place_index.has_key(placeid) and v['rating'] != None:
+						rows.append(u)
+						cols.append(self.place_index[placeid])
+						values.append(v['rating'])
+
+		rating_matrix = scipy.sparse.csr_matrix((numpy.array(values, dtype=float), (rows, cols)),
+												shape=(len(self.userids), len(self.placeids)))
+		rating_matrix.sort_indices()
+
+		return rating_matrix
+
+	def _UserRatings(self, userid, exclude_placeid=None):
+		"""
+		Return the places rated by a user as (place indices, ratings) arrays, sorted by place index.
+		"""
+		rated_places = [(self.place_index[placeid], v['rating']) for placeid, v in self.rating_recommender_data['by_user'].get(userid, {}).iteritems() \
+												if placeid != exclude_placeid and self.place_index.has_key(placeid) and v['rating'] != None]
+		rated_places.sort()
+
+		indices = numpy.array([i for i, r in rated_places], dtype=int)
+		ratings = numpy.array([r for i, r in rated_places], dtype=float)
+
+		return indices, ratings
+
+	def _SparseRowValues(self, matrix, row, columns):
+		"""
+		Return the values of a row of a CSR matrix (with sorted indices) in the given columns, 0 where missing.
+		"""
+		start, end = matrix.indptr[row], matrix.indptr[row+1]
+		indices = matrix.indices[start:end]
+
+		values = numpy.zeros(len(columns))
+		if end > start and len(columns) > 0:
+			positions = numpy.minimum(numpy.searchsorted(indices, columns), end - start - 1)
+			found = (indices[positions] == columns)
+			values[found] = matrix.data[start + positions[found]]
+
+		return values
+
 	def PredictRating(self, userid, placeid, force_predict=False):
 
-		# If the rating already exists, just return it, unless mentioned otherwise		
-		if (not force_predict) and self.rating_recommender_data['by_user'][userid].has_key(placeid):
-			return self.rating_recommender_data['by_user'][userid][placeid]['rating']
+		# If the rating already exists, just return it, unless mentioned otherwise
+		# (a rating of None is predicted, as in PredictRatings)
+		rated_places = self.rating_recommender_data['by_user'].get(userid, {})
+		if (not force_predict) and rated_places.get(placeid, {}).get('rating') != None:
+			return rated_places[placeid]['rating']
 
 		averaged_prediction = self.PredictRatingRaw(userid, placeid)
 
@@ -67,4 +351,49 @@ class RecommenderSystem(object):
 	def PredictRatingRaw(self, userid, placeid):
 		raise NotImplementedError()
 
+	def PredictRatings(self, userid, placeids, force_predict=False):
+		"""
+		Predict the ratings of a user for several places at once, with the same post processing as PredictRating.
+		Returns an array, in the order of placeids.
+		"""
+		placeids = list(placeids)
+		ratings = numpy.zeros(len(placeids))
+
+		# If the rating already exists, just return it, unless mentioned otherwise
+		rated_places = self.rating_recommender_data['by_user'].get(userid, {})
+		to_predict = []
+		for n, placeid in enumerate(placeids):
+			if (not force_predict) and rated_places.get(placeid, {}).get('rating') != None:
+				ratings[n] = rated_places[placeid]['rating']
+			else:
+				to_predict.append(n)
+
+		if len(to_predict) == 0:
+			return ratings
+
+		averaged_predictions = numpy.asarray(self.PredictRatingsRaw(userid, [placeids[n] for n in to_predict]), dtype=float)
+
+		# post processing:
+		# if we couldn't predict, return default value; check boundaries
+		predictions = numpy.clip(averaged_predictions, self._min_rating, self._max_rating)
+		predictions[averaged_predictions == -1] = self._default_rating
+
+		ratings[to_predict] = predictions
+
+		return ratings
+
+	def PredictRatingsMany(self, userids, placeids, force_predict=False):
+		"""
+		Predict the ratings of several users for several places. Returns a (users x places) array.
+		"""
+		placeids = list(placeids)
+		return numpy.array([self.PredictRatings(userid, placeids, force_predict) for userid in userids], dtype=float).reshape((len(userids), len(placeids)))
+
+	def PredictRatingsRaw(self, userid, placeids):
+		"""
+		Like PredictRatingRaw, for several places (-1 where there is no prediction).
+		Subclasses should override this with a vectorized version; this one goes place by place.
+		"""
+		return numpy.array([self.PredictRatingRaw(userid, placeid) for placeid in placeids], dtype=float)
+
 
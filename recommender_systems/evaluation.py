@@ -4,6 +4,8 @@
 __all__ = []
 __author__ = "Regev S"
 
+# python imports
+import numpy
 
 class Evaluator(object):
 	def Evaluate(self, recommender_system):
@@ -23,20 +25,13 @@ class AllButOneMeanAverageError(Evaluator):
 		for userid, rated_places in recommender_system.rating_recommender_data['by_user'].iteritems():
 
 			n_rated_places = len(rated_places)
-			total_average_error = 0.0
 
-			# go over all rated places for that user
-			for placeid, v in rated_places.iteritems():
+			# compare real ratings to predicted ratings, for all rated places of that user
+			placeids = rated_places.keys()
+			user_ratings = numpy.array([rated_places[placeid]['rating'] for placeid in placeids], dtype=float)
+			predicted_ratings = recommender_system.PredictRatings(userid, placeids, force_predict=True)
 
-				# compare real rating to predicted rating
-				user_rating = v['rating']
-				predicted_rating = recommender_system.PredictRating(userid, placeid, force_predict=True)
-
-				# print userid, placeid, user_rating, predicted_rating
-
-				abs_diff = abs(user_rating - predicted_rating)
-
-				total_average_error += abs_diff
+			total_average_error = numpy.abs(user_ratings - predicted_ratings).sum()
 
 			total_averages += (float(total_average_error) / n_rated_places)
 
@@ -8,6 +8,10 @@ __author__ = "Regev S"
 # Self imports
 import base
 
+# python imports
+import collections
+import numpy
+
 __all__.append('LinearHybridRecommender')
 class LinearHybridRecommender(base.RecommenderSystem):
 
@@ -39,9 +43,37 @@ class LinearHybridRecommender(base.RecommenderSystem):
 
 		return average_prediction
 
+	def PredictRatingsRaw(self, userid, placeids):
+		placeids = list(placeids)
+
+		average_predictions = numpy.zeros(len(placeids))
+		for i, obj in enumerate(self.recommender_system_objects):
+			average_predictions += obj.PredictRatings(userid, placeids, force_predict=True) * self.weights[i]
+
+		return average_predictions
+
+class _AugmentedPlacesData(object):
+	"""
+	Read-only places data, with the augmented feature added to copies of the places' info.
+	"""
+	def __init__(self, places_recommender_data, augmented_feature):
+		self.data = {}
+		for placeid, info in places_recommender_data.data.iteritems():
+			self.data[placeid] = dict(info)
+			self.data[placeid]['augmented_feature'] = augmented_feature[placeid]
+
+	def __getitem__(self, key):
+		return self.data[key]
+
+	def keys(self):
+		return self.data.keys()
+
 __all__.append('FeatureAugmentRecommender')
 class FeatureAugmentRecommender(base.RecommenderSystem):
 
+	# number of users whose content models are kept
+	_cache_size = 100
+
 	def __init__(self,
 				content_based_recommender_system_class,
 				other_recommender_system,
@@ -54,7 +86,8 @@ class FeatureAugmentRecommender(base.RecommenderSystem):
 		self.categorical_keywords = categorical_keywords
 		self.numerical_keywords = numerical_keywords
 
-		self.last_userid = None
+		# the content model of each user, least recently used first
+		self.content_based_recommender_system_objs = collections.OrderedDict()
 
 		base.RecommenderSystem.__init__(self, 
 										self.other_recommender_system.places_recommender_data,
@@ -62,24 +95,72 @@ class FeatureAugmentRecommender(base.RecommenderSystem):
 										self.other_recommender_system.rating_recommender_data
 										)
 
-	
-	def PredictRatingRaw(self, userid, placeid):
-		
+		# the versions of the data the content models are of (see _CheckVersions)
+		self.places_version = getattr(self.places_recommender_data, 'version', None)
+		self.rating_version = getattr(self.rating_recommender_data, 'version', None)
+
+		# the content models depend on the ratings
+		if hasattr(self.rating_recommender_data, 'AddListener'):
+			self.rating_recommender_data.AddListener(self)
+
+	def ClearCache(self):
+		self.content_based_recommender_system_objs.clear()
+
+	def _CheckVersions(self):
+		"""
+		Drop the content models if the places or the ratings changed (and the default rating, if the ratings
+		changed in a way we were not told about).
+		"""
+		places_version = getattr(self.places_recommender_data, 'version', None)
+		rating_version = getattr(self.rating_recommender_data, 'version', None)
+		if (places_version, rating_version) != (self.places_version, self.rating_version):
+			self.ClearCache()
+			if rating_version != self.rating_version:
+				self.SetDefaultRating()
+			self.places_version, self.rating_version = places_version, rating_version
+
+	def RatingChanged(self, userid, placeid, old_rating, new_rating):
+		self.ClearCache()
+		if self.rating_version != None and self.rating_recommender_data.version == self.rating_version + 1:
+			self.UpdateDefaultRating(old_rating, new_rating)
+			self.rating_version = self.rating_recommender_data.version
+
+	def ContentBasedRecommenderSystem(self, userid):
+		"""
+		Return the content model of a user, where the prediction of the other recommender system
+		is an extra feature. Models are built once per user and cached (until the places or ratings change).
+		"""
+		self._CheckVersions()
+
+		if self.content_based_recommender_system_objs.has_key(userid):
+			content_based_recommender_system_obj = self.content_based_recommender_system_objs.pop(userid)
+			self.content_based_recommender_system_objs[userid] = content_based_recommender_system_obj
+			return content_based_recommender_system_obj
+
 		# Add prediction from ther inside RS as an extra feature
-		if self.last_userid != userid:
-			for placeid_j in self.places_recommender_data.keys():
-				self.places_recommender_data[placeid_j]['augmented_feature'] = self.other_recommender_system.PredictRating(userid, placeid_j)
+		all_places_ids = self.places_recommender_data.keys()
+		augmented_feature = dict(zip(all_places_ids, self.other_recommender_system.PredictRatings(userid, all_places_ids)))
 
 		# Create a new predictor, with the other rating as a feature
-		self.content_based_recommender_system_obj = self.content_based_recommender_system_class(
-														self.places_recommender_data,
+		content_based_recommender_system_obj = self.content_based_recommender_system_class(
+														_AugmentedPlacesData(self.places_recommender_data, augmented_feature),
 														self.users_recommender_data,
 														self.rating_recommender_data,
 														self.categorical_keywords,
 														self.numerical_keywords + ['augmented_feature'])
 
+		self.content_based_recommender_system_objs[userid] = content_based_recommender_system_obj
+		if len(self.content_based_recommender_system_objs) > self._cache_size:
+			self.content_based_recommender_system_objs.popitem(last=False)
+
+		return content_based_recommender_system_obj
+	
+	def PredictRatingRaw(self, userid, placeid):
 		
-		prediction = self.content_based_recommender_system_obj.PredictRatingRaw(userid, placeid)
+		prediction = self.ContentBasedRecommenderSystem(userid).PredictRatingRaw(userid, placeid)
 
 		return prediction
 
+	def PredictRatingsRaw(self, userid, placeids):
+		return self.ContentBasedRecommenderSystem(userid).PredictRatingsRaw(userid, placeids)
+
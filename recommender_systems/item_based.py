@@ -10,6 +10,7 @@ import base
 
 # python imports
 import sys
+import numpy
 
 class ItemBasedRecommenderSystem(base.RecommenderSystem):
 	pass
@@ -36,67 +37,221 @@ class SlopeOneRecommenderSystem(ItemBasedRecommenderSystem):
 
 		self.weighted = weighted
 		self.CalculateDeviationMatrix()	
+
+		# keep the deviations up to date when single ratings change
+		if hasattr(self.rating_recommender_data, 'AddListener'):
+			self.rating_recommender_data.AddListener(self)
 	
 
 	def CalculateDeviationMatrix(self):
 		
-		self.deviation_matrix = {}
-		self.common_users = {}
-		
-		all_places_ids = self.places_recommender_data.keys()
-		n_places = len(all_places_ids)
-
-		for placeid_i in all_places_ids:
-			self.deviation_matrix[placeid_i] = {}
-			self.common_users[placeid_i] = {}
-			for placeid_j in all_places_ids:
-				self.deviation_matrix[placeid_i][placeid_j] = 0.0
-				
-		for i in range(n_places):
-			for j in range(i):
-				placeid_i = all_places_ids[i]
-				placeid_j = all_places_ids[j]
-
-				common_users = set(self.rating_recommender_data['by_place'].get(placeid_i, {}).keys()) & set(self.rating_recommender_data['by_place'].get(placeid_j, {}).keys())
-				self.common_users[placeid_i][placeid_j] = len(common_users)
-				self.common_users[placeid_j][placeid_i] = len(common_users)
-
-				for userid in common_users:
-					diff = (self.rating_recommender_data['by_place'][placeid_i][userid]['rating'] - self.rating_recommender_data['by_place'][placeid_j][userid]['rating'])
+		# user x place ratings, and an indicator of which entries exist
+		rating_matrix = self.BuildRatingMatrix()
+		rated_matrix = rating_matrix.copy()
+		rated_matrix.data[:] = 1.0
+
+		# common_users[i, j] = number of users who rated both i and j.
+		# Only co-rated pairs are stored (ratings are positive, so sums share the same pattern).
+		self.common_users = (rated_matrix.T * rated_matrix).tocsr()
+		self.common_users.sort_indices()
+
+		# sums[i, j] = sum of the ratings of i, over the users who rated both i and j
+		sums = (rating_matrix.T * rated_matrix).tocsr()
+		sums.sort_indices()
+		sums_transposed = sums.T.tocsr()
+		sums_transposed.sort_indices()
+
+		# deviation_matrix[i, j] = sum of (r_i - r_j), over the users who rated both i and j
+		self.deviation_matrix = self.common_users.copy()
+		self.deviation_matrix.data = sums.data - sums_transposed.data
+
+		# pairs that became co-rated after the matrices were built: {j: {i: [common users, deviation sum]}}
+		self.new_pairs = {}
+
+		# the version of the ratings the deviations are of (see RatingChanged)
+		self.rating_version = getattr(self.rating_recommender_data, 'version', None)
+
+	def _CheckRatingVersion(self):
+		"""
+		Rebuild the deviations if the ratings changed in a way we were not told about (e.g., a reset).
+		"""
+		if getattr(self.rating_recommender_data, 'version', None) != self.rating_version:
+			self.SetDefaultRating()
+			self.CalculateDeviationMatrix()
+
+	def _DeviationBlock(self, targets, rated_indices):
+		"""
+		Return (common users, deviation sums) of the pairs of the target places and the rated places, as dense arrays.
+		"""
+		common_users = numpy.zeros((len(targets), len(rated_indices)))
+		deviations = numpy.zeros((len(targets), len(rated_indices)))
+
+		n_built = self.common_users.shape[0]
+		built_targets = (targets < n_built)
+		built_rated = (rated_indices < n_built)
+		if built_targets.any() and built_rated.any():
+			block = numpy.ix_(built_targets, built_rated)
+			common_users[block] = self.common_users[targets[built_targets]][:, rated_indices[built_rated]].toarray()
+			deviations[block] = self.deviation_matrix[targets[built_targets]][:, rated_indices[built_rated]].toarray()
+
+		# pairs that became co-rated after the matrices were built
+		if self.new_pairs:
+			rated_positions = dict((i, n) for n, i in enumerate(rated_indices))
+			for m, j in enumerate(targets):
+				for i, (n_common_users, deviation) in self.new_pairs.get(j, {}).iteritems():
+					if rated_positions.has_key(i):
+						common_users[m, rated_positions[i]] += n_common_users
+						deviations[m, rated_positions[i]] += deviation
+
+		return common_users, deviations
+
+	def _AdjustPair(self, j, i, delta_common_users, delta_deviation):
+		"""
+		Add to the common users and deviation sum of the pair (j, i).
+		"""
+		if j < self.common_users.shape[0] and i < self.common_users.shape[1]:
+			start, end = self.common_users.indptr[j], self.common_users.indptr[j+1]
+			position = start + numpy.searchsorted(self.common_users.indices[start:end], i)
+			if position < end and self.common_users.indices[position] == i:
+				self.common_users.data[position] += delta_common_users
+				self.deviation_matrix.data[position] += delta_deviation
+				return
+
+		pair = self.new_pairs.setdefault(j, {}).setdefault(i, [0.0, 0.0])
+		pair[0] += delta_common_users
+		pair[1] += delta_deviation
+
+	def _ApplyRating(self, userid, placeid, rating, sign):
+		"""
+		Add (sign=1) or subtract (sign=-1) the contribution of a single rating to the deviations.
+		Costs O(number of places the user rated).
+		"""
+		if not self.place_index.has_key(placeid):
+			try:
+				self.places_recommender_data[placeid]
+			except KeyError:
+				return
+			self.place_index[placeid] = len(self.placeids)
+			self.placeids.append(placeid)
+		j = self.place_index[placeid]
+
+		rated_indices, ratings = self._UserRatings(userid, exclude_placeid=placeid)
+		for i, rating_i in zip(rated_indices, ratings):
+			self._AdjustPair(j, i, sign, sign * (rating - rating_i))
+			self._AdjustPair(i, j, sign, sign * (rating_i - rating))
+		self._AdjustPair(j, j, sign, 0.0)
+
+	def RatingChanged(self, userid, placeid, old_rating, new_rating):
+		"""
+		Update the deviations after a single rating was added, changed or removed
+		(called by RatingRecommenderData; the user's other ratings must be unchanged).
+		"""
+		if self.rating_version == None or self.rating_recommender_data.version != self.rating_version + 1:
+			# (other changes happened since - the deviations are rebuilt when next used)
+			return
+		self.rating_version = self.rating_recommender_data.version
+
+		if old_rating != None:
+			self._ApplyRating(userid, placeid, old_rating, -1)
+		if new_rating != None:
+			self._ApplyRating(userid, placeid, new_rating, 1)
+		self.UpdateDefaultRating(old_rating, new_rating)
+
+	def AddRating(self, userid, placeid, rating):
+		self.rating_recommender_data.SetRating(userid, placeid, rating)
+
+	def UpdateRating(self, userid, placeid, rating):
+		if not self.rating_recommender_data['by_user'].get(userid, {}).has_key(placeid):
+			raise KeyError("User %s did not rate place %s" % (userid, placeid))
+		self.rating_recommender_data.SetRating(userid, placeid, rating)
+
+	def RemoveRating(self, userid, placeid):
+		self.rating_recommender_data.RemoveRating(userid, placeid)
+
+	def PredictRatingsRaw(self, userid, placeids):
+
+		self._CheckRatingVersion()
+
+		averaged_predictions = -numpy.ones(len(placeids))
+
+		known = numpy.array([n for n, placeid in enumerate(placeids) if self.place_index.has_key(placeid)], dtype=int)
+		targets = numpy.array([self.place_index[placeids[n]] for n in known], dtype=int)
+
+		# the places the user rated (a place is not used to predict itself)
+		rated_indices, ratings = self._UserRatings(userid)
+		common_users, deviations = self._DeviationBlock(targets, rated_indices)
+		common_users[targets[:, numpy.newaxis] == rated_indices[numpy.newaxis, :]] = 0
+
+		has_common_users = (common_users > 0)
+		devs = deviations / numpy.where(has_common_users, common_users, 1.0)
+
+		if self.weighted:
+			weights = numpy.where(has_common_users, common_users, 0.0)
+		else:
+			weights = has_common_users.astype(float)
+
+		total_prediction = ((devs + ratings) * weights).sum(axis=1)
+		total_weights = weights.sum(axis=1)
+
+		# where there is no common rating with anyone, we cannot predict
+		can_predict = (total_weights > 0)
+		averaged_predictions[known[can_predict]] = total_prediction[can_predict] / total_weights[can_predict]
+
+		return averaged_predictions
+
+	def _DeviationRow(self, j, rated_indices):
+		"""
+		Return (common users, deviation sums) of the pairs of one target place and the rated places.
+		"""
+		common_users = numpy.zeros(len(rated_indices))
+		deviations = numpy.zeros(len(rated_indices))
+
+		# (both matrices have the same pattern)
+		if j < self.common_users.shape[0] and len(rated_indices) > 0:
+			start, end = self.common_users.indptr[j], self.common_users.indptr[j+1]
+			if end > start:
+				positions = start + numpy.minimum(numpy.searchsorted(self.common_users.indices[start:end], rated_indices), end - start - 1)
+				found = (self.common_users.indices[positions] == rated_indices)
+				common_users[found] = self.common_users.data[positions[found]]
+				deviations[found] = self.deviation_matrix.data[positions[found]]
+
+		# pairs that became co-rated after the matrices were built
+		new_pairs = self.new_pairs.get(j)
+		if new_pairs:
+			for n, i in enumerate(rated_indices):
+				if new_pairs.has_key(i):
+					common_users[n] += new_pairs[i][0]
+					deviations[n] += new_pairs[i][1]
+
+		return common_users, deviations
 
-					self.deviation_matrix[placeid_i][placeid_j] += diff
-					self.deviation_matrix[placeid_j][placeid_i] += (-diff)
-				
 	def PredictRatingRaw(self, userid, placeid):
 
-		placeid_j = placeid
+		self._CheckRatingVersion()
 
-		places_with_common_users = [placeid_i for placeid_i in self.rating_recommender_data['by_user'][userid].keys() \
-											  if placeid_i != placeid_j and self.common_users[placeid_i][placeid_j] > 0]
-											  
-		if len(places_with_common_users) == 0:			
-			# warnings.warn("Cannot predict - no common rating with anyone")
-			averaged_prediction = -1
-			
-		else:
-			total_prediction = 0.0
-			total_weights = 0.0
+		# (a single place - only its row of the deviations is used)
+		if not self.place_index.has_key(placeid):
+			return -1
+		j = self.place_index[placeid]
 
-			for placeid_i in places_with_common_users:
-				dev = self.deviation_matrix[placeid_j][placeid_i] / float(self.common_users[placeid_j][placeid_i])
-				user_rating = self.rating_recommender_data['by_user'][userid][placeid_i]['rating']
+		# the other places the user rated
+		rated_indices, ratings = self._UserRatings(userid, exclude_placeid=placeid)
+		common_users, deviations = self._DeviationRow(j, rated_indices)
 
-				if self.weighted:
-					weight = float(self.common_users[placeid_j][placeid_i])
-				else:
-					weight = 1.0
-				total_prediction += (dev + user_rating) * weight
-				total_weights = weight
+		has_common_users = (common_users > 0)
+		devs = deviations / numpy.where(has_common_users, common_users, 1.0)
 
+		if self.weighted:
+			weights = numpy.where(has_common_users, common_users, 0.0)
+		else:
+			weights = has_common_users.astype(float)
 
-			averaged_prediction = total_prediction / total_weights
+		# where there is no common rating with anyone, we cannot predict
+		total_weights = weights.sum()
+		if total_weights == 0:
+			return -1
 
-		return averaged_prediction			
+		return numpy.dot(devs + ratings, weights) / total_weights
 	
 class TFIDFRecommenderSystem(ItemBasedRecommenderSystem):
 	
@@ -111,6 +266,7 @@ class TFIDFRecommenderSystem(ItemBasedRecommenderSystem):
 		self.categorical_keywords = categorical_keywords
 		self.numerical_keywords = numerical_keywords
 
+		self.BuildIndices()
 		self.InitFeatures()
 		self.InitWeights()		
 		self.CalculatePlaceRepresentations()
@@ -185,46 +341,59 @@ class TFIDFRecommenderSystem(ItemBasedRecommenderSystem):
 					self.representations[placeid][numerical_keyword] = float(info[numerical_keyword])
 
 	def PreprocessWeights(self):
-		self.norms = {}
-		for placeid, rep in self.representations.iteritems():
-			self.norms[placeid] = sum([self.weights[feature] * rep[feature]**2 for feature in self.features])**0.5
-		
-		self.inners = {}
-		for placeid, rep in self.representations.iteritems():
-			for placeid_j, rep_j in self.representations.iteritems():
-				 self.inners[(placeid, placeid_j)] = sum([self.weights[feature] * rep[feature] * rep_j[feature] for feature in self.features])
 
-				
+		# representations and weights as arrays, by place index
+		features = list(self.features)
+		self.weights_vector = numpy.array([self.weights[feature] for feature in features], dtype=float)
+		self.representations_matrix = numpy.array([[self.representations[placeid][feature] for feature in features] for placeid in self.placeids], dtype=float)
+		self.representations_matrix.shape = (len(self.placeids), len(features))
+
+		self.norms = numpy.dot(self.representations_matrix**2, self.weights_vector)**0.5
 		
-	def PredictRatingRaw(self, userid, placeid):
+	def PredictRatingsRaw(self, userid, placeids):
 
 		epsilon = 10**-7
 
-		# all the other places the user rated
-		rated_places = self.rating_recommender_data.data['by_user'][userid].keys()
-		rated_places = [placeid_j for placeid_j in rated_places if placeid_j != placeid]
+		targets = numpy.array([self.place_index[placeid] for placeid in placeids], dtype=int)
 
-		if len(rated_places) == 0:
-			return -1
+		# the places the user rated (a place is not used to predict itself)
+		rated_indices, ratings = self._UserRatings(userid)
 
-		self.total_weights = {}
-		self.total_rating = {}
+		# cosine similarity
+		inner_products = numpy.dot(self.representations_matrix[targets] * self.weights_vector, self.representations_matrix[rated_indices].T)
+		cosine_weights = inner_products / numpy.outer(self.norms[targets], self.norms[rated_indices]) + epsilon
+		cosine_weights[targets[:, numpy.newaxis] == rated_indices[numpy.newaxis, :]] = 0.0
 
-		for placeid_j in rated_places:
-		
-			# the other rating
-			rating_j = self.rating_recommender_data.data['by_user'][userid][placeid_j]['rating']
+		total_weights = cosine_weights.sum(axis=1)
+		averaged_predictions = numpy.dot(cosine_weights, ratings) / numpy.where(total_weights == 0, 1.0, total_weights)
+
+		# no other rated places
+		n_other_rated = (targets[:, numpy.newaxis] != rated_indices[numpy.newaxis, :]).sum(axis=1)
+		averaged_predictions[n_other_rated == 0] = -1
+
+		return averaged_predictions
 
-			# cosine similarity			
-			inner_product = self.inners[(placeid, placeid_j)]
-			cosine_weight = inner_product / (self.norms[placeid] * self.norms[placeid_j]) + epsilon
+	def PredictRatingRaw(self, userid, placeid):
+
+		epsilon = 10**-7
+
+		# (a single place, without the setup of PredictRatingsRaw)
+		target = self.place_index[placeid]
+
+		# the other places the user rated
+		rated_indices, ratings = self._UserRatings(userid, exclude_placeid=placeid)
+		if len(rated_indices) == 0:
+			return -1
 
-			self.total_weights[placeid_j] = cosine_weight
-			self.total_rating[placeid_j] = rating_j
+		# cosine similarity
+		inner_products = numpy.dot(self.representations_matrix[rated_indices], self.representations_matrix[target] * self.weights_vector)
+		cosine_weights = inner_products / (self.norms[target] * self.norms[rated_indices]) + epsilon
 
-		averaged_prediction = sum([self.total_weights[placeid_j]*self.total_rating[placeid_j] for placeid_j in rated_places]) / sum(self.total_weights.values())
+		total_weights = cosine_weights.sum()
+		if total_weights == 0:
+			total_weights = 1.0
 
-		return averaged_prediction
+		return numpy.dot(cosine_weights, ratings) / total_weights
 		
 
 
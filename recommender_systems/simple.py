@@ -7,6 +7,9 @@ __author__ = "Regev S"
 
 import base
 
+# python imports
+import numpy
+
 __all__.append("ExpertRating")
 class ExpertRating(base.RecommenderSystem):
 
@@ -22,6 +25,11 @@ class ExpertRating(base.RecommenderSystem):
 		else:
 			return self._default_expert_rank
 
+	def PredictRatingsRaw(self, userid, placeids):
+		expert_ranks = numpy.array([self.places_recommender_data[placeid]['expert_rank'] for placeid in placeids], dtype=float)
+		expert_ranks[numpy.isnan(expert_ranks)] = self._default_expert_rank
+		return expert_ranks
+
 
 
 
@@ -34,6 +42,9 @@ class AverageRating(base.RecommenderSystem):
 	def PredictRatingRaw(self, userid, placeid):
 		return self._default_rating
 
+	def PredictRatingsRaw(self, userid, placeids):
+		return numpy.zeros(len(placeids)) + self._default_rating
+
 
 
 
@@ -60,20 +71,18 @@ class AverageUserRating(base.RecommenderSystem):
 
 		all_users = self.users_recommender_data.keys()
 
-		for i, userid_i in enumerate(all_users):
-			
-			total_rating = 0.0
-			n_rating = 0
+		statistics = self.RatingStatistics()
 
-			for placeid, info in self.rating_recommender_data['by_user'].get(userid_i, {}).iteritems():
-				total_rating += info['rating']				
-				n_rating += 1
+		for i, userid_i in enumerate(all_users):
 			
-			if n_rating == 0:
-				self.user_averages[userid_i] = self._default_average_rating
+			if statistics.user_means.has_key(userid_i):
+				self.user_averages[userid_i] = statistics.user_means[userid_i]
 			else:
-				self.user_averages[userid_i] = float(total_rating) / n_rating
+				self.user_averages[userid_i] = self._default_average_rating
 
 	def PredictRatingRaw(self, userid, placeid):
-		return self.user_averages[userid]
+		return self.user_averages.get(userid, -1)
+
+	def PredictRatingsRaw(self, userid, placeids):
+		return numpy.zeros(len(placeids)) + self.user_averages.get(userid, -1)
 
@@ -8,16 +8,35 @@ __author__ = "Regev S"
 # Self imports
 import base
 
+# python imports
+import numpy
+import scipy.sparse
+
 
 class UserBasedRecommenderSystem(base.RecommenderSystem):
 
+	# number of users whose similarity rows are calculated at once in neighborhood mode
+	_block_size = 128
+
 	def __init__(self, 
 				 places_recommender_data,
 				 users_recommender_data,
-				 rating_recommender_data):
+				 rating_recommender_data,
+				 n_neighbors = None,
+				 min_similarity = None):
+		"""
+		n_neighbors         - If given, keep only the n_neighbors most similar users of each user (instead of
+		                      the full user x user similarity matrix), and predict only from them
+		min_similarity      - If given (with n_neighbors), neighbors must be at least that similar
+		"""
 		base.RecommenderSystem.__init__(self, places_recommender_data, users_recommender_data, rating_recommender_data)
+
+		self.n_neighbors = n_neighbors
+		self.min_similarity = min_similarity
 	
+		self.rating_matrix = self.BuildRatingMatrix()
 		self.CalculateUserAverages()
+		self.CalculateCenteredRatings()
 		self.CalculateUserSimilarityMatrix()
 
 	def CalculateUserAverages(self):
@@ -29,19 +48,16 @@ class UserBasedRecommenderSystem(base.RecommenderSystem):
 
 		all_users = self.users_recommender_data.keys()
 
+		statistics = self.RatingStatistics()
+
 		for i, userid_i in enumerate(all_users):
 			
-			ratings = []			
-
-			for placeid, info in self.rating_recommender_data['by_user'].get(userid_i, {}).iteritems():
-				ratings.append(info['rating']				)
-				
-			n_rating = len(ratings)
+			n_rating = statistics.user_counts.get(userid_i, 0)
 
 			if n_rating == 0:
 				self.user_averages[userid_i] = self._default_average_rating				
 			else:
-				self.user_averages[userid_i] = sum(ratings) / n_rating
+				self.user_averages[userid_i] = statistics.user_sums[userid_i] / n_rating
 
 			# if n_rating == 0:
 			# 	self.user_sigmas[userid_i] = 1.0
@@ -50,28 +66,158 @@ class UserBasedRecommenderSystem(base.RecommenderSystem):
 			# if self.user_sigmas[userid_i] == 0.0:
 			# 	self.user_sigmas[userid_i] = 1.0
 
+		# the same averages, by user index
+		self.user_averages_vector = numpy.array([self.user_averages.get(userid, self._default_average_rating) for userid in self.userids], dtype=float)
+
+
+	def CalculateCenteredRatings(self):
+
+		# ratings centered around the user averages (only where rated), and an indicator of which entries exist
+		self.rated_matrix = self.rating_matrix.copy()
+		self.rated_matrix.data[:] = 1.0
+
+		centered_matrix = self.rating_matrix.tocoo()
+		centered_matrix.data = centered_matrix.data - self.user_averages_vector[centered_matrix.row]
+		self.centered_matrix = centered_matrix.tocsr()
+
+		# the same, by place (for predictions)
+		self.rated_columns = self.rated_matrix.tocsc()
+		self.centered_columns = self.centered_matrix.tocsc()
 
 	def CalculateUserSimilarityMatrix(self):
 		raise NotImplementedError()
 
+	def CalculateUserSimilarityRows(self, start, end):
+		"""
+		Return the similarities of the users start..end-1 to all the users, as a (sparse or dense) matrix.
+		"""
+		raise NotImplementedError()
+
+	def CalculateSimilarities(self):
+		"""
+		Fill the similarities, either as the full user_sim_matrix, or (if n_neighbors is given) as the
+		neighborhoods: neighbor_indices/neighbor_similarities are n_users x n_neighbors arrays, holding
+		the most similar users of each user in decreasing similarity, padded by -1/0.
+		"""
+		n_users = len(self.userids)
+
+		if self.n_neighbors == None:
+			self.user_sim_matrix = self.CalculateUserSimilarityRows(0, n_users)
+			return
+
+		self.user_sim_matrix = None
+		self.neighbor_indices = -numpy.ones((n_users, self.n_neighbors), dtype=numpy.int32)
+		self.neighbor_similarities = numpy.zeros((n_users, self.n_neighbors))
+
+		for start in xrange(0, n_users, self._block_size):
+			end = min(start + self._block_size, n_users)
+			rows = self.CalculateUserSimilarityRows(start, end)
+			if scipy.sparse.issparse(rows):
+				rows = rows.tocsr()
+
+			for r in xrange(end - start):
+				if scipy.sparse.issparse(rows):
+					indices = rows.indices[rows.indptr[r]:rows.indptr[r+1]]
+					similarities = rows.data[rows.indptr[r]:rows.indptr[r+1]]
+				else:
+					indices = numpy.arange(n_users)
+					similarities = rows[r]
+
+				# zero similarity has no influence on the prediction
+				keep = (similarities != 0)
+				if self.min_similarity != None:
+					keep &= (similarities >= self.min_similarity)
+				indices, similarities = indices[keep], similarities[keep]
+
+				if len(similarities) > self.n_neighbors:
+					best = numpy.argpartition(-similarities, self.n_neighbors - 1)[:self.n_neighbors]
+					indices, similarities = indices[best], similarities[best]
+				order = numpy.argsort(-similarities, kind='mergesort')
+
+				self.neighbor_indices[start + r, :len(order)] = indices[order]
+				self.neighbor_similarities[start + r, :len(order)] = similarities[order]
+
+	def PredictRatingsRaw(self, userid, placeids):
+
+		# (nothing is known about users who are not in the data)
+		if not self.user_index.has_key(userid):
+			return -numpy.ones(len(placeids))
+
+		u = self.user_index[userid]
+
+		known = numpy.array([n for n, placeid in enumerate(placeids) if self.place_index.has_key(placeid)], dtype=int)
+		targets = numpy.array([self.place_index[placeids[n]] for n in known], dtype=int)
+
+		if self.n_neighbors != None:
+			# only the neighbors (who rated the places)
+			neighbors = self.neighbor_indices[u]
+			weights = self.neighbor_similarities[u][neighbors >= 0]
+			neighbors = neighbors[neighbors >= 0]
+
+			total_prediction = numpy.dot(weights, self.centered_matrix[neighbors][:, targets].toarray())
+			total_weights = numpy.dot(numpy.abs(weights), self.rated_matrix[neighbors][:, targets].toarray())
+
+		elif scipy.sparse.issparse(self.user_sim_matrix):
+			# all the users who rated the places
+			weights = self.user_sim_matrix[u]
+
+			total_prediction = (weights * self.centered_columns[:, targets]).toarray().ravel()
+			total_weights = (abs(weights) * self.rated_columns[:, targets]).toarray().ravel()
+
+		else:
+			# all the users who rated the places
+			weights = self.user_sim_matrix[u]
+
+			total_prediction = self.centered_columns[:, targets].T.dot(weights)
+			total_weights = self.rated_columns[:, targets].T.dot(numpy.abs(weights))
+
+		averaged_predictions = numpy.zeros(len(placeids)) + self.user_averages[userid]
+		has_weights = (total_weights > 0)
+		averaged_predictions[known[has_weights]] += total_prediction[has_weights] / total_weights[has_weights]
+
+		return averaged_predictions
+
 	def PredictRatingRaw(self, userid, placeid):
 
-		total_prediction = 0.0
-		total_weights = 0.0
+		if not self.user_index.has_key(userid):
+			return -1
 
-		for userid_v in self.rating_recommender_data['by_place'].get(placeid, {}).keys():
-			
-			dev =  self.rating_recommender_data['by_place'][placeid][userid_v]['rating'] - self.user_averages[userid_v]
-			weight = self.user_sim_matrix[userid][userid_v]
+		# (a single place - only its column of the ratings is used)
+		averaged_prediction = self.user_averages[userid]
+		if not self.place_index.has_key(placeid):
+			return averaged_prediction
+
+		u = self.user_index[userid]
+		p = self.place_index[placeid]
+
+		# the users who rated the place (the centered and rated matrices share their pattern)
+		start, end = self.centered_columns.indptr[p], self.centered_columns.indptr[p+1]
+		raters = self.centered_columns.indices[start:end]
+		centered = self.centered_columns.data[start:end]
+
+		if self.n_neighbors != None:
+			# only the neighbors who rated the place
+			neighbors = self.neighbor_indices[u]
+			similarities = self.neighbor_similarities[u][neighbors >= 0]
+			neighbors = neighbors[neighbors >= 0]
+
+			weights = numpy.zeros(len(raters))
+			if len(raters) > 0:
+				positions = numpy.minimum(numpy.searchsorted(raters, neighbors), len(raters) - 1)
+				found = (raters[positions] == neighbors)
+				weights[positions[found]] = similarities[found]
+
+		elif scipy.sparse.issparse(self.user_sim_matrix):
+			weights = self._SparseRowValues(self.user_sim_matrix, u, raters)
 
-			total_prediction += weight * dev 
-			total_weights += abs(weight)
+		else:
+			weights = self.user_sim_matrix[u, raters]
 
-		averaged_prediction = self.user_averages[userid] 
+		total_weights = numpy.abs(weights).sum()
 		if total_weights > 0:
-			averaged_prediction += total_prediction / total_weights
+			averaged_prediction += numpy.dot(weights, centered) / total_weights
 
-		return averaged_prediction		
+		return averaged_prediction
 
 __all__.append("PearsonRecommenderSystem")
 class PearsonRecommenderSystem(UserBasedRecommenderSystem):	
@@ -82,47 +228,69 @@ class PearsonRecommenderSystem(UserBasedRecommenderSystem):
 		
 
 	def CalculateUserSimilarityMatrix(self):
-		
-		self.user_sim_matrix = {}
 
-		all_users = self.users_recommender_data.keys()
+		self.squared_matrix = self.centered_matrix.multiply(self.centered_matrix).tocsr()
 
-		for i, userid_i in enumerate(all_users):
-			self.user_sim_matrix[userid_i] = {}
-			self.user_sim_matrix[userid_i][userid_i] = 0.0 # to avoid influence on your own predictions
+		self.CalculateSimilarities()
 
-			for j, userid_j in enumerate(all_users[:i]):
+	def CalculateUserSimilarityRows(self, start, end):
 
-				common_places = set(self.rating_recommender_data['by_user'].get(userid_i, {}).keys()) & \
-								set(self.rating_recommender_data['by_user'].get(userid_j, {}).keys())
+		# all the sums are over the common places of each pair of users;
+		# only pairs with common places are stored, and they all share the same pattern
+		n_common = (self.rated_matrix[start:end] * self.rated_matrix.T).tocsr()
+		n_common.sort_indices()
 
+		inner_products = _AsPattern(self.centered_matrix[start:end] * self.centered_matrix.T, n_common)
+		vars_i = _AsPattern(self.squared_matrix[start:end] * self.rated_matrix.T, n_common)
+		vars_j = _AsPattern(self.rated_matrix[start:end] * self.squared_matrix.T, n_common)
 
-				if len(common_places) == 0:
-					correlation = 0.0
-				
-				else:
-					# calculate pearson's correlation
-					inner_product = sum([(self.rating_recommender_data['by_user'][userid_i][placeid]['rating'] - self.user_averages[userid_i]) * \
-									 (self.rating_recommender_data['by_user'][userid_j][placeid]['rating'] - self.user_averages[userid_j]) for placeid in common_places])
+		# calculate pearson's correlation
+		variances = vars_i * vars_j
+		correlation = numpy.zeros(len(variances))
+		nonzero = (variances != 0)
+		correlation[nonzero] = inner_products[nonzero] / variances[nonzero]**0.5
 
-					var_i = sum([(self.rating_recommender_data['by_user'][userid_i][placeid]['rating'] - self.user_averages[userid_i])**2 for placeid in common_places])
-					var_j = sum([(self.rating_recommender_data['by_user'][userid_j][placeid]['rating'] - self.user_averages[userid_j])**2 for placeid in common_places])
+		# idioitic correction
+		correlation *= numpy.minimum(1.0, n_common.data / float(self._correction_ratio))
 
-					if var_i*var_j == 0:
-						correlation = 0.0
-					else:
-						correlation = inner_product / (var_i * var_j)**0.5
+		# calculate the case amplification of the correlation
+		gamma = numpy.abs(correlation)**self._case_amplification * correlation
+
+		# zero on the diagonal, to avoid influence on your own predictions
+		rows = start + numpy.repeat(numpy.arange(n_common.shape[0]), numpy.diff(n_common.indptr))
+		gamma[rows == n_common.indices] = 0.0
 
+		# this is the similarity
+		user_sim_rows = n_common.copy()
+		user_sim_rows.data = gamma
+		user_sim_rows.eliminate_zeros()
+		user_sim_rows.sort_indices()
 
-				# idioitic correction
-				correlation *= min(1.0, float(len(common_places)) / self._correction_ratio)
+		return user_sim_rows
 
-				# calculate the case amplification of the correlation
-				gamma = abs(correlation)**self._case_amplification * correlation
 
-				# this is the similarity
-				self.user_sim_matrix[userid_i][userid_j] = gamma
-				self.user_sim_matrix[userid_j][userid_i] = gamma
+def _AsPattern(matrix, pattern):
+	"""
+	Return the values of a sparse matrix on the (sorted CSR) pattern of another one, 0 where missing.
+	"""
+	matrix = matrix.tocsr()
+	matrix.sort_indices()
+
+	# address both by (row, column) as a single sorted key
+	n_columns = numpy.int64(pattern.shape[1])
+	matrix_rows = numpy.repeat(numpy.arange(matrix.shape[0], dtype=numpy.int64), numpy.diff(matrix.indptr))
+	matrix_keys = matrix_rows * n_columns + matrix.indices
+	pattern_rows = numpy.repeat(numpy.arange(pattern.shape[0], dtype=numpy.int64), numpy.diff(pattern.indptr))
+	pattern_keys = pattern_rows * n_columns + pattern.indices
+
+	values = numpy.zeros(len(pattern_keys))
+	if len(matrix_keys) > 0:
+		positions = numpy.searchsorted(matrix_keys, pattern_keys)
+		positions[positions == len(matrix_keys)] = 0
+		found = (matrix_keys[positions] == pattern_keys)
+		values[found] = matrix.data[positions[found]]
+
+	return values
 
 
 
@@ -136,12 +304,14 @@ class DemographicRecommenderSystem(UserBasedRecommenderSystem):
 				 users_recommender_data,
 				 rating_recommender_data,
 				 categorical_keywords = [],
-				 numerical_keywords = []):
+				 numerical_keywords = [],
+				 n_neighbors = None,
+				 min_similarity = None):
 		
 		self.categorical_keywords = categorical_keywords
 		self.numerical_keywords = numerical_keywords
 
-		UserBasedRecommenderSystem.__init__(self, places_recommender_data, users_recommender_data, rating_recommender_data)
+		UserBasedRecommenderSystem.__init__(self, places_recommender_data, users_recommender_data, rating_recommender_data, n_neighbors, min_similarity)
 
 		
 		
@@ -221,19 +391,26 @@ class DemographicRecommenderSystem(UserBasedRecommenderSystem):
 					self.representations[userid][numerical_keyword] = float(info[numerical_keyword])
 
 	def PreprocessWeights(self):
-		
-		epsilon = 10**-7
 
-		self.norms = {}
-		for userid, rep in self.representations.iteritems():
-			self.norms[userid] = sum([self.weights[feature] * rep[feature]**2 for feature in self.features])**0.5
-		
-		self.user_sim_matrix = {}
+		# representations and weights as arrays, by user index (users without a representation are all zeros)
+		features = list(self.features)
+		self.weights_vector = numpy.array([self.weights[feature] for feature in features], dtype=float)
+		self.representations_matrix = numpy.zeros((len(self.userids), len(features)))
 		for userid, rep in self.representations.iteritems():
-			if not self.user_sim_matrix.has_key(userid):
-				self.user_sim_matrix[userid] = {}
-			for userid_j, rep_j in self.representations.iteritems():
-				 self.user_sim_matrix[userid][userid_j] = sum([self.weights[feature] * rep[feature] * rep_j[feature] for feature in self.features]) / (self.norms[userid] * self.norms[userid_j]) + epsilon
+			self.representations_matrix[self.user_index[userid]] = [rep[feature] for feature in features]
+
+		self.norms = numpy.dot(self.representations_matrix**2, self.weights_vector)**0.5
+
+		self.CalculateSimilarities()
+
+	def CalculateUserSimilarityRows(self, start, end):
+
+		epsilon = 10**-7
+
+		norms = numpy.where(self.norms == 0, 1.0, self.norms)
+
+		inner_products = numpy.dot(self.representations_matrix[start:end] * self.weights_vector, self.representations_matrix.T)
+		return inner_products / numpy.outer(norms[start:end], norms) + epsilon
 
 				
 		
@@ -5,12 +5,19 @@ __all__ = []
 __author__ = "Regev S"
 
 import geopy.distance
+import heapq
+import numpy
+import collections
+import threading
+import cPickle
+import time
 
 
 # Self imports
 import integration
 
 import recommender_systems
+import recommender_systems.base
 import recommender_systems.simple
 import recommender_systems.item_based
 import recommender_systems.user_based
@@ -30,8 +37,106 @@ class NiceList(list):
         return '\t'.join(["%s = %s" % (field, str(value)) for field, value in zip(use_fields, self)])
 
 
+__all__.append('RecommendationCache')
+class RecommendationCache:
+    """
+    An LRU cache of recommendations, bounded by (approximate) memory.
+
+    Identical concurrent requests are coalesced: only the first computes the result, and the others wait for it.
+    The cached results are shared, so they should not be modified.
+    """
+
+    def __init__(self, max_bytes=16*1024*1024):
+        """
+        max_bytes       - maximal (approximate) total size of the cached results
+        """
+        self.max_bytes = max_bytes
+
+        self.entries = collections.OrderedDict()      # key -> (result, size), least recently used first
+        self.n_bytes = 0
+        self.in_flight = {}                           # key -> (threading.Event, {'result': ...} or {'error': ...})
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def _Size(self, result):
+        return len(cPickle.dumps(result, 2))
+
+    def Get(self, key, compute):
+        """
+        Return the cached result for the key, or compute it by calling compute() (and cache it).
+        """
+        with self.lock:
+            if self.entries.has_key(key):
+                self.hits += 1
+                entry = self.entries.pop(key)
+                self.entries[key] = entry
+                return entry[0]
+
+            if self.in_flight.has_key(key):
+                self.coalesced += 1
+                event, outcome = self.in_flight[key]
+                owner = False
+            else:
+                self.misses += 1
+                event, outcome = self.in_flight[key] = (threading.Event(), {})
+                owner = True
+
+        if not owner:
+            event.wait()
+            if outcome.has_key('error'):
+                raise outcome['error']
+            return outcome['result']
+
+        try:
+            result = compute()
+        except Exception, e:
+            outcome['error'] = e
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+            raise
+
+        outcome['result'] = result
+        size = self._Size(result)
+        with self.lock:
+            del self.in_flight[key]
+            if size <= self.max_bytes:
+                if self.entries.has_key(key):
+                    self.n_bytes -= self.entries.pop(key)[1]
+                self.entries[key] = (result, size)
+                self.n_bytes += size
+                while self.n_bytes > self.max_bytes:
+                    old_key, (old_result, old_size) = self.entries.popitem(last=False)
+                    self.n_bytes -= old_size
+        event.set()
+
+        return result
+
+    def Clear(self):
+        """
+        Remove all the cached results.
+        """
+        with self.lock:
+            self.entries = collections.OrderedDict()
+            self.n_bytes = 0
+
+    def Stats(self):
+        """
+        Return a dict with the hits/misses/coalesced counters, and the number and size of the entries.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced,
+                    'entries': len(self.entries), 'bytes': self.n_bytes}
+
+
 class Recommender:
 
+    _min_block_size = 8     # number of places to score at once (grows, up to _max_block_size)
+    _max_block_size = 256
+
     def __init__(self, places_recommender_data, weather_client, integration_sorter_class, integration_filter_class, recommender_system):
         self._places_recommender_data = places_recommender_data
         self._weather_client = weather_client
@@ -41,13 +146,169 @@ class Recommender:
 
         self._check_userid = False
 
+        # use geodesic distances (slow), instead of great-circle distances from the spatial index
+        self.exact_distances = False
+
+        # number of rating predictions the last Recommend could skip
+        self.n_skipped_predictions = 0
+
+        # results cache (see EnableCache)
+        self._cache = None
+
+    def EnableCache(self, cache=None, location_precision=3, time_bucket=15*60):
+        """
+        Cache the results of Recommend. Queries are considered the same if they have the same parameters, up to
+        rounding the location and bucketing the visit (and, with use_weather, current) times. Results are invalidated
+        when any of the data changes (see RecommenderData.Changed).
+
+        cache               - RecommendationCache object to use (can be shared between recommenders); default is a new one
+        location_precision  - number of digits after the point to round lat/long to (3 is ~100m)
+        time_bucket         - size of the time buckets (in seconds)
+        """
+        if cache == None:
+            cache = RecommendationCache()
+        self._cache = cache
+        self._cache_location_precision = location_precision
+        self._cache_time_bucket = time_bucket
+
+    def DisableCache(self):
+        self._cache = None
+
+    def Detach(self):
+        """
+        Stop the recommender system from following rating changes (when the recommender is no longer used).
+        """
+        if hasattr(self._recommender_system, 'Detach'):
+            self._recommender_system.Detach()
+
+    def _DataVersions(self):
+        return tuple([getattr(data, 'version', None) for data in (self._places_recommender_data,
+                                                                   getattr(self._recommender_system, 'users_recommender_data', None),
+                                                                   getattr(self._recommender_system, 'rating_recommender_data', None))])
+
+    def _CacheKey(self, query):
+        """
+        Return a key for the query (a dict of the parameters of Recommend), for the results cache.
+        """
+        def bucket(t):
+            if t == None:
+                return None
+            return int(t // self._cache_time_bucket)
+
+        key = dict(query)
+        if key['location'] != None:
+            key['location'] = tuple([round(x, self._cache_location_precision) for x in key['location']])
+        key['visit_time'] = bucket(key['visit_time'])
+        key['visit_end_time'] = bucket(key['visit_end_time'])
+        if key['use_only_ids'] != None:
+            key['use_only_ids'] = tuple(sorted(key['use_only_ids']))
+        if key['use_weather']:
+            key['now'] = bucket(time.time())
+
+        return (self.__class__.__name__, id(self._recommender_system), self._DataVersions(), tuple(sorted(key.items())))
+
 
 
     def _Distance(self, latlong1, latlong2):
         if latlong1 == None or latlong2 == None:
             return 0
         return geopy.distance.distance(latlong1, latlong2).m
+
+    def _Distances(self, placeids, location):
+        """
+        Return an array of the distances (in m) from the location to the places (0 where unknown).
+        """
+        if location == None:
+            return numpy.zeros(len(placeids))
+
+        if self.exact_distances:
+            return numpy.array([self._Distance(self._places_recommender_data[uid]['latlong'], location) for uid in placeids], dtype=float)
+
+        distances = self._places_recommender_data.SpatialIndex().Distances(location, placeids) * 1000.0
+        distances[numpy.isnan(distances)] = 0
+        return distances
         
+    def _TopN(self, userid, placeids, distances, n_items, required_radius, integration_sorter, integration_filter):
+        """
+        Return the n_items best scored places (by score, and then by their order in placeids) which pass
+        the expensive predicates of the integration filter, predicting as few ratings as possible.
+
+        If the sorter can bound the score by the distance (ScoreBound), places are scored by increasing distance,
+        and the search stops once no farther place can beat the n_items-th best one.
+
+        Returns (the IDs of the best places, {place ID: (ID, name, distance (km), predicted rating)} for the places
+        which were scored, the number of places which were not scored).
+
+        (The state of a query is kept in locals, so queries can run concurrently.)
+        """
+        order = numpy.argsort(distances, kind='mergesort')
+        bounds = integration_sorter.ScoreBound(distance=distances[order], max_rating=self._recommender_system._max_rating, required_radius=required_radius)
+        if bounds is None:
+            bounds = numpy.zeros(len(order)) + numpy.inf
+
+        aux_data = {}
+
+        top = []                # a heap of the n_items best (score, -position) scored so far
+        scored = []             # (-score, position) of all the places scored so far
+        passed = {}             # position -> whether it passed the expensive predicates
+        n_scored = 0
+        block_size = max(n_items, self._min_block_size)
+
+        while True:
+            #
+            # Check if farther places can still make it
+            #
+            if n_scored == len(order) or (len(top) >= n_items and bounds[n_scored] < top[0][0]):
+                best, threshold = self._Accept(placeids, scored, passed, n_items, integration_filter)
+                if n_scored == len(order) or (len(best) >= n_items and bounds[n_scored] < threshold):
+                    break
+
+            #
+            # Score the next block of places
+            #
+            block = order[n_scored:n_scored + block_size]
+            n_scored += len(block)
+            block_size = min(2 * block_size, self._max_block_size)
+
+            block_placeids = [placeids[position] for position in block]
+            ratings = self._recommender_system.PredictRatings(userid, block_placeids, True)
+            scores = integration_sorter.Score(distance=distances[block], rating=ratings, required_radius=required_radius)
+
+            for position, uid, rating, score in zip(block, block_placeids, ratings, scores):
+                aux_data[uid] = (uid, self._places_recommender_data[uid]['raw']['wineryname'], distances[position] / 1000.0, rating)
+
+                scored.append((-score, position))
+                if len(top) < n_items:
+                    heapq.heappush(top, (score, -position))
+                elif (score, -position) > top[0]:
+                    heapq.heapreplace(top, (score, -position))
+
+        return [placeids[position] for position in best], aux_data, len(order) - n_scored
+
+    def _Accept(self, placeids, scored, passed, n_items, integration_filter):
+        """
+        Go over the scored places from the best, checking the expensive predicates (only once for each place),
+        until n_items pass. Return the positions of those which passed, and the score of the worst of them
+        (-inf if there are not enough).
+        """
+        ranked = sorted(scored)
+
+        best = []
+        n_checked = 0
+        while len(best) < n_items and n_checked < len(ranked):
+            batch = [position for minus_score, position in ranked[n_checked:n_checked + n_items - len(best)]]
+            n_checked += len(batch)
+
+            to_check = [position for position in batch if not passed.has_key(position)]
+            for position, add_item in zip(to_check, integration_filter.FilterExpensive([self._places_recommender_data[placeids[position]] for position in to_check])):
+                passed[position] = add_item
+
+            best += [position for position in batch if passed[position]]
+
+        if len(best) < n_items:
+            return best, -numpy.inf
+        return best, -ranked[n_checked - 1][0]
+
     def _LegalLatlong(self, latlong):
         if len(latlong) != 2:
             return False
@@ -80,6 +341,7 @@ class Recommender:
                   visiting_center = None,
                   visiting_center_free_admission = None,
                   visit_time = None,
+                  visit_end_time = None,
                   use_weather = False,
                   use_only_ids = None
                  ):
@@ -87,7 +349,8 @@ class Recommender:
         Recommend a winery according to the specified parameters.
         
         userid      - The user ID according to which to recommend (default is empty)
-        required_radius     - The radius which is considered "reasonable" for the query
+        required_radius     - The radius (in km) which is considered "reasonable" for the query; places
+                              farther than that from the location are not recommended (0 means no limit)
 
         n_items     - The number of items to recommend (1 or more)
         location    - a lat/long tuple, around which to search; can be None
@@ -99,10 +362,56 @@ class Recommender:
         visiting_center_free_admission -    True if a free visiting center is reuiqred, False or None else
         visit_time          - Time around which to time your visit; given in seconds since epoch; can be None (and be ignored)
                               e.g., for the current time; give time.time()
+        visit_end_time      - Time at which the visit ends (seconds since epoch); if given with visit_time, only places
+                              open during the whole window are recommended; can be None
         use_weather         - Use current weather conditions to filter out places (True/False, default is False)
 
         use_only_ids        - (debugging) Pretend only these place IDs exist.
+
+        (If the cache is enabled, see EnableCache, the results may come from the cache.)
         """        
+        query = dict(n_items = n_items,
+                     userid = userid,
+                     required_radius = required_radius,
+                     location = location,
+                     size = size,
+                     expert_rank = expert_rank,
+                     kosher = kosher,
+                     visiting_center = visiting_center,
+                     visiting_center_free_admission = visiting_center_free_admission,
+                     visit_time = visit_time,
+                     visit_end_time = visit_end_time,
+                     use_weather = use_weather,
+                     use_only_ids = use_only_ids)
+
+        if self._cache == None:
+            results, self.n_skipped_predictions = self._Recommend(**query)
+            return results
+
+        # (the statistics of the call are cached with its results; the cached results are shared, so return copies)
+        results, self.n_skipped_predictions = self._cache.Get(self._CacheKey(query), lambda: self._Recommend(**query))
+        return [NiceList(result, result.fields) for result in results]
+
+    def _Recommend(self,
+                   n_items,
+                   userid,
+                   required_radius,
+                   location,
+                   size,
+                   expert_rank,
+                   kosher,
+                   visiting_center,
+                   visiting_center_free_admission,
+                   visit_time,
+                   visit_end_time,
+                   use_weather,
+                   use_only_ids
+                  ):
+        """
+        Recommend (without the cache); see Recommend.
+
+        Return the results, and the number of rating predictions that could be skipped.
+        """
         
         #
         # Make sure the input is legal
@@ -129,44 +438,49 @@ class Recommender:
         #
         # Create sorter and integrator
         #
-        self._integration_sorter = self._integration_sorter_class()
-        self._integration_filter = self._integration_filter_class(  size = size,
-                                                                  expert_rank = expert_rank,
-                                                                  kosher = kosher,
-                                                                  visiting_center = visiting_center,
-                                                                  visiting_center_free_admission = visiting_center_free_admission,
-                                                                  visit_time = visit_time,
-                                                                  use_weather = use_weather,
-                                                                  use_only_ids = use_only_ids,                                                                  
-                                                                  weather_client = self._weather_client)
+        integration_sorter = self._integration_sorter_class()
+        integration_filter = self._integration_filter_class(  size = size,
+                                                              expert_rank = expert_rank,
+                                                              kosher = kosher,
+                                                              visiting_center = visiting_center,
+                                                              visiting_center_free_admission = visiting_center_free_admission,
+                                                              visit_time = visit_time,
+                                                              visit_end_time = visit_end_time,
+                                                              use_weather = use_weather,
+                                                              use_only_ids = use_only_ids,                                                                  
+                                                              weather_client = self._weather_client)
 
             
         #
-        # Filter all irrelevant places
+        # Filter all irrelevant places (first all at once on the columns, then one by one by the cheap predicates)
         #
+        columns = self._places_recommender_data.Columns()
+        mask = integration_filter.Mask(columns)
+
+        # only consider places within the required radius (if given); in the order of the columns, as without
+        # a radius (ties are broken by it)
+        if (location != None) and required_radius:
+            positions = numpy.sort(columns.Positions([uid for uid, distance in self._places_recommender_data.SpatialIndex().WithinRadius(location, required_radius)]))
+            candidate_places = columns.placeids[positions[mask[positions]]]
+        else:
+            candidate_places = columns.placeids[mask]
+
         relevant_places = []
         
-        for uid, info in self._places_recommender_data.data.iteritems():          
-            if self._integration_filter.Filter(info):
+        for uid in candidate_places:
+            if integration_filter.FilterRemaining(self._places_recommender_data[uid]):
                 relevant_places.append(uid)
                 
         #
-        # Sort all relevant places
+        # Find the best places
         #
-        self._scores = {}
-        self._aux_data = {}
-        for uid in relevant_places:
+        distances = self._Distances(relevant_places, location)
+        best, aux_data, n_skipped_predictions = self._TopN(userid, relevant_places, distances, n_items, required_radius,
+                                                           integration_sorter, integration_filter)
 
-            distance    = self._Distance(self._places_recommender_data[uid]['latlong'], location)                    
-            rating      = self._recommender_system.PredictRating(userid, uid, True)            
-                
-            self._aux_data[uid] = (uid, self._places_recommender_data[uid]['raw']['wineryname'], distance / 1000.0, rating)
-            self._scores[uid] = self._integration_sorter.Score(distance=distance, rating=rating, required_radius=required_radius)
-        
-        best = sorted(relevant_places, key=lambda uid: self._scores[uid], reverse=True)[:n_items]
-        with_data = [NiceList(self._aux_data[b], ["ID", "Name", "Distance (km)", "Predicted Rating"]) for b in best] 
+        with_data = [NiceList(aux_data[b], ["ID", "Name", "Distance (km)", "Predicted Rating"]) for b in best] 
                         
-        return with_data
+        return with_data, n_skipped_predictions
 
 
 
@@ -257,7 +571,7 @@ class PearsonRecommender(Recommender):
                              weather_client                     = weather_client,
                              integration_sorter_class           = integration.LinearIntegratorSorter,
                              integration_filter_class           = integration.BasicIntegratorFilter,
-                             recommender_system                 = recommender_systems.user_based.PearsonRecommenderSystem(
+                             recommender_system                 = recommender_systems.base.SHARED_MODELS.Get(recommender_systems.user_based.PearsonRecommenderSystem,
                                                                     places_recommender_data,
                                                                     users_recommender_data,
                                                                     rating_recommender_data)
@@ -282,7 +596,7 @@ class TFIDFRecommender(Recommender):
                              weather_client                     = weather_client,
                              integration_sorter_class           = integration.LinearIntegratorSorter,
                              integration_filter_class           = integration.BasicIntegratorFilter,
-                             recommender_system                 = recommender_systems.item_based.TFIDFRecommenderSystem(
+                             recommender_system                 = recommender_systems.base.SHARED_MODELS.Get(recommender_systems.item_based.TFIDFRecommenderSystem,
                                                                     places_recommender_data,
                                                                     users_recommender_data,
                                                                     rating_recommender_data, 
@@ -303,12 +617,12 @@ class HybridLinearRecommender(Recommender):
                  rating_recommender_data, 
                  weather_client=None):
         
-        collab_rs = recommender_systems.user_based.PearsonRecommenderSystem(
+        collab_rs = recommender_systems.base.SHARED_MODELS.Get(recommender_systems.user_based.PearsonRecommenderSystem,
                                                                     places_recommender_data,
                                                                     users_recommender_data,
                                                                     rating_recommender_data)
 
-        content_rs = recommender_systems.item_based.TFIDFRecommenderSystem(
+        content_rs = recommender_systems.base.SHARED_MODELS.Get(recommender_systems.item_based.TFIDFRecommenderSystem,
                                                                     places_recommender_data,
                                                                     users_recommender_data,
                                                                     rating_recommender_data, 
@@ -338,7 +652,7 @@ class HybridAugmentedRecommender(Recommender):
                  rating_recommender_data, 
                  weather_client=None):
         
-        collab_rs = recommender_systems.user_based.PearsonRecommenderSystem(
+        collab_rs = recommender_systems.base.SHARED_MODELS.Get(recommender_systems.user_based.PearsonRecommenderSystem,
                                                                     places_recommender_data,
                                                                     users_recommender_data,
                                                                     rating_recommender_data)
@@ -384,3 +698,87 @@ class DemographicRecommender(Recommender):
            
         self._check_userid = True
 
+
+
+__all__.append('RecommenderRegistry')
+class RecommenderRegistry:
+    """
+    Recommenders by name, each built (once) when first used.
+
+    Use like this:
+
+    >>> R = RecommenderRegistry()
+    >>> R.Register('SW', lambda: SimpleWineryRecommender(RD_places, WEATHER))
+    >>> SW = R.Lazy('SW')
+    >>> SW.Recommend(...)           # (builds the recommender)
+    """
+
+    def __init__(self):
+        self.builders = collections.OrderedDict()      # name -> function which builds the recommender
+        self.built = {}
+        self.lock = threading.RLock()                  # (a builder can use other recommenders)
+
+    def Register(self, name, build):
+        """
+        name    - The name of the recommender
+        build   - A function (with no arguments) which returns the recommender
+        """
+        with self.lock:
+            self.builders[name] = build
+            old_recommender = self.built.pop(name, None)
+            if hasattr(old_recommender, 'Detach'):
+                old_recommender.Detach()
+
+    def __getitem__(self, name):
+        """
+        Return the recommender, building it if it was not built yet.
+        """
+        recommender = self.built.get(name)
+        if recommender != None:
+            return recommender
+        with self.lock:
+            if not self.built.has_key(name):
+                self.built[name] = self.builders[name]()
+            return self.built[name]
+
+    def Names(self):
+        return self.builders.keys()
+
+    def IsBuilt(self, name):
+        return self.built.has_key(name)
+
+    def Lazy(self, name):
+        """
+        Return a LazyRecommender for the name (which can be used as the recommender itself).
+        """
+        if not self.builders.has_key(name):
+            raise KeyError(name)
+        return LazyRecommender(self, name)
+
+
+__all__.append('LazyRecommender')
+class LazyRecommender:
+    """
+    Stands for a recommender of a RecommenderRegistry; the recommender is built when one of its attributes
+    is first used (e.g., Recommend).
+    """
+
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+
+    def Get(self):
+        """
+        Return the recommender itself.
+        """
+        return self._registry[self._name]
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.Get(), name)
+
+    def __repr__(self):
+        if self._registry.IsBuilt(self._name):
+            return repr(self.Get())
+        return "<lazy recommender %s>" % self._name
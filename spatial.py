@@ -0,0 +1,179 @@
+#
+# Spatial index
+#
+__all__ = []
+__author__ = "Regev S"
+
+# Python imports
+import math
+import heapq
+import numpy
+
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+
+
+__all__.append('haversine')
+def haversine(latlong, latitudes, longitudes):
+    """
+    Great-circle distances (in km) from a point to many points.
+
+    latlong     - latitude/longitude of the point (in degrees)
+    latitudes   - array of latitudes of the other points (in degrees)
+    longitudes  - array of longitudes of the other points (in degrees)
+    """
+    lat1 = math.radians(latlong[0])
+    lon1 = math.radians(latlong[1])
+    lat2 = numpy.radians(latitudes)
+    lon2 = numpy.radians(longitudes)
+
+    a = numpy.sin((lat2 - lat1) / 2)**2 + math.cos(lat1) * numpy.cos(lat2) * numpy.sin((lon2 - lon1) / 2)**2
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(numpy.minimum(a, 1.0)))
+
+
+__all__.append('PlacesSpatialIndex')
+class PlacesSpatialIndex:
+    """
+    A grid index over the lat/long of places, for "all places within R km" and "k nearest places" queries.
+    Distances are great-circle (haversine) distances in km. Places without a latlong are not indexed.
+
+    Use like this:
+
+    >>> S = PlacesSpatialIndex(places_recommender_data)
+    >>> S.WithinRadius((31.768862, 35.203856), 20)
+    [('12', 3.2), ('7', 15.1)]
+    >>> S.Nearest((31.768862, 35.203856), 1)
+    [('12', 3.2)]
+    """
+
+    _cell_size = 0.1        # (in degrees)
+
+    def __init__(self, places_recommender_data):
+        """
+        places_recommender_data    - PlacesRecommenderData object with the places to index
+        """
+        self.places_recommender_data = places_recommender_data
+        self.Rebuild()
+
+    def Rebuild(self):
+        """
+        Rebuild the index from the current latlong values.
+        """
+        self.placeids = []
+        latlongs = []
+        for uid in self.places_recommender_data.keys():
+            latlong = self.places_recommender_data[uid]['latlong']
+            if latlong != None:
+                self.placeids.append(uid)
+                latlongs.append(latlong)
+
+        latlongs = numpy.array(latlongs, dtype=float).reshape((len(latlongs), 2))
+        self.latitudes = latlongs[:, 0]
+        self.longitudes = latlongs[:, 1]
+        self.positions = dict((uid, position) for position, uid in enumerate(self.placeids))
+
+        # the positions of the places in each cell
+        self.cells = {}
+        for position, cell in enumerate(zip(*self._Cell(self.latitudes, self.longitudes))):
+            self.cells.setdefault(cell, []).append(position)
+        for cell in self.cells:
+            self.cells[cell] = numpy.array(self.cells[cell], dtype=int)
+
+        # the (non empty) cells as arrays, to find their rings around a point at once
+        cells = self.cells.keys()
+        self.cell_rows = numpy.array([i for i, j in cells], dtype=int)
+        self.cell_columns = numpy.array([j for i, j in cells], dtype=int)
+        self.cell_positions = [self.cells[cell] for cell in cells]
+
+    def _Cell(self, latitude, longitude):
+        return (numpy.floor(numpy.asarray(latitude) / self._cell_size).astype(int),
+                numpy.floor(numpy.asarray(longitude) / self._cell_size).astype(int))
+
+    def _RingDistanceBound(self, latlong, ring):
+        """
+        A lower bound (in km) on the distance from latlong to any place beyond the given ring.
+        """
+        # the places beyond the ring are at least 'ring' cells away, in latitude or in longitude
+        # (the longitude distance is the smallest at the highest latitude the band reaches)
+        max_latitude = min(90.0, abs(latlong[0]) + (ring + 1) * self._cell_size)
+        latitude_bound = ring * self._cell_size * KM_PER_DEGREE
+        longitude_bound = haversine((max_latitude, 0.0), [max_latitude], [ring * self._cell_size])[0]
+        return min(latitude_bound, longitude_bound) * 0.999
+
+    def IterNearest(self, latlong, max_distance=None):
+        """
+        Generate (placeid, distance in km) for all the indexed places, by increasing distance from latlong.
+
+        Optional:
+        max_distance    - Only places up to this distance (in km) are needed; farther cells are not searched
+                          (but some farther places may still be generated)
+        """
+        if len(self.cell_positions) == 0:
+            return
+
+        # the ring of each non empty cell around the center cell (only these rings are searched)
+        i0, j0 = [int(x) for x in self._Cell(latlong[0], latlong[1])]
+        rings = numpy.maximum(numpy.abs(self.cell_rows - i0), numpy.abs(self.cell_columns - j0))
+        order = numpy.argsort(rings, kind='mergesort')
+        rings = rings[order]
+
+        heap = []
+        n = 0
+        while n < len(order):
+            ring = rings[n]
+
+            # the places in this ring and beyond are at least this far
+            if max_distance != None and ring > 0 and self._RingDistanceBound(latlong, ring - 1) > max_distance:
+                break
+
+            end = n + numpy.searchsorted(rings[n:], ring, 'right')
+            positions = numpy.concatenate([self.cell_positions[cell] for cell in order[n:end]])
+            distances = haversine(latlong, self.latitudes[positions], self.longitudes[positions])
+            for distance, position in zip(distances, positions):
+                heapq.heappush(heap, (distance, position))
+            n = end
+
+            # everything closer than the next non empty ring can already be given
+            if n < len(order):
+                bound = self._RingDistanceBound(latlong, rings[n] - 1)
+                while heap and heap[0][0] <= bound:
+                    distance, position = heapq.heappop(heap)
+                    yield self.placeids[position], distance
+
+        while heap:
+            distance, position = heapq.heappop(heap)
+            yield self.placeids[position], distance
+
+    def Distances(self, latlong, placeids):
+        """
+        Return an array of the distances (in km) from latlong to the given places (nan for places without a latlong).
+        """
+        positions = numpy.array([self.positions.get(uid, -1) for uid in placeids], dtype=int)
+        distances = numpy.zeros(len(positions)) + numpy.nan
+
+        indexed = (positions >= 0)
+        distances[indexed] = haversine(latlong, self.latitudes[positions[indexed]], self.longitudes[positions[indexed]])
+        return distances
+
+    def WithinRadius(self, latlong, radius_km):
+        """
+        Return a list of (placeid, distance in km) of all the places within radius_km of latlong, by increasing distance.
+        """
+        results = []
+        for placeid, distance in self.IterNearest(latlong, radius_km):
+            if distance > radius_km:
+                break
+            results.append((placeid, distance))
+        return results
+
+    def Nearest(self, latlong, k):
+        """
+        Return a list of (placeid, distance in km) of the k places nearest to latlong, by increasing distance.
+        """
+        results = []
+        for placeid, distance in self.IterNearest(latlong):
+            if len(results) >= k:
+                break
+            results.append((placeid, distance))
+        return results
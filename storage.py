@@ -0,0 +1,615 @@
+#
+# Columnar storage of recommendation data
+#
+__all__ = []
+__author__ = "Regev S"
+
+# Python imports
+import os
+import os.path
+import shutil
+import json
+import cPickle
+import numpy
+
+
+FORMAT = "dtour-columnar"
+FORMAT_VERSION = 1
+
+# Marks a field which is missing from a record
+MISSING = object()
+
+
+#
+# Writing
+#
+
+class _TableWriter:
+    """
+    Encodes records into typed columns (see WriteTable).
+    """
+
+    def __init__(self):
+        self.strings = []
+        self.string_index = {}
+        self.arrays = {}
+        self.objects = []
+
+    def String(self, s):
+        if not self.string_index.has_key(s):
+            self.string_index[s] = len(self.strings)
+            self.strings.append(s)
+        return self.string_index[s]
+
+    def Array(self, array):
+        name = "c%d.npy" % len(self.arrays)
+        self.arrays[name] = array
+        return name
+
+    def _Kind(self, values):
+        """
+        Return the type of a column, by its (non None, non missing) values.
+        """
+        if len(values) == 0:
+            return 'none'
+        if all([isinstance(v, bool) for v in values]):
+            return 'bool'
+        if all([isinstance(v, (int, long)) and not isinstance(v, bool) and abs(v) < 2**53 for v in values]):
+            return 'int'
+        if all([isinstance(v, float) for v in values]):
+            return 'float'
+        if all([isinstance(v, str) for v in values]):
+            return 'str'
+        if all([isinstance(v, unicode) for v in values]):
+            return 'unicode'
+        if all([isinstance(v, tuple) and len(v) == 2 and all([isinstance(x, float) for x in v]) for v in values]):
+            return 'pair'
+        if all([isinstance(v, dict) for v in values]):
+            return 'dict'
+        return 'object'
+
+    def Column(self, name, values):
+        """
+        Encode a column of values (some may be MISSING) and return its description.
+        """
+        column = {'name': name}
+
+        if any([v is MISSING for v in values]):
+            column['present'] = self.Array(numpy.array([v is not MISSING for v in values], dtype=bool))
+        values = [(None if v is MISSING else v) for v in values]
+
+        kind = column['type'] = self._Kind([v for v in values if v != None])
+
+        if kind == 'bool':
+            column['values'] = self.Array(numpy.array([{True: 1, False: 0}.get(v, -1) for v in values], dtype=numpy.int8))
+
+        elif kind in ['int', 'float']:
+            column['values'] = self.Array(numpy.array([(numpy.nan if v == None else v) for v in values], dtype=float))
+
+        elif kind == 'pair':
+            column['values'] = self.Array(numpy.array([((numpy.nan, numpy.nan) if v == None else v) for v in values], dtype=float).reshape((len(values), 2)))
+
+        elif kind in ['str', 'unicode']:
+            column['values'] = self.Array(numpy.array([(-1 if v == None else self.String(v)) for v in values], dtype=numpy.int32))
+
+        elif kind == 'dict':
+            column['none'] = self.Array(numpy.array([v == None for v in values], dtype=bool))
+            subkeys = sorted(set([k for v in values if v != None for k in v.keys()]))
+            column['children'] = [self.Column(k, [(MISSING if v == None else v.get(k, MISSING)) for v in values]) for k in subkeys]
+
+        elif kind == 'object':
+            column['values'] = len(self.objects)
+            self.objects.append(values)
+
+        return column
+
+    def Write(self, path, keys, records, blob_fields):
+        """
+        Write the table into a new directory at path.
+        """
+        os.mkdir(path)
+
+        arity = 1
+        if len(keys) > 0 and isinstance(keys[0], tuple):
+            arity = len(keys[0])
+        key_columns = zip(*keys) if arity > 1 else [keys]
+        key_columns = key_columns or [[] for n in xrange(arity)]
+
+        fields = sorted(set([k for record in records for k in record.keys()]))
+
+        header = {'format': FORMAT,
+                  'version': FORMAT_VERSION,
+                  'n_records': len(records),
+                  'keys': [self.Column('key%d' % n, list(column)) for n, column in enumerate(key_columns)],
+                  'arity': arity,
+                  'columns': [self.Column(field, [record.get(field, MISSING) for record in records]) for field in fields if field not in blob_fields],
+                  'blob_fields': [field for field in fields if field in blob_fields]}
+
+        # the blob fields are kept apart, and only loaded when needed
+        blob = {}
+        header['blob_present'] = {}
+        for field in header['blob_fields']:
+            blob[field] = [_Resolve(record.get(field)) for record in records]
+            if any([not record.has_key(field) for record in records]):
+                header['blob_present'][field] = self.Array(numpy.array([record.has_key(field) for record in records], dtype=bool))
+        _WriteFile(os.path.join(path, "blob.pcl"), lambda f: cPickle.dump(blob, f, -1))
+        _WriteFile(os.path.join(path, "objects.pcl"), lambda f: cPickle.dump(self.objects, f, -1))
+
+        # string table: utf-8 bytes and offsets
+        encoded = [(s.encode('utf-8') if isinstance(s, unicode) else s) for s in self.strings]
+        offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum([len(s) for s in encoded])
+        _WriteFile(os.path.join(path, "string_offsets.npy"), lambda f: numpy.save(f, offsets))
+        _WriteFile(os.path.join(path, "strings.npy"), lambda f: numpy.save(f, numpy.frombuffer(''.join(encoded), dtype=numpy.uint8)))
+
+        for name, array in self.arrays.iteritems():
+            _WriteFile(os.path.join(path, name), lambda f: numpy.save(f, array))
+
+        # the header is written last (once the rest is on the disk) - a directory without it is not a table
+        _WriteFile(os.path.join(path, "header.json"), lambda f: json.dump(header, f, indent=1))
+        _SyncDirectory(path)
+
+
+def _WriteFile(path, write):
+    """
+    Write a file by calling write(f), and make sure it is on the disk.
+    """
+    f = file(path, 'wb')
+    try:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+
+def _SyncDirectory(path):
+    """
+    Make sure the entries of a directory (e.g., renames in it) are on the disk.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # (directories cannot be opened on some systems, e.g., windows)
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+__all__.append('WriteTable')
+def WriteTable(path, keys, records, blob_fields=('raw',)):
+    """
+    Write records into a columnar table (a directory), replacing the table at path if there is one.
+
+    Keys are strings, or tuples of strings (of the same length); records are dicts. Each field is stored as
+    a typed column (bools, ints, floats, lat/long pairs, strings in a string table, or nested dicts of these);
+    other values are pickled. The blob fields (e.g., the raw spreadsheet rows) are stored apart, and are only
+    loaded when accessed.
+
+    path            - path of the table directory
+    keys            - list of keys
+    records         - list of dicts, one for each key
+    blob_fields     - names of the fields to store in the blob
+    """
+    path = os.path.abspath(path)
+    new_path = path + ".new"
+    old_path = path + ".old"
+
+    for p in [new_path, old_path]:
+        if os.path.exists(p):
+            shutil.rmtree(p)
+
+    _TableWriter().Write(new_path, keys, records, blob_fields)
+
+    # (if this is interrupted, _Recover finishes or undoes it)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(new_path, path)
+
+    # (the new table must be in place before the caller removes the journal)
+    _SyncDirectory(os.path.dirname(path))
+
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def _Recover(path):
+    """
+    Bring back the table at path if WriteTable was interrupted while replacing it.
+    """
+    path = os.path.abspath(path)
+    new_path = path + ".new"
+    old_path = path + ".old"
+
+    if not os.path.exists(path):
+        # (a complete new table replaces the old one - or is the first one)
+        if _HasHeader(new_path):
+            os.rename(new_path, path)
+        elif os.path.exists(old_path):
+            os.rename(old_path, path)
+        _SyncDirectory(os.path.dirname(path))
+
+    if _HasHeader(path) and os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def _HasHeader(path):
+    return os.path.exists(os.path.join(path, "header.json"))
+
+
+#
+# Journal
+#
+
+__all__.append('AppendJournal')
+def AppendJournal(path, entries):
+    """
+    Append entries (picklable objects) to a journal file, and make sure they are on the disk.
+    """
+    f = file(path, 'ab')
+    try:
+        for entry in entries:
+            cPickle.dump(entry, f, -1)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+
+__all__.append('ReadJournal')
+def ReadJournal(path):
+    """
+    Return the list of entries in a journal file (empty if there is no such file). A partly written
+    entry at the end (e.g., after a crash) is dropped from the file.
+    """
+    if not os.path.exists(path):
+        return []
+
+    entries = []
+    f = file(path, 'rb')
+    try:
+        while True:
+            position = f.tell()
+            try:
+                entries.append(cPickle.load(f))
+            except EOFError:
+                break
+            except Exception:
+                f.close()
+                f = file(path, 'r+b')
+                f.truncate(position)
+                break
+    finally:
+        f.close()
+
+    return entries
+
+
+__all__.append('RemoveJournal')
+def RemoveJournal(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+#
+# Reading
+#
+
+__all__.append('IsTable')
+def IsTable(path):
+    """
+    Return whether there is a table at path.
+    """
+    _Recover(path)
+    return _HasHeader(path)
+
+
+__all__.append('Table')
+class Table:
+    """
+    A columnar table written by WriteTable. The columns are memory mapped; the blob is loaded on first use.
+
+    Use like this:
+
+    >>> T = Table("data/places_db.store")
+    >>> T.Keys()[:2]
+    ['766cff27a26d9ba5', 'c47f34205c8c29eb']
+    >>> T.Column('size')
+    memmap([ 2.,  1., ...])
+    >>> T.Records()[0]['raw']['wineryname']
+    'Nachshon Winery'
+    """
+
+    def __init__(self, path):
+        """
+        path    - path of the table directory
+        """
+        self.path = path
+        self.header = json.load(file(os.path.join(path, "header.json")), object_hook=_AsciiNames)
+
+        if self.header['format'] != FORMAT or self.header['version'] > FORMAT_VERSION:
+            raise ValueError("%s: unsupported table format %s, version %s" % (path, self.header['format'], self.header['version']))
+
+        self.n_records = self.header['n_records']
+
+        self._arrays = {}
+        self._strings = None
+        self._objects = None
+        self._blob = None
+        self._index = None
+
+    def __len__(self):
+        return self.n_records
+
+    def _Array(self, name):
+        if not self._arrays.has_key(name):
+            array = numpy.load(os.path.join(self.path, name), mmap_mode='r')
+            if array.size == 0:
+                # (empty arrays cannot be memory mapped)
+                array = numpy.load(os.path.join(self.path, name))
+            self._arrays[name] = array
+        return self._arrays[name]
+
+    def _String(self, n):
+        if self._strings == None:
+            self._strings = (self._Array("strings.npy"), self._Array("string_offsets.npy"))
+        data, offsets = self._strings
+        return data[offsets[n]:offsets[n + 1]].tostring()
+
+    def _Objects(self):
+        if self._objects == None:
+            self._objects = cPickle.load(file(os.path.join(self.path, "objects.pcl"), 'rb'))
+        return self._objects
+
+    def Blob(self):
+        """
+        Return the blob fields, as a dict from field name to a list of values (loaded on first use).
+        """
+        if self._blob == None:
+            self._blob = cPickle.load(file(os.path.join(self.path, "blob.pcl"), 'rb'))
+        return self._blob
+
+    def _Find(self, name):
+        for column in self.header['columns']:
+            if column['name'] == name:
+                return column
+        raise KeyError(name)
+
+    def Column(self, name):
+        """
+        Return the (memory mapped) array of a column of bools (1/0/-1 for True/False/None), ints or floats (nan for None),
+        lat/long pairs (n x 2, nan for None) or strings (indices in the string table, -1 for None).
+        """
+        return self._Array(self._Find(name)['values'])
+
+    def _Decode(self, column):
+        """
+        Return the list of values of a column (MISSING where missing).
+        """
+        kind = column['type']
+
+        if kind == 'none':
+            values = [None] * self.n_records
+
+        elif kind == 'bool':
+            values = [{1: True, 0: False}.get(v) for v in self._Array(column['values']).tolist()]
+
+        elif kind == 'int':
+            values = [(None if v != v else int(v)) for v in self._Array(column['values']).tolist()]
+
+        elif kind == 'float':
+            values = [(None if v != v else v) for v in self._Array(column['values']).tolist()]
+
+        elif kind == 'pair':
+            values = [(None if v[0] != v[0] else tuple(v)) for v in self._Array(column['values']).tolist()]
+
+        elif kind in ['str', 'unicode']:
+            strings = {}
+            values = []
+            for n in self._Array(column['values']).tolist():
+                if n == -1:
+                    values.append(None)
+                    continue
+                if not strings.has_key(n):
+                    strings[n] = self._String(n)
+                    if kind == 'unicode':
+                        strings[n] = strings[n].decode('utf-8')
+                values.append(strings[n])
+
+        elif kind == 'dict':
+            children = [(child['name'], self._Decode(child)) for child in column['children']]
+            values = []
+            for n, none in enumerate(self._Array(column['none']).tolist()):
+                if none:
+                    values.append(None)
+                else:
+                    values.append(dict((name, child_values[n]) for name, child_values in children if child_values[n] is not MISSING))
+
+        elif kind == 'object':
+            values = list(self._Objects()[column['values']])
+
+        else:
+            raise ValueError("%s: unknown column type %s" % (self.path, kind))
+
+        if column.has_key('present'):
+            values = [(v if present else MISSING) for v, present in zip(values, self._Array(column['present']).tolist())]
+
+        return values
+
+    def _DecodeOne(self, column, n):
+        """
+        Return the value of a column in record n (MISSING if missing), like _Decode.
+        """
+        if column.has_key('present') and not self._Array(column['present'])[n]:
+            return MISSING
+
+        kind = column['type']
+
+        if kind == 'none':
+            return None
+
+        elif kind == 'bool':
+            return {1: True, 0: False}.get(int(self._Array(column['values'])[n]))
+
+        elif kind in ['int', 'float']:
+            v = float(self._Array(column['values'])[n])
+            if v != v:
+                return None
+            return int(v) if kind == 'int' else v
+
+        elif kind == 'pair':
+            v = self._Array(column['values'])[n].tolist()
+            if v[0] != v[0]:
+                return None
+            return tuple(v)
+
+        elif kind in ['str', 'unicode']:
+            i = int(self._Array(column['values'])[n])
+            if i == -1:
+                return None
+            if kind == 'unicode':
+                return self._String(i).decode('utf-8')
+            return self._String(i)
+
+        elif kind == 'dict':
+            if self._Array(column['none'])[n]:
+                return None
+            values = [(child['name'], self._DecodeOne(child, n)) for child in column['children']]
+            return dict((name, value) for name, value in values if value is not MISSING)
+
+        elif kind == 'object':
+            return self._Objects()[column['values']][n]
+
+        else:
+            raise ValueError("%s: unknown column type %s" % (self.path, kind))
+
+    def Keys(self):
+        """
+        Return the list of keys.
+        """
+        key_columns = [self._Decode(column) for column in self.header['keys']]
+        if self.header['arity'] == 1:
+            return key_columns[0]
+        return zip(*key_columns)
+
+    def Index(self):
+        """
+        Return a dict from each key to the number of its record (built on first use).
+        """
+        if self._index == None:
+            self._index = dict((key, n) for n, key in enumerate(self.Keys()))
+        return self._index
+
+    def Record(self, n):
+        """
+        Return record number n (a dict, as in Records), decoding only its values.
+        """
+        values = [(column['name'], self._DecodeOne(column, n)) for column in self.header['columns']]
+        record = dict((name, value) for name, value in values if value is not MISSING)
+        for field in self.header['blob_fields']:
+            if self._BlobPresent(field)[n]:
+                record[field] = LazyBlobValue(self, field, n)
+        return record
+
+    def Records(self):
+        """
+        Return the list of records (dicts), in the order of the keys. The blob fields are LazyBlobValue objects.
+        """
+        columns = [(column['name'], self._Decode(column)) for column in self.header['columns']]
+
+        blob_present = [(field, self._BlobPresent(field).tolist()) for field in self.header['blob_fields']]
+
+        records = []
+        for n in xrange(self.n_records):
+            record = dict((name, values[n]) for name, values in columns if values[n] is not MISSING)
+            for field, present in blob_present:
+                if present[n]:
+                    record[field] = LazyBlobValue(self, field, n)
+            records.append(record)
+
+        return records
+
+    def _BlobPresent(self, field):
+        """
+        Return a boolean array of the records which have the blob field.
+        """
+        if self.header.get('blob_present', {}).has_key(field):
+            return self._Array(self.header['blob_present'][field])
+        return numpy.ones(self.n_records, dtype=bool)
+
+
+__all__.append('LazyBlobValue')
+class LazyBlobValue:
+    """
+    A value (usually a dict) from the blob of a table, which is only loaded when accessed.
+    """
+
+    def __init__(self, table, field, n):
+        self._table = table
+        self._field = field
+        self._n = n
+
+    def Value(self):
+        return self._table.Blob()[self._field][self._n]
+
+    def __getitem__(self, key):
+        return self.Value()[key]
+
+    def __setitem__(self, key, value):
+        self.Value()[key] = value
+
+    def __contains__(self, key):
+        return key in self.Value()
+
+    def __iter__(self):
+        return iter(self.Value())
+
+    def __len__(self):
+        return len(self.Value())
+
+    def __eq__(self, other):
+        return self.Value() == _Resolve(other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __nonzero__(self):
+        return bool(self.Value())
+
+    def __repr__(self):
+        return repr(self.Value())
+
+    def __getattr__(self, name):
+        # (e.g., get, keys, has_key, iteritems)
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.Value(), name)
+
+    def __reduce__(self):
+        return (_Identity, (self.Value(),))
+
+
+def _AsciiNames(d):
+    # (json gives unicode strings; names are kept as str where possible)
+    def ascii(value):
+        if isinstance(value, unicode):
+            try:
+                return str(value)
+            except UnicodeEncodeError:
+                pass
+        elif isinstance(value, list):
+            return [ascii(x) for x in value]
+        return value
+    return dict((ascii(key), ascii(value)) for key, value in d.items())
+
+
+def _Identity(value):
+    return value
+
+
+def _Resolve(value):
+    if isinstance(value, LazyBlobValue):
+        return value.Value()
+    return value
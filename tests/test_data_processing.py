@@ -0,0 +1,411 @@
+#
+# Tests of data acquisition and processing
+#
+import os
+import sys
+import shelve
+import shutil
+import tempfile
+import time
+import unittest
+import warnings
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_processing
+
+
+DAYS = ['sunday', 'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday']
+
+
+def PlaceRow(n, **values):
+    row = {'id': 'p%d' % n, 'address': 'Street %d, Tel Aviv' % n, 'size': '2', 'rogovrank': '3', 'kosher': 'Yes',
+           'visitingcenter': 'No', 'visitorcenteradmition': None}
+    for day in DAYS:
+        row[day] = '17'
+    row.update(values)
+    return row
+
+
+def UserRow(n, **values):
+    row = {'id': 'u%d' % n, 'age': '30', 'sex': 'F', 'job': 'a', 'zip': '1'}
+    row.update(values)
+    return row
+
+
+def RatingRow(u, p, rating='3'):
+    return {'userid': 'u%d' % u, 'placeid': 'p%d' % p, 'rating': rating}
+
+
+class DataTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.geocoder = data_processing.FakeGeocoder()
+        self.geocoding_cache = data_processing.GeocodingCache(self.Path('geocache.sqlite'), geocoder=self.geocoder, rate=1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def Path(self, name):
+        return os.path.join(self.directory, name)
+
+    def Build(self, place_ids, user_ids):
+        places = data_processing.PlacesRecommenderData(self.Path('places_db.pcl'), self.geocoding_cache, 'places', 'e', ids=place_ids)
+        users = data_processing.UsersRecommenderData(self.Path('users_db.pcl'), 'users', 'e', ids=user_ids)
+        rating = data_processing.RatingRecommenderData(self.Path('rating_db.pcl'), 'rating', 'e', user_ids=user_ids, place_ids=place_ids)
+        return places, users, rating
+
+
+class SharedRegistriesTest(DataTestCase):
+
+    def testEmptyRegistriesAreShared(self):
+        for run in xrange(2):
+            place_ids, user_ids = data_processing.IdRegistry(), data_processing.IdRegistry()
+            places, users, rating = self.Build(place_ids, user_ids)
+
+            self.assertTrue(places.ids is place_ids)
+            self.assertTrue(users.ids is user_ids)
+            self.assertTrue(rating.user_ids is user_ids)
+            self.assertTrue(rating.place_ids is place_ids)
+            self.assertTrue(rating.Ratings().user_ids is user_ids)
+            self.assertTrue(rating.Ratings().place_ids is place_ids)
+
+            if run == 0:
+                places.UpdateFromGoogle([PlaceRow(n) for n in xrange(3)])
+                users.UpdateFromGoogle([UserRow(n) for n in xrange(2)])
+                rating.UpdateFromGoogle([RatingRow(0, 1), RatingRow(1, 2, '5')])
+                for data in (places, users, rating):
+                    data.Save()
+            else:
+                self.assertEqual(rating.Ratings().Get('u1', 'p2'), 5)
+                self.assertEqual(sorted(user_ids.Indices(['u0', 'u1']).tolist()), [0, 1])
+
+            for data in (places, users, rating):
+                data.Close()
+
+
+class SaveTest(DataTestCase):
+
+    def testOpenDataIsSavedAtExit(self):
+        users = data_processing.UsersRecommenderData(self.Path('users_db.pcl'), 'users', 'e')
+        users.UpdateFromGoogle([UserRow(n) for n in xrange(2)])
+
+        data_processing._SaveOpenData()
+        self.assertEqual(sorted(data_processing.UsersRecommenderData(self.Path('users_db.pcl')).keys()), ['u0', 'u1'])
+
+        # (closed data is no longer saved at exit)
+        users.Close()
+        self.assertFalse(users in data_processing._OPEN_DATA)
+        users.UpdateFromGoogle([UserRow(2)])
+        data_processing._SaveOpenData()
+        self.assertEqual(sorted(data_processing.UsersRecommenderData(self.Path('users_db.pcl')).keys()), ['u0', 'u1'])
+
+
+    def testRecordsBeforeLoading(self):
+        places = data_processing.PlacesRecommenderData(self.Path('places_db.pcl'), self.geocoding_cache)
+        places.UpdateFromGoogle([PlaceRow(n) for n in xrange(5)])
+        places.Save(compact=True)
+
+        # (and some changes in the journal)
+        places.UpdateChangedFromGoogle([PlaceRow(n, size='4') for n in [0, 1, 2, 4, 7]])
+        places.Save()
+        expected = dict((uid, places[uid]) for uid in places.keys())
+        places.Close()
+
+        places = data_processing.PlacesRecommenderData(self.Path('places_db.pcl'), self.geocoding_cache)
+        self.assertEqual(sorted(places.keys()), ['p0', 'p1', 'p2', 'p4', 'p7'])
+        for uid in expected:
+            self.assertEqual(places[uid], expected[uid])
+        self.assertRaises(KeyError, places.__getitem__, 'p3')
+        places.Columns()
+        places.SpatialIndex()
+        self.assertFalse(places.__dict__.has_key('data'))
+
+        # (the records which were given are kept once the data is loaded)
+        record = places['p0']
+        self.assertTrue(places.data['p0'] is record)
+        self.assertEqual(places.data, expected)
+        places.Close()
+
+
+class SyncTest(DataTestCase):
+
+    def setUp(self):
+        DataTestCase.setUp(self)
+        # (spreadsheet key -> worksheets)
+        self.spreadsheets = {'users': [[UserRow(n) for n in xrange(3)]],
+                             'rating': [[RatingRow(0, 0), RatingRow(0, 1, '5'), RatingRow(1, 1)]]}
+        data_processing.SPREADSHEET_SESSIONS.service_factory = lambda: data_processing.FakeSpreadsheetService(self.spreadsheets)
+
+    def tearDown(self):
+        data_processing.SPREADSHEET_SESSIONS.service_factory = None
+        data_processing.SPREADSHEET_SESSIONS.Clear()
+        DataTestCase.tearDown(self)
+
+    def Build(self):
+        users = data_processing.UsersRecommenderData(self.Path('users_db.pcl'), 'users', 'e')
+        rating = data_processing.RatingRecommenderData(self.Path('rating_db.pcl'), 'rating', 'e')
+        return users, rating
+
+    def assertChanges(self, changes, added=(), changed=(), removed=()):
+        self.assertEqual((sorted(changes.added), sorted(changes.changed), sorted(changes.removed)),
+                         (sorted(added), sorted(changed), sorted(removed)))
+
+    def testDifferentialSync(self):
+        users, rating = self.Build()
+        self.assertChanges(users.Sync('password', differential=True), added=['u0', 'u1', 'u2'])
+        self.assertChanges(rating.Sync('password', differential=True), added=[('u0', 'p0'), ('u0', 'p1'), ('u1', 'p1')])
+
+        # (nothing changed)
+        version = users.version
+        self.assertEqual(len(users.Sync('password', differential=True)), 0)
+        self.assertEqual(len(rating.Sync('password', differential=True)), 0)
+        self.assertEqual(users.version, version)
+
+        self.spreadsheets['users'] = [[UserRow(0, job='b'), UserRow(2), UserRow(3)]]
+        self.spreadsheets['rating'] = [[RatingRow(0, 0, '4'), RatingRow(1, 1), RatingRow(1, 2)]]
+        self.assertChanges(users.Sync('password', differential=True), added=['u3'], changed=['u0'], removed=['u1'])
+        self.assertChanges(rating.Sync('password', differential=True), added=[('u1', 'p2')], changed=[('u0', 'p0')], removed=[('u0', 'p1')])
+
+        self.assertEqual(sorted(users.keys()), ['u0', 'u2', 'u3'])
+        self.assertEqual(users['u0']['job'], 'b')
+        self.assertEqual(rating.Ratings().Get('u0', 'p0'), 4)
+        self.assertFalse(rating.Ratings().Has('u0', 'p1'))
+
+        # (the changes are in the journals, with the removed rows as tombstones)
+        self.assertTrue(os.path.exists(users.journal_path))
+        self.assertTrue(os.path.exists(rating.journal_path))
+        users.Close()
+        rating.Close()
+
+        users, rating = self.Build()
+        self.assertEqual(sorted(users.keys()), ['u0', 'u2', 'u3'])
+        self.assertEqual(sorted((userid, placeid, value) for userid, placeid, value, raw in rating.Ratings().Triples()),
+                         [('u0', 'p0', 4), ('u1', 'p1', 3), ('u1', 'p2', 3)])
+        self.assertEqual(len(users.Sync('password', differential=True)), 0)
+        self.assertEqual(len(rating.Sync('password', differential=True)), 0)
+        users.Close()
+        rating.Close()
+
+    def testSyncAll(self):
+        users, rating = self.Build()
+        n_logins = data_processing.FakeSpreadsheetService.n_logins
+
+        results = data_processing.SyncAll([users, rating], 'password', differential=True)
+        self.assertChanges(results[0], added=['u0', 'u1', 'u2'])
+        self.assertChanges(results[1], added=[('u0', 'p0'), ('u0', 'p1'), ('u1', 'p1')])
+        self.assertEqual(rating.Ratings().Get('u0', 'p1'), 5)
+
+        # (the sessions are logged in once)
+        self.assertTrue(1 <= data_processing.FakeSpreadsheetService.n_logins - n_logins <= 2)
+        n_logins = data_processing.FakeSpreadsheetService.n_logins
+        self.assertEqual([len(changes) for changes in data_processing.SyncAll([users, rating], 'password', differential=True)], [0, 0])
+        self.assertEqual(data_processing.FakeSpreadsheetService.n_logins, n_logins)
+
+        # (errors are raised)
+        rating.google_key = 'missing'
+        self.assertRaises(KeyError, data_processing.SyncAll, [users, rating], 'password')
+        users.Close()
+        rating.Close()
+
+    def testPages(self):
+        rows = [UserRow(n) for n in xrange(12)]
+        service = data_processing.FakeSpreadsheetService({'users': [rows, rows[:10]]})
+        acquisitor = data_processing.GoogleSpreadsheetAcquisitor('e', 'password', service)
+
+        self.assertEqual([len(page) for page in acquisitor.IterPages('users', 0, page_size=5)], [5, 5, 2])
+        self.assertEqual([len(page) for page in acquisitor.IterPages('users', 1, page_size=5)], [5, 5])
+        self.assertEqual(acquisitor.GetSpreadsheet('users', 0), rows)
+        self.assertRaises(IndexError, list, acquisitor.IterPages('users', 2))
+
+    def testPageErrors(self):
+        class FailingService(data_processing.FakeSpreadsheetService):
+            def GetListFeed(self, spreadsheet_key, worksheet_key, query=None):
+                if int(query['start-index']) > 1:
+                    raise IOError("Connection lost")
+                return data_processing.FakeSpreadsheetService.GetListFeed(self, spreadsheet_key, worksheet_key, query)
+
+        acquisitor = data_processing.GoogleSpreadsheetAcquisitor('e', 'password', FailingService({'users': [[UserRow(n) for n in xrange(12)]]}))
+        pages = acquisitor.IterPages('users', 0, page_size=5)
+        self.assertEqual(len(pages.next()), 5)
+        self.assertRaises(IOError, pages.next)
+
+
+class RatingStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = data_processing.RatingStore([('u0', 'p0', 3, None), ('u0', 'p2', 4, None), ('u1', 'p1', 5, None)])
+
+    def testKeptRowsFollowChanges(self):
+        by_user = self.store.ByUser()
+        by_place = self.store.ByPlace()
+        user_row = by_user['u0']
+        place_row = by_place['p1']
+        self.assertEqual(sorted(user_row.keys()), ['p0', 'p2'])
+
+        # (inserted before the other ratings of the user, so their slots move)
+        self.store.Set('u0', 'p1', 1)
+        self.store.Set('u1', 'p0', 2)
+        self.assertEqual(sorted((placeid, info['rating']) for placeid, info in user_row.iteritems()), [('p0', 3), ('p1', 1), ('p2', 4)])
+        self.assertEqual(dict((userid, info['rating']) for userid, info in place_row.iteritems()), {'u0': 1, 'u1': 5})
+
+        self.store.Remove('u0', 'p0')
+        self.store.Compact()
+        self.assertEqual(user_row['p2']['rating'], 4)
+        self.assertEqual(user_row.get('p0'), None)
+        self.assertEqual(len(user_row), 2)
+
+        # (a changed value, without moving slots)
+        self.store.Set('u0', 'p2', 5)
+        self.assertEqual(user_row['p2']['rating'], 5)
+
+    def testViewsMatchTriples(self):
+        self.store.Set('u2', 'p0', 1)
+        self.store.Remove('u1', 'p1')
+        triples = sorted((userid, placeid, rating) for userid, placeid, rating, raw in self.store.Triples())
+        from_view = sorted((userid, placeid, info['rating']) for userid, row in self.store.ByUser().iteritems() for placeid, info in row.iteritems())
+        self.assertEqual(triples, from_view)
+        self.assertEqual(triples, [('u0', 'p0', 3), ('u0', 'p2', 4), ('u2', 'p0', 1)])
+
+
+class GeocodingTest(DataTestCase):
+
+    def testSqliteStoreIsShared(self):
+        failed = data_processing.GeocodingCache.FAILED
+        store = data_processing.SqliteGeocodingStore(self.Path('shared.sqlite'))
+        other = data_processing.SqliteGeocodingStore(self.Path('shared.sqlite'))
+
+        store.PutMany([('street 1', ('Street 1', (32.0, 34.8))), ('nowhere', failed + (123.0,))])
+        self.assertEqual(other.Get('street 1'), ('Street 1', (32.0, 34.8)))
+        self.assertEqual(other.Get('nowhere'), failed + (123.0,))
+        self.assertEqual(other.Get('street 2'), None)
+
+        other.Put('street 1', ('Street 1, Tel Aviv', (32.1, 34.8)))
+        store.PutMany([('street 1', ('Old', (0.0, 0.0)))], replace=False)
+        self.assertEqual(store.Get('street 1'), ('Street 1, Tel Aviv', (32.1, 34.8)))
+
+        store.Close()
+        other.Close()
+
+    def testImportShelve(self):
+        failed = data_processing.GeocodingCache.FAILED
+        shelve_obj = shelve.open(self.Path('old.shelve'))
+        shelve_obj['Street 1,  Tel Aviv'] = failed
+        shelve_obj['street 1, tel aviv'] = ('Street 1, Tel Aviv', (32.0, 34.8))
+        shelve_obj['Street 2'] = ('Street 2', (31.0, 35.0))
+        shelve_obj.close()
+
+        store = data_processing.SqliteGeocodingStore(self.Path('imported.sqlite'))
+        store.Put('street 2', ('Newer', (31.5, 35.0)))
+        self.assertFalse(store.Imported(self.Path('old.shelve')))
+        self.assertEqual(store.ImportShelve(self.Path('old.shelve')), 2)
+        self.assertTrue(store.Imported(self.Path('old.shelve')))
+
+        # (a result is preferred over a failure, and results which were already kept stay)
+        self.assertEqual(store.Get('street 1, tel aviv'), ('Street 1, Tel Aviv', (32.0, 34.8)))
+        self.assertEqual(store.Get('street 2'), ('Newer', (31.5, 35.0)))
+        store.Close()
+
+    def testFailedImportIsRetried(self):
+        file(self.Path('old.shelve'), 'wb').write('not a shelve')
+        store = data_processing.SqliteGeocodingStore(self.Path('imported.sqlite'))
+        self.assertRaises(Exception, store.ImportShelve, self.Path('old.shelve'))
+        self.assertFalse(store.Imported(self.Path('old.shelve')))
+        store.Close()
+
+        os.remove(self.Path('old.shelve'))
+        shelve_obj = shelve.open(self.Path('old.shelve'))
+        shelve_obj['Street 1'] = ('Street 1', (32.0, 34.8))
+        shelve_obj.close()
+
+        store = data_processing.SqliteGeocodingStore(self.Path('imported.sqlite'))
+        self.assertEqual(store.ImportShelve(self.Path('old.shelve')), 1)
+        self.assertTrue(store.Imported(self.Path('old.shelve')))
+        self.assertEqual(store.Get('street 1'), ('Street 1', (32.0, 34.8)))
+        store.Close()
+
+    def testGeocodeManyUsesTheStore(self):
+        addresses = ['Street 1, Tel Aviv', '  street 1,  TEL AVIV', 'Nowhere', 'Street 2, Haifa']
+        geocoder = data_processing.FakeGeocoder(failing=['Nowhere'])
+        cache = data_processing.GeocodingCache(self.Path('many.sqlite'), geocoder=geocoder, rate=1000)
+
+        results = cache.GeocodeMany(addresses)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[2], data_processing.GeocodingCache.FAILED)
+        self.assertEqual(results[3], data_processing.FakeGeocoder().geocode('Street 2, Haifa'))
+        self.assertEqual(geocoder.n_calls, 3)
+        del cache
+
+        # (another cache over the same file finds the results, and retries failures only once they expire)
+        geocoder = data_processing.FakeGeocoder()
+        cache = data_processing.GeocodingCache(self.Path('many.sqlite'), geocoder=geocoder, rate=1000)
+        self.assertEqual(cache.GeocodeMany(addresses), results)
+        self.assertEqual(geocoder.n_calls, 0)
+        del cache
+
+        cache = data_processing.GeocodingCache(self.Path('many.sqlite'), geocoder=geocoder, rate=1000, failure_ttl=-1)
+        self.assertNotEqual(cache['Nowhere'], data_processing.GeocodingCache.FAILED)
+        self.assertEqual(geocoder.n_calls, 1)
+        del cache
+
+
+class OpeningHoursTest(DataTestCase):
+
+    def setUp(self):
+        DataTestCase.setUp(self)
+        rows = [PlaceRow(0), PlaceRow(1, monday='12'), PlaceRow(2, monday=None), PlaceRow(3, monday='1330'),
+                PlaceRow(4, **dict((day, '24') for day in DAYS)), PlaceRow(5, monday='24', tuesday='9')]
+
+        self.places = data_processing.PlacesRecommenderData(self.Path('places_db.pcl'), self.geocoding_cache)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.places.UpdateFromGoogle(rows)
+        self.warnings = [str(warning.message) for warning in caught]
+        self.columns = self.places.Columns()
+
+    def tearDown(self):
+        self.places.Close()
+        DataTestCase.tearDown(self)
+
+    def Monday(self, hour, minute=0):
+        # (19 Oct 2026 is a monday, in local time)
+        return time.mktime((2026, 10, 19, hour, minute, 0, 0, 0, -1))
+
+    def assertOpen(self, mask, expected):
+        self.assertEqual(dict(zip(self.columns.placeids, mask.tolist())), dict(('p%d' % n, value) for n, value in enumerate(expected)))
+
+    def testIllegalHours(self):
+        self.assertEqual(self.warnings, ['ID p3: illegal value 1330'])
+        self.assertEqual(self.places['p3']['hours']['monday'], None)
+        self.assertEqual(self.places['p3']['hours']['tuesday'], 17)
+
+    def testOpenAt(self):
+        self.assertOpen(self.columns.OpenAt(self.Monday(10)), [True] * 6)
+        self.assertOpen(self.columns.OpenAt(self.Monday(11, 30), 60 * 60), [True, False, True, True, True, True])
+        self.assertOpen(self.columns.OpenAt(self.Monday(17, 30)), [False, False, True, True, True, True])
+
+    def testOpenDuring(self):
+        self.assertOpen(self.columns.OpenDuring(self.Monday(10), self.Monday(16)), [True, False, True, True, True, True])
+        self.assertOpen(self.columns.OpenDuring(self.Monday(10), self.Monday(18)), [False, False, True, True, True, True])
+
+        # (through the night, until tuesday)
+        self.assertOpen(self.columns.OpenDuring(self.Monday(20), self.Monday(32)), [False, False, True, True, True, True])
+        self.assertOpen(self.columns.OpenDuring(self.Monday(20), self.Monday(34)), [False, False, True, True, True, False])
+
+        # (for more than a week, the places must be open until midnight every day)
+        self.assertOpen(self.columns.OpenDuring(self.Monday(0), self.Monday(24 * 9)), [False, False, False, False, True, False])
+
+    def testIllegalStoredHours(self):
+        # (hours saved before they were checked are unknown as well)
+        self.places.data['p0']['hours']['monday'] = 1330
+        self.places.Changed()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            columns = self.places.Columns()
+        self.assertEqual([str(warning.message) for warning in caught], ['ID p0: illegal value 1330.0'])
+        self.assertTrue(columns.OpenAt(self.Monday(20))[columns.index['p0']])
+
+
+if __name__ == '__main__':
+    unittest.main()
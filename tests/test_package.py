@@ -0,0 +1,107 @@
+#
+# Tests of the package (the data and recommenders it sets up)
+#
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+import recommenders
+
+
+class PackageTest(unittest.TestCase):
+    """
+    Over a copy of the package file in a temporary directory (so that its data files are there; the modules
+    are the ones in the repository).
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        package_dir = os.path.join(self.directory, 'dtour_copy')
+        os.mkdir(package_dir)
+        os.mkdir(os.path.join(package_dir, 'data'))
+        shutil.copy(os.path.join(REPOSITORY, '__init__.py'), package_dir)
+
+        sys.path.insert(0, self.directory)
+        self.package = __import__('dtour_copy')
+
+    def tearDown(self):
+        for data in [self.package.RD_places, self.package.RD_users, self.package.RD_rating]:
+            data.Close()
+        self.package.GEOCODING_STORE.Close()
+
+        for name in sys.modules.keys():
+            if name == 'dtour_copy' or name.startswith('dtour_copy.'):
+                del sys.modules[name]
+        sys.path.remove(self.directory)
+        shutil.rmtree(self.directory)
+
+    def Built(self):
+        return [name for name in self.package.RECOMMENDERS.Names() if self.package.RECOMMENDERS.IsBuilt(name)]
+
+    def testImportBuildsNothing(self):
+        self.assertEqual(self.Built(), [])
+        self.assertEqual(repr(self.package.SWJ), "<lazy recommender SWJ>")
+        self.assertEqual(self.Built(), [])
+
+    def testFirstUseBuildsOne(self):
+        registry = self.package.RECOMMENDERS
+        builds = []
+        build = registry.builders['SWJ']
+        registry.Register('SWJ', lambda: builds.append('SWJ') or build())
+
+        self.package.SWJ.Recommend
+        self.assertEqual(self.Built(), ['SWJ'])
+        self.package.SWJ.Recommend
+        self.assertTrue(self.package.SWJ.Get() is registry['SWJ'])
+        self.assertTrue(isinstance(registry['SWJ'], recommenders.SimpleWineryRecommender))
+        self.assertEqual(builds, ['SWJ'])
+
+    def testUnknownName(self):
+        self.assertRaises(KeyError, self.package.RECOMMENDERS.__getitem__, 'NONE')
+        self.assertRaises(KeyError, self.package.RECOMMENDERS.Lazy, 'NONE')
+
+
+class RegistryTest(unittest.TestCase):
+
+    def testConcurrentFirstUseBuildsOne(self):
+        registry = recommenders.RecommenderRegistry()
+        builds = []
+        started = threading.Event()
+        def build():
+            builds.append(1)
+            started.wait()
+            return recommenders.SimpleWineryRecommender(None)
+        registry.Register('SW', build)
+        lazy = registry.Lazy('SW')
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(lazy.Get())) for n in xrange(5)]
+        for thread in threads:
+            thread.start()
+        started.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(builds, [1])
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all([result is results[0] for result in results]))
+
+    def testRegisterReplaces(self):
+        registry = recommenders.RecommenderRegistry()
+        registry.Register('SW', lambda: recommenders.SimpleWineryRecommender(None))
+        lazy = registry.Lazy('SW')
+        old = lazy.Get()
+
+        registry.Register('SW', lambda: recommenders.SimpleWineryRecommender(None))
+        self.assertFalse(registry.IsBuilt('SW'))
+        self.assertFalse(lazy.Get() is old)
+
+
+if __name__ == '__main__':
+    unittest.main()
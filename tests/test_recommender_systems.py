@@ -0,0 +1,265 @@
+#
+# Tests of the recommender algorithms
+#
+import os
+import sys
+import gc
+import random
+import shutil
+import tempfile
+import unittest
+import weakref
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_processing
+import recommender_systems.base
+import recommender_systems.item_based
+import recommender_systems.user_based
+import recommender_systems.hybrid
+import recommenders
+import weather
+
+
+class Data(object):
+    """
+    Plain data in the form of RecommenderData.
+    """
+    version = 0
+
+    def __init__(self, data):
+        self.data = data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def keys(self):
+        return self.data.keys()
+
+
+def MakeData(n_places=25, n_users=30, density=0.3, seed=0):
+    rnd = random.Random(seed)
+    places = {}
+    for n in xrange(n_places):
+        places['p%d' % n] = {'size': rnd.choice([1, 2, 3, 4, None]), 'expert_rank': rnd.choice([1, 2, 3, 4, 5, None]),
+                             'kosher': rnd.random() < 0.5, 'visiting_center': rnd.random() < 0.5}
+    users = {}
+    for n in xrange(n_users):
+        users['u%d' % n] = {'age': rnd.choice([None, 20, 30, 40]), 'sex': rnd.choice(['M', 'F']), 'job': rnd.choice(['a', 'b']), 'zip': '1'}
+    by_user, by_place = {}, {}
+    for userid in users:
+        by_user[userid] = {}
+        for placeid in places:
+            if rnd.random() < density:
+                rating = rnd.randint(1, 5)
+                by_user[userid][placeid] = {'rating': rating, 'raw': {}}
+                by_place.setdefault(placeid, {})[userid] = {'rating': rating, 'raw': {}}
+    return Data(places), Data(users), {'by_user': by_user, 'by_place': by_place}
+
+
+def MakeSystems(places, users, rating):
+    return {'slope one': recommender_systems.item_based.SlopeOneRecommenderSystem(places, users, rating),
+            'weighted slope one': recommender_systems.item_based.SlopeOneRecommenderSystem(places, users, rating, True),
+            'tfidf': recommender_systems.item_based.TFIDFRecommenderSystem(places, users, rating, [], ['kosher', 'visiting_center', 'size', 'expert_rank']),
+            'pearson': recommender_systems.user_based.PearsonRecommenderSystem(places, users, rating),
+            'pearson neighbors': recommender_systems.user_based.PearsonRecommenderSystem(places, users, rating, n_neighbors=5),
+            'demographic': recommender_systems.user_based.DemographicRecommenderSystem(places, users, rating, ['sex', 'job', 'zip'], ['age'])}
+
+
+class PredictionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.places, self.users, self.rating = MakeData()
+
+        # (some of the stored ratings are None)
+        rnd = random.Random(1)
+        for userid in sorted(self.users.keys()):
+            for placeid in sorted(self.places.keys()):
+                if not self.rating['by_user'][userid].has_key(placeid) and rnd.random() < 0.1:
+                    self.rating['by_user'][userid][placeid] = {'rating': None, 'raw': {}}
+                    self.rating['by_place'].setdefault(placeid, {})[userid] = {'rating': None, 'raw': {}}
+
+        self.systems = MakeSystems(self.places, self.users, self.rating)
+
+    def testSingleMatchesBatch(self):
+        placeids = sorted(self.places.keys())
+        userids = sorted(self.users.keys()) + ['unknown']
+        for name, system in sorted(self.systems.items()):
+            for userid in userids:
+                for force_predict in [True, False]:
+                    single = [system.PredictRating(userid, placeid, force_predict) for placeid in placeids]
+                    batch = system.PredictRatings(userid, placeids, force_predict)
+                    self.assertTrue(None not in single, "%s, %s" % (name, userid))
+                    self.assertTrue(numpy.allclose(single, batch), "%s, %s, %s" % (name, userid, force_predict))
+
+
+class RatingDataTestCase(unittest.TestCase):
+    """
+    Over ratings in a RatingRecommenderData.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.places, self.users, ratings = MakeData()
+        self.rating = data_processing.RatingRecommenderData(os.path.join(self.directory, 'rating_db.pcl'), 'rating', 'e')
+        for userid, rated_places in ratings['by_user'].iteritems():
+            for placeid, v in rated_places.iteritems():
+                self.rating.SetRating(userid, placeid, v['rating'])
+
+    def tearDown(self):
+        self.rating.Close()
+        shutil.rmtree(self.directory)
+
+
+class IncrementalSlopeOneTest(RatingDataTestCase):
+
+    def Build(self, weighted):
+        return recommender_systems.item_based.SlopeOneRecommenderSystem(self.places, self.users, self.rating, weighted)
+
+    def Deviations(self, system, placeids):
+        indices = numpy.array([system.place_index[placeid] for placeid in placeids], dtype=int)
+        return system._DeviationBlock(indices, indices)
+
+    def assertMatchesRebuild(self, system):
+        rebuilt = self.Build(system.weighted)
+        placeids = sorted(self.places.keys())
+        for userid in sorted(self.users.keys()):
+            self.assertTrue(numpy.allclose(system.PredictRatings(userid, placeids, force_predict=True),
+                                           rebuilt.PredictRatings(userid, placeids, force_predict=True)), userid)
+        self.assertAlmostEqual(system._default_rating, rebuilt._default_rating)
+
+        rated_placeids = sorted(set(placeids) & set(rebuilt.place_index))
+        for incremental_values, rebuilt_values in zip(self.Deviations(system, rated_placeids), self.Deviations(rebuilt, rated_placeids)):
+            self.assertTrue(numpy.allclose(incremental_values, rebuilt_values))
+
+    def testMatchesRebuild(self):
+        rnd = random.Random(1)
+        systems = [self.Build(False), self.Build(True)]
+
+        userids = sorted(self.users.keys())
+        placeids = sorted(self.places.keys())
+        for n in xrange(200):
+            userid, placeid = rnd.choice(userids + ['new user']), rnd.choice(placeids)
+            if rnd.random() < 0.3:
+                if self.rating.Ratings().Has(userid, placeid):
+                    self.rating.RemoveRating(userid, placeid)
+            else:
+                self.rating.SetRating(userid, placeid, rnd.choice([1, 2, 3, 4, 5, None]))
+
+        for system in systems:
+            self.assertMatchesRebuild(system)
+
+    def testBulkChanges(self):
+        systems = [self.Build(False), self.Build(True)]
+
+        self.rating.UpdateFromGoogle([{'userid': 'u0', 'placeid': 'p%d' % n, 'rating': str(1 + n % 5)} for n in xrange(5)])
+        self.rating.SetRating('u0', 'p6', 1)
+        for system in systems:
+            self.assertMatchesRebuild(system)
+
+        # (a differential update, which removes the ratings which are not in the spreadsheet)
+        rows = [{'userid': userid, 'placeid': placeid, 'rating': str(rating)} for userid, placeid, rating, raw in self.rating.Ratings().Triples()
+                if rating != None and placeid != 'p3']
+        changes = self.rating.UpdateChangedFromGoogle(rows)
+        self.assertTrue(len(changes.removed) > 0)
+        self.rating.SetRating('u1', 'p3', 2)
+        for system in systems:
+            self.assertMatchesRebuild(system)
+
+    def testReset(self):
+        system = self.Build(False)
+        self.rating.Reset()
+        self.rating.UpdateFromGoogle([{'userid': 'u%d' % (n % 7), 'placeid': 'p%d' % (n % 11), 'rating': str(1 + n % 5)} for n in xrange(40)])
+        self.assertMatchesRebuild(system)
+
+    def testListenersAreWeak(self):
+        system = self.Build(False)
+        self.assertEqual(self.rating._Listeners(), [system])
+        del system
+        gc.collect()
+        self.assertEqual(self.rating._Listeners(), [])
+
+    def testDetach(self):
+        system = self.Build(False)
+        system.Detach()
+        self.assertEqual(self.rating._Listeners(), [])
+
+        default_rating = system._default_rating
+        self.rating.SetRating('u0', 'p0', 5 if default_rating < 3 else 1)
+        self.assertEqual(system._default_rating, default_rating)
+
+
+class FeatureAugmentTest(RatingDataTestCase):
+
+    def Build(self):
+        other = recommender_systems.user_based.PearsonRecommenderSystem(self.places, self.users, self.rating)
+        return recommender_systems.hybrid.FeatureAugmentRecommender(recommender_systems.item_based.TFIDFRecommenderSystem, other,
+                                                                    [], ['kosher', 'visiting_center', 'size'])
+
+    def assertMatchesRebuild(self, system):
+        rebuilt = self.Build()
+        placeids = sorted(self.places.keys())
+        for userid in ['u0', 'u1', 'u2']:
+            self.assertTrue(numpy.allclose(system.PredictRatings(userid, placeids, force_predict=True),
+                                           rebuilt.PredictRatings(userid, placeids, force_predict=True)), userid)
+        self.assertAlmostEqual(system._default_rating, rebuilt._default_rating)
+
+    def testCachedModelsFollowChanges(self):
+        system = self.Build()
+        placeids = sorted(self.places.keys())
+        for userid in ['u0', 'u1', 'u2']:
+            system.PredictRatings(userid, placeids)
+
+        # (the places changed)
+        for placeid in placeids[:10]:
+            self.places[placeid]['size'] = 4
+        self.places.version = 1
+        self.assertMatchesRebuild(system)
+
+        # (the ratings were replaced)
+        self.rating.Reset()
+        self.rating.UpdateFromGoogle([{'userid': 'u%d' % (n % 5), 'placeid': 'p%d' % (n % 11), 'rating': str(1 + n % 5)} for n in xrange(40)])
+        self.assertMatchesRebuild(system)
+
+
+class ModelCacheTest(RatingDataTestCase):
+
+    def Build(self):
+        return recommenders.PearsonRecommender(self.places, self.users, self.rating, weather.RainyInJerusalem())
+
+    def testRecommendersShareModels(self):
+        first, second = self.Build(), self.Build()
+        self.assertTrue(first._recommender_system is second._recommender_system)
+        self.assertTrue(first._recommender_system.RatingStatistics() is
+                        recommender_systems.item_based.SlopeOneRecommenderSystem(self.places, self.users, self.rating).RatingStatistics())
+
+    def testVersionChangeRebuilds(self):
+        first = self.Build()
+        self.rating.SetRating('u0', 'p0', 5)
+        second = self.Build()
+        self.assertFalse(first._recommender_system is second._recommender_system)
+
+        placeids = sorted(self.places.keys())
+        rebuilt = recommender_systems.user_based.PearsonRecommenderSystem(self.places, self.users, self.rating)
+        self.assertTrue(numpy.allclose(second._recommender_system.PredictRatings('u0', placeids, True), rebuilt.PredictRatings('u0', placeids, True)))
+        self.assertTrue(self.Build()._recommender_system is second._recommender_system)
+
+    def testDataIsNotKept(self):
+        recommender = self.Build()
+        system = weakref.ref(recommender._recommender_system)
+        rating = weakref.ref(self.rating)
+        self.assertTrue(len(recommender_systems.base.SHARED_MODELS) > 0)
+
+        del recommender
+        gc.collect()
+        self.assertEqual(system(), None)
+
+        self.rating.Close()
+        self.rating = data_processing.RatingRecommenderData(os.path.join(self.directory, 'rating_db.pcl'), 'rating', 'e')
+        gc.collect()
+        self.assertEqual(rating(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,157 @@
+#
+# Tests of the recommenders
+#
+import os
+import sys
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_processing
+import integration
+import recommenders
+import weather
+
+from test_data_processing import PlaceRow
+
+
+class PlacesTestCase(unittest.TestCase):
+    """
+    Over places in a PlacesRecommenderData (with made up locations).
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        geocoding_cache = data_processing.GeocodingCache(os.path.join(self.directory, 'geocache.sqlite'),
+                                                         geocoder=data_processing.FakeGeocoder(), rate=1000)
+        self.places = data_processing.PlacesRecommenderData(os.path.join(self.directory, 'places_db.pcl'), geocoding_cache, 'places', 'e')
+        self.places.UpdateFromGoogle(self.PlaceRows())
+        self.recommender = recommenders.SimpleWineryRecommender(self.places, weather.RainyInJerusalem())
+
+    def PlaceRows(self):
+        return [PlaceRow(n, wineryname='Winery %d' % n, size=str(1 + n % 4), rogovrank=str(1 + n % 5),
+                         kosher=['Yes', 'No'][n % 2]) for n in xrange(60)]
+
+    def tearDown(self):
+        self.places.Close()
+        shutil.rmtree(self.directory)
+
+
+class ConcurrentRecommendTest(PlacesTestCase):
+
+    def setUp(self):
+        PlacesTestCase.setUp(self)
+
+        self.queries = [dict(n_items=3), dict(n_items=5, kosher=True), dict(n_items=2, size=3),
+                        dict(n_items=4, location=(32.0, 34.8)), dict(n_items=6, expert_rank=4, location=(31.5, 35.0))]
+
+        self.check_interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+
+    def tearDown(self):
+        sys.setcheckinterval(self.check_interval)
+        PlacesTestCase.tearDown(self)
+
+    def testQueriesDoNotMix(self):
+        expected = [self.recommender.Recommend(**query) for query in self.queries]
+        errors = []
+
+        def Run(n):
+            for repeat in xrange(30):
+                for m in xrange(len(self.queries)):
+                    k = (n + m) % len(self.queries)
+                    try:
+                        result = self.recommender.Recommend(**self.queries[k])
+                    except Exception, e:
+                        result = e
+                    if result != expected[k]:
+                        errors.append((self.queries[k], result))
+
+        threads = [threading.Thread(target=Run, args=(n,)) for n in xrange(len(self.queries))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+
+class CacheTest(PlacesTestCase):
+
+    def setUp(self):
+        PlacesTestCase.setUp(self)
+        self.cache = recommenders.RecommendationCache()
+        self.recommender.EnableCache(self.cache)
+
+    def testHitsReturnCopies(self):
+        query = dict(n_items=3, location=(32.0, 34.8))
+        expected = [list(result) for result in self.recommender.Recommend(**query)]
+
+        results = self.recommender.Recommend(**query)
+        self.assertEqual(results, expected)
+        results[0][0] = 'changed'
+        results.append('changed')
+
+        self.assertEqual(self.recommender.Recommend(**query), expected)
+        self.assertEqual(self.cache.Stats()['hits'], 2)
+
+    def testStatisticsAreCached(self):
+        few, many = dict(n_items=1, location=(32.0, 34.8)), dict(n_items=30, location=(32.0, 34.8))
+        self.recommender.Recommend(**few)
+        n_skipped = self.recommender.n_skipped_predictions
+        self.recommender.Recommend(**many)
+        self.assertNotEqual(self.recommender.n_skipped_predictions, n_skipped)
+
+        self.recommender.Recommend(**few)
+        self.assertEqual(self.cache.Stats()['hits'], 1)
+        self.assertEqual(self.recommender.n_skipped_predictions, n_skipped)
+
+
+class TopNTest(PlacesTestCase):
+
+    def PlaceRows(self):
+        rnd = random.Random(0)
+        return [PlaceRow(n, wineryname='Winery %d' % n, size=rnd.choice(['1', '2', '3', '4', None]), rogovrank=rnd.choice(['1', '2', '3', '4', '5', None]),
+                         kosher=rnd.choice(['Yes', 'No']), visitingcenter=rnd.choice(['Yes', 'No'])) for n in xrange(150)]
+
+    def BruteForce(self, n_items, location=None, required_radius=0, use_weather=False, **kwargs):
+        """
+        The best places, by filtering and scoring all of them.
+        """
+        integration_filter = integration.BasicIntegratorFilter(use_weather=use_weather, weather_client=self.recommender._weather_client, **kwargs)
+        placeids = [uid for uid in self.places.Columns().placeids if integration_filter.Filter(self.places[uid])]
+
+        distances = self.recommender._Distances(placeids, location)
+        if location != None and required_radius:
+            placeids = [uid for uid, distance in zip(placeids, distances) if distance <= required_radius * 1000.0]
+            distances = self.recommender._Distances(placeids, location)
+
+        ratings = self.recommender._recommender_system.PredictRatings('', placeids, True)
+        scores = self.recommender._integration_sorter_class().Score(distance=distances, rating=ratings, required_radius=required_radius)
+
+        # (by score, and then by order)
+        ranked = sorted(range(len(placeids)), key=lambda n: (-scores[n], n))
+        return [placeids[n] for n in ranked[:n_items]]
+
+    def testMatchesBruteForce(self):
+        rnd = random.Random(1)
+        for sorter in [integration.LinearIntegratorSorter, integration.StupidIntegratorSorter]:
+            self.recommender._integration_sorter_class = sorter
+            for n in xrange(100):
+                query = dict(n_items=rnd.choice([1, 3, 10, 40]), use_weather=rnd.random() < 0.3)
+                if rnd.random() < 0.7:
+                    query['location'] = (29.5 + 3.8 * rnd.random(), 34.3 + 1.5 * rnd.random())
+                    query['required_radius'] = rnd.choice([0, 10, 30, 100])
+                for name, values in [('expert_rank', [2, 4]), ('size', [2, 3]), ('kosher', [True]), ('visiting_center', [True])]:
+                    if rnd.random() < 0.3:
+                        query[name] = rnd.choice(values)
+
+                self.assertEqual([result[0] for result in self.recommender.Recommend(**query)], self.BruteForce(**query), (sorter.__name__, query))
+
+
+if __name__ == '__main__':
+    unittest.main()
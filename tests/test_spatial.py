@@ -0,0 +1,91 @@
+#
+# Tests of the spatial index
+#
+import os
+import sys
+import random
+import unittest
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import spatial
+
+
+class FakePlaces:
+    """
+    Places with just a latlong, in the form of PlacesRecommenderData.
+    """
+
+    def __init__(self, latlongs):
+        self.data = dict(('p%d' % n, {'latlong': latlong}) for n, latlong in enumerate(latlongs))
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def keys(self):
+        return self.data.keys()
+
+
+class SpatialIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(0)
+        latlongs = [(29.5 + 3.8 * rnd.random(), 34.3 + 1.5 * rnd.random()) for n in xrange(300)]
+        latlongs += [None] * 10
+        latlongs += [(-33.87, 151.21), (64.15, -21.94), (31.7, 35.2), (31.7, 35.2)]
+        self.places = FakePlaces(latlongs)
+        self.index = spatial.PlacesSpatialIndex(self.places)
+
+        self.queries = [(29.5 + 3.8 * rnd.random(), 34.3 + 1.5 * rnd.random()) for n in xrange(30)]
+        self.queries += [(31.7, 35.2), (0.0, 0.0), (45.0, 10.0), (-33.0, 150.0), (70.0, -20.0)]
+
+    def BruteForce(self, latlong):
+        """
+        (placeid, distance) of all the places with a latlong, by distance.
+        """
+        placeids = [uid for uid, info in self.places.data.iteritems() if info['latlong'] != None]
+        latlongs = numpy.array([self.places.data[uid]['latlong'] for uid in placeids])
+        distances = spatial.haversine(latlong, latlongs[:, 0], latlongs[:, 1])
+        return sorted(zip(placeids, distances), key=lambda (uid, distance): distance)
+
+    def assertSameResults(self, latlong, results, expected, message):
+        # (the same distances in order, and each is the distance to its place; ids may differ on ties)
+        self.assertEqual(len(results), len(expected), message)
+        numpy.testing.assert_allclose([distance for uid, distance in results], [distance for uid, distance in expected], rtol=1e-9)
+        for uid, distance in results:
+            place = self.places.data[uid]['latlong']
+            self.assertAlmostEqual(distance, spatial.haversine(latlong, [place[0]], [place[1]])[0], 9, message)
+
+    def testWithinRadius(self):
+        for latlong in self.queries:
+            for radius in [0.5, 5, 30, 200, 3000]:
+                expected = [(uid, distance) for uid, distance in self.BruteForce(latlong) if distance <= radius]
+                self.assertSameResults(latlong, self.index.WithinRadius(latlong, radius), expected, (latlong, radius))
+
+    def testNearest(self):
+        for latlong in self.queries:
+            for k in [1, 3, 20, 400]:
+                self.assertSameResults(latlong, self.index.Nearest(latlong, k), self.BruteForce(latlong)[:k], (latlong, k))
+
+    def testDistances(self):
+        placeids = sorted(self.places.data.keys()) + ['unknown']
+        for latlong in self.queries:
+            distances = self.index.Distances(latlong, placeids)
+            for uid, distance in zip(placeids, distances):
+                if uid in self.places.data and self.places.data[uid]['latlong'] != None:
+                    place = self.places.data[uid]['latlong']
+                    self.assertAlmostEqual(distance, spatial.haversine(latlong, [place[0]], [place[1]])[0], 9)
+                else:
+                    self.assertTrue(numpy.isnan(distance), uid)
+
+    def testNoPlaces(self):
+        index = spatial.PlacesSpatialIndex(FakePlaces([None]))
+        self.assertEqual(index.WithinRadius((31.7, 35.2), 100), [])
+        self.assertEqual(index.Nearest((31.7, 35.2), 3), [])
+        self.assertTrue(numpy.isnan(index.Distances((31.7, 35.2), ['p0'])[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#
+# Tests of the columnar storage
+#
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage
+
+
+class StorageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'table.store')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class RoundTripTest(StorageTestCase):
+
+    def Records(self):
+        # (a column of each kind, with None and missing values)
+        return [{'none': None, 'bool': True, 'int': 3, 'float': 1.5, 'str': 'a', 'unicode': u'\u05d9\u05d9\u05df', 'pair': (31.7, 35.2),
+                 'dict': {'monday': 17, 'tuesday': None, 'nested': {'x': 'b'}}, 'object': [1, 2], 'raw': {'id': 'k0', 'name': 'A'}},
+                {'none': None, 'bool': None, 'int': None, 'float': None, 'str': None, 'unicode': None, 'pair': None,
+                 'dict': None, 'object': 'mixed', 'raw': {'id': 'k1'}},
+                {'bool': False, 'int': -2**40, 'float': -0.25, 'str': '', 'pair': (0.0, -1.0), 'dict': {'monday': 9}, 'object': 3}]
+
+    def assertSameRecords(self, records, expected):
+        self.assertEqual(len(records), len(expected))
+        for record, expected_record in zip(records, expected):
+            self.assertEqual(sorted(record.keys()), sorted(expected_record.keys()))
+            for field, value in expected_record.iteritems():
+                self.assertEqual(record[field], value, field)
+                if field not in ['raw', 'none']:
+                    self.assertEqual(type(record[field]), type(value), field)
+
+    def testColumnKinds(self):
+        storage.WriteTable(self.path, ['k0', 'k1', 'k2'], self.Records())
+        table = storage.Table(self.path)
+
+        self.assertEqual(table.Keys(), ['k0', 'k1', 'k2'])
+        self.assertEqual(table.Index(), {'k0': 0, 'k1': 1, 'k2': 2})
+        self.assertEqual(dict((column['name'], column['type']) for column in table.header['columns']),
+                         {'none': 'none', 'bool': 'bool', 'int': 'int', 'float': 'float', 'str': 'str', 'unicode': 'unicode',
+                          'pair': 'pair', 'dict': 'dict', 'object': 'object'})
+
+        self.assertSameRecords(table.Records(), self.Records())
+        self.assertSameRecords([table.Record(n) for n in xrange(len(table))], self.Records())
+
+    def testBlobIsLazy(self):
+        storage.WriteTable(self.path, ['k0', 'k1', 'k2'], self.Records())
+        table = storage.Table(self.path)
+        records = table.Records()
+
+        raw = records[0]['raw']
+        self.assertTrue(isinstance(raw, storage.LazyBlobValue))
+        self.assertEqual(table._blob, None)
+        self.assertEqual(raw['name'], 'A')
+        self.assertEqual(raw.get('missing', 'default'), 'default')
+        self.assertTrue('id' in raw)
+        self.assertNotEqual(table._blob, None)
+
+        # (written again, lazy values are stored as their values)
+        storage.WriteTable(self.path, ['k0', 'k1', 'k2'], records)
+        self.assertSameRecords(storage.Table(self.path).Records(), self.Records())
+
+    def testTupleKeys(self):
+        keys = [('u0', 'p0'), ('u0', 'p1'), ('u1', 'p0')]
+        storage.WriteTable(self.path, keys, [{'rating': n, 'raw': None} for n in xrange(3)])
+        table = storage.Table(self.path)
+        self.assertEqual(table.Keys(), keys)
+        self.assertEqual(table.Record(table.Index()[('u0', 'p1')])['rating'], 1)
+
+    def testEmpty(self):
+        storage.WriteTable(self.path, [], [])
+        table = storage.Table(self.path)
+        self.assertEqual(table.Keys(), [])
+        self.assertEqual(table.Records(), [])
+
+
+class RecoveryTest(StorageTestCase):
+
+    def testInterruptedFirstSnapshot(self):
+        # (the new table was written, but not renamed into place)
+        storage.WriteTable(self.path, ['a', 'b'], [{'x': 1}, {'x': 2}])
+        os.rename(self.path, self.path + '.new')
+
+        self.assertTrue(storage.IsTable(self.path))
+        self.assertEqual(storage.Table(self.path).Keys(), ['a', 'b'])
+        self.assertFalse(os.path.exists(self.path + '.new'))
+
+    def testInterruptedReplace(self):
+        storage.WriteTable(self.path, ['a'], [{'x': 1}])
+
+        # (the old table was moved away, and the new one is complete)
+        storage.WriteTable(self.path + '.next', ['b'], [{'x': 2}])
+        os.rename(self.path, self.path + '.old')
+        os.rename(self.path + '.next', self.path + '.new')
+        self.assertTrue(storage.IsTable(self.path))
+        self.assertEqual(storage.Table(self.path).Keys(), ['b'])
+        self.assertFalse(os.path.exists(self.path + '.old'))
+
+        # (the old table was moved away, and the new one is not complete)
+        os.rename(self.path, self.path + '.old')
+        os.mkdir(self.path + '.new')
+        self.assertTrue(storage.IsTable(self.path))
+        self.assertEqual(storage.Table(self.path).Keys(), ['b'])
+
+        # (the next write clears what is left)
+        storage.WriteTable(self.path, ['c'], [{'x': 3}])
+        self.assertEqual(storage.Table(self.path).Keys(), ['c'])
+        self.assertFalse(os.path.exists(self.path + '.new'))
+
+
+if __name__ == '__main__':
+    unittest.main()
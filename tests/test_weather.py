@@ -0,0 +1,62 @@
+#
+# Tests of the weather layer
+#
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import weather
+
+
+LATLONGS = [(31.0 + n * 0.05, 35.0 + n * 0.03) for n in xrange(20)]
+
+
+class CachedWeatherTest(unittest.TestCase):
+
+    def testConditionsAreCached(self):
+        client = weather.FakeWeather(conditions=lambda latlong: u"Rain" if latlong[0] > 31.5 else u"Sunny")
+        cached = weather.CachedWeather(client)
+        try:
+            conditions = cached.GetConditions(LATLONGS)
+            n_calls = client.n_calls
+            self.assertEqual(cached.GetConditions(LATLONGS), conditions)
+            self.assertEqual(client.n_calls, n_calls)
+            self.assertEqual(conditions, [u"Rain" if cached._CellCenter(cached._Cell(latlong))[0] > 31.5 else u"Sunny" for latlong in LATLONGS])
+        finally:
+            cached.Close()
+
+    def testFailuresAreCached(self):
+        client = weather.FakeWeather(failure_rate=1.0)
+        cached = weather.CachedWeather(client)
+        try:
+            self.assertEqual(cached.GetConditions(LATLONGS[:3]), [u""] * 3)
+            n_calls = client.n_calls
+            cached.GetConditions(LATLONGS[:3])
+            self.assertEqual(client.n_calls, n_calls)
+        finally:
+            cached.Close()
+
+    def testThreadsStartLazilyAndStop(self):
+        n_threads = threading.active_count()
+
+        cached = weather.CachedWeather(weather.FakeWeather(), n_threads=4)
+        self.assertEqual(threading.active_count(), n_threads)
+
+        cached.GetConditions(LATLONGS)
+        cached.StartRefresher(LATLONGS, interval=0.01)
+        self.assertEqual(threading.active_count(), n_threads + 5)
+
+        cached.Close()
+        self.assertEqual(threading.active_count(), n_threads)
+
+        # (can still be used)
+        self.assertEqual(cached.GetConditions(LATLONGS[:1], timeout=1), [u"Sunny"])
+        cached.Close()
+        self.assertEqual(threading.active_count(), n_threads)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,6 +6,15 @@ __author__ = "Regev S"
 
 
 import pywapi
+import numpy
+import math
+import time
+import random
+import threading
+import Queue
+
+# Self imports
+import spatial
 
 class WeatherAcquisitor:
 
@@ -46,6 +55,12 @@ class WeatherAcquisitor:
     def GetCondition(self, latlong):
         raise NotImplementedError
 
+    def GetConditions(self, latlongs):
+        """
+        Returns the current conditions for several latitude/longitude coordinates (a list).
+        """
+        return [self.GetCondition(latlong) for latlong in latlongs]
+
 __all__.append('GoogleWeather')
 class GoogleWeather(WeatherAcquisitor):
     def GetCondition(self, latlong):
@@ -72,13 +87,246 @@ class RainyInJerusalem(WeatherAcquisitor):
         latlong     - latitude/longitude coordinates
         radius_km   - radius from jerusalem.
         """
-        import geopy.distance
-        dist = geopy.distance.distance(latlong, (31.768862, 35.203856)).m
-        if dist < radius_km*1000:
-            return u"Rain"
-        else:
-            return u"Sunny"
+        return self.GetConditions([latlong], radius_km)[0]
+
+    def GetConditions(self, latlongs, radius_km=50):
+        """
+        Like GetCondition, for several latitude/longitude coordinates at once (a list).
+        """
+        latlongs = numpy.array(latlongs, dtype=float).reshape((len(latlongs), 2))
+        dist = spatial.haversine((31.768862, 35.203856), latlongs[:, 0], latlongs[:, 1])
+        return [(u"Rain" if d < radius_km else u"Sunny") for d in dist]
+
+
+
+__all__.append('CachedWeather')
+class CachedWeather(WeatherAcquisitor):
+    """
+    A caching layer over another WeatherAcquisitor.
+
+    Locations are bucketed into grid cells, and the condition of each cell is cached for 'ttl' seconds
+    (failures - exceptions or an empty condition - are cached for 'failure_ttl' seconds). Missing cells are
+    fetched concurrently by a pool of threads (started on the first fetch, stopped by Close); cells which were
+    not fetched by the deadline get an empty (unknown) condition.
+
+    Use like this:
+
+    >>> W = CachedWeather(GoogleWeather())
+    >>> W.GetConditions([(31.768862, 35.203856), (32.794044, 34.989571)])
+    [u'Rain', u'Sunny']
+    >>> W.StartRefresher([info['latlong'] for info in RD_places.data.values() if info['latlong'] != None])
+    """
+
+    _cell_size = 0.1        # (in degrees)
+
+    def __init__(self, weather_client, ttl=30*60, failure_ttl=5*60, timeout=5, n_threads=8):
+        """
+        weather_client      - the WeatherAcquisitor to fetch the conditions with
+        ttl                 - number of seconds to keep a condition
+        failure_ttl         - number of seconds to keep a failure
+        timeout             - maximal number of seconds to wait for conditions in each call (the deadline)
+        n_threads           - number of threads which fetch conditions
+        """
+        self.weather_client = weather_client
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.timeout = timeout
+
+        self.cache = {}             # cell -> (condition, expiration time)
+        self.pending = {}           # cell -> threading.Event, set when the cell was fetched
+        self.lock = threading.Lock()
+
+        self.n_fetches = 0
+        self.n_failures = 0
+
+        # (the threads are started on the first fetch, and stopped by Close)
+        self.n_threads = n_threads
+        self.threads = []
+        self.queue = Queue.Queue()
+
+        self.refresher = None
+
+    def _Cell(self, latlong):
+        return (int(math.floor(latlong[0] / self._cell_size)), int(math.floor(latlong[1] / self._cell_size)))
+
+    def _CellCenter(self, cell):
+        return ((cell[0] + 0.5) * self._cell_size, (cell[1] + 0.5) * self._cell_size)
+
+    def _Worker(self, queue):
+        while True:
+            cell = queue.get()
+            if cell == None:
+                # (see Close)
+                return
+            self._Fetch(cell)
+
+    def _StartWorkers(self):
+        # (called with the lock held)
+        if len(self.threads) > 0:
+            return
+        for n in xrange(self.n_threads):
+            thread = threading.Thread(target=self._Worker, args=(self.queue,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _Fetch(self, cell):
+        """
+        Fetch the condition of a cell and cache it.
+        """
+        try:
+            condition = self.weather_client.GetCondition(self._CellCenter(cell))
+        except Exception:
+            condition = u""
+
+        with self.lock:
+            self.n_fetches += 1
+            if condition == u"":
+                self.n_failures += 1
+                self.cache[cell] = (condition, time.time() + self.failure_ttl)
+            else:
+                self.cache[cell] = (condition, time.time() + self.ttl)
+            event = self.pending.pop(cell, None)
 
+        if event != None:
+            event.set()
 
+    def _Request(self, cell, refresh=False):
+        """
+        Make sure the cell is being fetched, if it is not fresh in the cache (or if refresh is True).
+        Return an event to wait on, or None if the cached condition can be used.
+        """
+        with self.lock:
+            if (not refresh) and self.cache.has_key(cell) and self.cache[cell][1] > time.time():
+                return None
+            if self.pending.has_key(cell):
+                return self.pending[cell]
+            event = self.pending[cell] = threading.Event()
+            self._StartWorkers()
+            queue = self.queue
+
+        queue.put(cell)
+        return event
+
+    def GetCondition(self, latlong):
+        """
+        Returns the current condition for a latitude/longitude coordinate.
+        """
+        return self.GetConditions([latlong])[0]
+
+    def GetConditions(self, latlongs, timeout=None):
+        """
+        Returns the current conditions for several latitude/longitude coordinates (a list).
+
+        timeout     - maximal number of seconds to wait (default is self.timeout)
+        """
+        if timeout == None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+
+        cells = [self._Cell(latlong) for latlong in latlongs]
+
+        events = [self._Request(cell) for cell in set(cells)]
+        for event in events:
+            if event != None:
+                event.wait(max(0, deadline - time.time()))
+
+        with self.lock:
+            return [self.cache.get(cell, (u"", None))[0] for cell in cells]
+
+    def Clear(self):
+        """
+        Clear the cache.
+        """
+        with self.lock:
+            self.cache = {}
+
+    def StartRefresher(self, latlongs, interval=None):
+        """
+        Start a background thread which keeps the cells of the given locations (e.g., of the wineries) warm,
+        by refetching them every 'interval' seconds (default is 90% of the ttl).
+        """
+        self.StopRefresher()
+
+        if interval == None:
+            interval = 0.9 * self.ttl
+
+        cells = set(self._Cell(latlong) for latlong in latlongs)
+        stop = threading.Event()
+
+        def refresh():
+            while not stop.is_set():
+                for cell in cells:
+                    self._Request(cell, refresh=True)
+                stop.wait(interval)
+
+        self.refresher = (threading.Thread(target=refresh), stop)
+        self.refresher[0].daemon = True
+        self.refresher[0].start()
+
+    def StopRefresher(self):
+        """
+        Stop the background refresher (if it is running).
+        """
+        if self.refresher != None:
+            thread, stop = self.refresher
+            stop.set()
+            thread.join()
+            self.refresher = None
+
+    def Close(self):
+        """
+        Stop the refresher and the fetching threads (after they fetch the cells already requested).
+        The object can still be used afterwards (the threads are started again when needed).
+        """
+        self.StopRefresher()
+
+        # (threads started after this get a new queue)
+        with self.lock:
+            threads, queue = self.threads, self.queue
+            self.threads, self.queue = [], Queue.Queue()
+        for thread in threads:
+            queue.put(None)
+
+        for thread in threads:
+            thread.join()
+
+
+__all__.append('FakeWeather')
+class FakeWeather(WeatherAcquisitor):
+    """
+    (For debugging and testing purposes)
+
+    A local stand-in for a weather provider, with a delay and failures.
+    """
+
+    def __init__(self, conditions=None, default_condition=u"Sunny", delay=0, failure_rate=0, seed=None):
+        """
+        conditions          - a function from latlong to a condition (default is always default_condition)
+        default_condition   - the condition to return
+        delay               - number of seconds each call takes
+        failure_rate        - probability of each call raising an IOError
+        seed                - the seed of the failures
+        """
+        self.conditions = conditions
+        self.default_condition = default_condition
+        self.delay = delay
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+        self.n_calls = 0
+        self.lock = threading.Lock()
+
+    def GetCondition(self, latlong):
+        with self.lock:
+            self.n_calls += 1
+            failed = (self.random.random() < self.failure_rate)
 
+        if self.delay:
+            time.sleep(self.delay)
+        if failed:
+            raise IOError("Fake weather failure")
 
+        if self.conditions != None:
+            return self.conditions(latlong)
+        return self.default_condition